@@ -1,21 +1,25 @@
 import os
-from flask import Flask, request, render_template, jsonify
+import time
+from flask import Flask, Response, g, request, render_template, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_community.chat_models import ChatOpenAI
-import spacy
-from tqdm import tqdm
-from functions.functions_rag import (
-    encode_pdf,
-    retrieve_context_per_question,
-    answer_question_from_context,
-    create_question_answer_from_context_chain
-)
 
-from functions.functions_utils import (
-    find_all_pdfs,
-    load_file_titles
+# Load environment variables (before the functions modules read their settings)
+load_dotenv()
+
+from functions.functions_index import INDEX_FOLDER
+from functions.functions_context import create_app_context
+from functions.functions_metrics import observe_stage, start_request_spans, stop_request_spans
+from functions.functions_api import (
+    METRICS_MIMETYPE,
+    STREAM_HEADERS,
+    RequestError,
+    aask_batch,
+    ask,
+    ask_stream,
+    document_keywords,
+    keyword_suggestions,
+    metrics_text
 )
 
 app = Flask(__name__)
@@ -25,73 +29,72 @@ UPLOAD_FOLDER = './database'
 ALLOWED_EXTENSIONS = {'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Load environment variables
-load_dotenv()
-
-# Load OpenAI API key from environment
+# Load OpenAI API key from environment (not needed with LLM_MODEL=fake and a hash- embedding model)
 openai_api_key = os.getenv("OPENAI_API_KEY")
-os.environ["OPENAI_API_KEY"] = openai_api_key
+if openai_api_key:
+    os.environ["OPENAI_API_KEY"] = openai_api_key
 
-nlp = spacy.load("en_core_web_sm")
+# Objects shared by all requests (LLM, QA chain, embeddings, indexes, file titles, answer cache)
+app_context = create_app_context(INDEX_FOLDER, UPLOAD_FOLDER, './file_titles.csv')
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    g.spans_token = start_request_spans()
+
+@app.after_request
+def add_timing_header(response):
+    observe_stage(f"request_{request.endpoint}", time.perf_counter() - g.request_start)
+    server_timing = stop_request_spans(g.spans_token)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
+@app.errorhandler(RequestError)
+def request_error(e):
+    return jsonify({'error': str(e)}), e.status
+
 @app.route('/ask', methods=['POST'])
 def ask_question():
-    data = request.get_json()
-    question = data.get('question')
-
-    if not question:
-        return jsonify({'error': 'Missing question'}), 400
-
-    # Load file paths and titles from the CSV file
-    file_titles = load_file_titles('./file_titles.csv')
-
-    # Get all PDF files in the directory
-    pdf_files = find_all_pdfs(app.config['UPLOAD_FOLDER'])
-
-    if not pdf_files:
-        return jsonify({'error': 'No files uploaded'}), 400
-
-    combined_chunks_vector_store = None
-    references = []
-
-    # Progress bar to show file processing
-    for pdf_file in tqdm(pdf_files, desc="Processing PDFs"):
-        vectorstore = encode_pdf(pdf_file, chunk_size=1000, chunk_overlap=200)
-
-        if combined_chunks_vector_store is None:
-            combined_chunks_vector_store = vectorstore
-        else:
-            combined_chunks_vector_store.merge_from(vectorstore)
-
-    # Retrieve the relevant context (returning the document object itself)
-    context_docs = retrieve_context_per_question(question, combined_chunks_vector_store.as_retriever(search_kwargs={"k": 2}))
-    #print("Retrieved Context: ", context_docs)
-
-    # Append source of related files to references by accessing metadata
-    for doc in context_docs:
-        if hasattr(doc, 'metadata') and 'source' in doc.metadata:
-            file_path = doc.metadata['source']  # Use the full file path
-            normalized_path = os.path.normpath(file_path)  # Normalize the path for matching
-            normalized_path = normalized_path.replace("\\", "/")  # Convert backslashes to slashes (if necessary)
-            
-            # Find file title using the normalized path
-            file_title = file_titles.get(normalized_path, "Unknown Title")
-            references.append({"file_path": normalized_path, "file_title": file_title})
-
-    # Remove duplicate file paths and titles
-    references = [dict(t) for t in {tuple(d.items()) for d in references}]
-
-    # Generate an answer using the context
-    llm = ChatOpenAI(temperature=0, model_name="gpt-4", max_tokens=2000)
-    question_answer_from_context_chain = create_question_answer_from_context_chain(llm)
-    result = answer_question_from_context(question, " ".join([doc.page_content for doc in context_docs]), question_answer_from_context_chain)
-    return jsonify({'answer': result['answer'], 'context': result['context'], 'references': references}), 200
+    # From the answer cache, or by hybrid retrieval (BM25 and FAISS in parallel) and the LLM
+    return jsonify(ask(app_context, request.get_json())), 200
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_question_stream():
+    # Retrieval finishes before the response starts, so the first event is sent right after it
+    events = ask_stream(app_context, request.get_json())
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_question_batch():
+    # One vectorized retrieval pass, then concurrent answers with retries on rate limits
+    return jsonify(app_context.run_async(aask_batch(app_context, request.get_json()))), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
+
+@app.route('/cache/stats', methods=['GET'])
+def answer_cache_stats():
+    return jsonify(app_context.answer_cache.stats()), 200
+
+@app.route('/keywords', methods=['GET'])
+def keywords():
+    # Top keywords of one document (?document=<file path>) or of the corpus, precomputed when indexing
+    return jsonify(document_keywords(app_context.get_keyword_index(), request.args)), 200
+
+@app.route('/keywords/autocomplete', methods=['GET'])
+def keyword_autocomplete():
+    # Completions of a partially typed query (?q=reactor co), without the LLM or the PDFs
+    return jsonify(keyword_suggestions(app_context.get_keyword_index(), request.args)), 200
 
 if __name__ == '__main__':
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
+    app_context.get_retriever()
+    app_context.get_keyword_index()
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+from quart import Quart, Response, g, request, render_template, jsonify
+from quart_cors import cors
+from dotenv import load_dotenv
+
+# Load environment variables (before the functions modules read their settings)
+load_dotenv()
+
+from functions.functions_index import INDEX_FOLDER
+from functions.functions_context import create_app_context
+from functions.functions_metrics import observe_stage, start_request_spans, stop_request_spans
+from functions.functions_api import (
+    METRICS_MIMETYPE,
+    STREAM_HEADERS,
+    RequestError,
+    aask,
+    aask_batch,
+    aask_stream,
+    document_keywords,
+    keyword_suggestions,
+    metrics_text
+)
+
+# Asynchronous (ASGI) version of app.py: embedding, retrieval and LLM calls are awaited,
+# so one process serves many in-flight questions. Run with:
+#   hypercorn app_async:app --bind 0.0.0.0:5001
+app = Quart(__name__)
+app = cors(app)
+
+UPLOAD_FOLDER = './database'
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+# Streamed answers can take longer than the default 60 second response timeout
+app.config['RESPONSE_TIMEOUT'] = None
+
+# Objects shared by all requests (LLM, QA chain, embeddings, indexes, file titles, answer cache)
+app_context = create_app_context(INDEX_FOLDER, UPLOAD_FOLDER, './file_titles.csv')
+
+@app.before_serving
+async def load_indexes():
+    # Load (or build) the indexes before the first request, without blocking the event loop
+    await asyncio.get_running_loop().run_in_executor(None, app_context.get_retriever)
+    await asyncio.get_running_loop().run_in_executor(None, app_context.get_keyword_index)
+
+@app.after_serving
+async def close_connections():
+    await app_context.aclose()
+
+@app.before_request
+async def start_timing():
+    g.request_start = time.perf_counter()
+    g.spans_token = start_request_spans()
+
+@app.after_request
+async def add_timing_header(response):
+    observe_stage(f"request_{request.endpoint}", time.perf_counter() - g.request_start)
+    server_timing = stop_request_spans(g.spans_token)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+@app.route('/')
+async def home():
+    return await render_template('index.html')
+
+@app.errorhandler(RequestError)
+async def request_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+@app.route('/ask', methods=['POST'])
+async def ask_question():
+    # From the answer cache, or by hybrid retrieval and the LLM (retried with exponential backoff on rate limits)
+    return jsonify(await aask(app_context, await request.get_json())), 200
+
+@app.route('/ask/stream', methods=['POST'])
+async def ask_question_stream():
+    # Retrieval finishes before the response starts, so the first event is sent right after it
+    events = await aask_stream(app_context, await request.get_json())
+    return events, 200, dict(STREAM_HEADERS, **{'Content-Type': 'text/event-stream'})
+
+@app.route('/ask/batch', methods=['POST'])
+async def ask_question_batch():
+    # One vectorized retrieval pass, then concurrent answers with retries on rate limits
+    return jsonify(await aask_batch(app_context, await request.get_json())), 200
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
+
+@app.route('/cache/stats', methods=['GET'])
+async def answer_cache_stats():
+    return jsonify(app_context.answer_cache.stats()), 200
+
+@app.route('/keywords', methods=['GET'])
+async def keywords():
+    # Top keywords of one document (?document=<file path>) or of the corpus, precomputed when indexing
+    keyword_index = await asyncio.get_running_loop().run_in_executor(None, app_context.get_keyword_index)
+    return jsonify(document_keywords(keyword_index, request.args)), 200
+
+@app.route('/keywords/autocomplete', methods=['GET'])
+async def keyword_autocomplete():
+    # Completions of a partially typed query (?q=reactor co), without the LLM or the PDFs
+    keyword_index = await asyncio.get_running_loop().run_in_executor(None, app_context.get_keyword_index)
+    return jsonify(keyword_suggestions(keyword_index, request.args)), 200
+
+if __name__ == '__main__':
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+    app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,148 @@
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from functions.functions_bm25 import BM25Index
+from functions.functions_embeddings import CachedEmbeddings, HashEmbeddings
+from functions.functions_retrieval import HybridRetriever
+from functions.functions_vector_index import build_faiss_index
+
+# Offline benchmark of query coalescing: closed-loop clients retrieve from a synthetic corpus, with the
+# local embedder waiting --latency seconds per call like an embedding API round trip
+parser = argparse.ArgumentParser(description="Benchmark retrieval throughput and p99 latency with query coalescing.")
+parser.add_argument('--chunks', type=int, default=20000, help="Number of synthetic chunks")
+parser.add_argument('--dim', type=int, default=768, help="Embedding dimension")
+parser.add_argument('--index-type', default='flat', help="Vector index type (see benchmark_vector_index.py)")
+parser.add_argument('--latency', type=float, default=0.05, help="Simulated seconds per embedding call")
+parser.add_argument('--requests', type=int, default=400, help="Questions per concurrency level")
+parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64, 128],
+                    help="Numbers of clients with a question in flight")
+parser.add_argument('--windows', type=float, nargs='+', default=[0.0, 0.002, 0.005],
+                    help="Coalescing windows in seconds (0 is off)")
+parser.add_argument('--max-batch', type=int, default=32, help="Largest coalesced batch")
+parser.add_argument('--p99', type=float, default=0.25, help="p99 latency target in seconds for the summary")
+parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                    help="Threaded clients (app.py) or asyncio tasks (app_async.py)")
+args = parser.parse_args()
+
+
+class CountingHashEmbeddings(HashEmbeddings):
+    # Counts embedding calls (API round trips) and the texts they embed
+    def __init__(self, size, latency):
+        super().__init__(size=size, latency=latency)
+        self.calls = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def _count(self, texts):
+        with self._lock:
+            self.calls += 1
+            self.texts += len(texts)
+
+    def embed_documents(self, texts):
+        self._count(texts)
+        return super().embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        self._count(texts)
+        return await super().aembed_documents(texts)
+
+
+def synthetic_corpus(n_chunks, seed=0):
+    # Chunks of 40 words from a Zipf-distributed vocabulary, like technical text
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"term{i}" for i in range(20000)])
+    words = vocabulary[np.minimum(rng.zipf(1.2, size=(n_chunks, 40)), len(vocabulary)) - 1]
+    return [" ".join(row) for row in words]
+
+
+def run_threads(retriever, questions, concurrency):
+    latencies = []
+    lock = threading.Lock()
+    position = iter(range(len(questions)))
+
+    def client():
+        while True:
+            with lock:
+                i = next(position, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            retriever.retrieve_with_timings(questions[i])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+async def run_tasks(retriever, questions, concurrency):
+    latencies = []
+    position = iter(range(len(questions)))
+
+    async def client():
+        for i in position:
+            start = time.perf_counter()
+            await retriever.aretrieve_with_timings(questions[i])
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies
+
+
+texts = synthetic_corpus(args.chunks)
+print(f"Embedding {len(texts)} synthetic chunks of dimension {args.dim}...")
+corpus_vectors = HashEmbeddings(size=args.dim).embed_documents(texts)
+vectorstore = FAISS.from_embeddings(list(zip(texts, corpus_vectors)), HashEmbeddings(size=args.dim))
+vectorstore.index = build_faiss_index(np.array(corpus_vectors, dtype=np.float32), args.index_type)
+bm25 = BM25Index().fit(texts, list(vectorstore.index_to_docstore_id.values()))
+
+best = {}
+with tempfile.TemporaryDirectory() as tmp_dir:
+    print(f"\n{'window ms':>9} {'clients':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'batch':>6}")
+    for window in args.windows:
+        base = CountingHashEmbeddings(args.dim, args.latency)
+        vectorstore.embedding_function = CachedEmbeddings(base, cache_file=f"{tmp_dir}/embeddings-{window}.sqlite")
+        # The executor is sized like the application's (ThreadPoolExecutor defaults)
+        retriever = HybridRetriever(vectorstore, bm25, k=4, executor=ThreadPoolExecutor(),
+                                    coalesce_window=window, coalesce_max_batch=args.max_batch)
+
+        for concurrency in args.concurrency:
+            # Fresh questions, so every one needs an embedding call
+            questions = [f"term{i % 97} term{i % 13} question {window} {concurrency} {i}"
+                         for i in range(args.requests)]
+            calls, embedded = base.calls, base.texts
+            start = time.perf_counter()
+            if args.mode == 'thread':
+                latencies = run_threads(retriever, questions, concurrency)
+            else:
+                latencies = asyncio.run(run_tasks(retriever, questions, concurrency))
+            elapsed = time.perf_counter() - start
+
+            throughput = len(latencies) / elapsed
+            p50, p99 = np.percentile(latencies, [50, 99])
+            batch = (base.texts - embedded) / max(base.calls - calls, 1)
+            print(f"{window * 1000:>9.1f} {concurrency:>8} {throughput:>8.1f} {p50 * 1000:>8.1f} "
+                  f"{p99 * 1000:>8.1f} {batch:>6.1f}")
+            if p99 <= args.p99:
+                best[window] = max(best.get(window, 0.0), throughput)
+
+print(f"\nBest throughput with p99 <= {args.p99 * 1000:.0f} ms:")
+baseline = best.get(0.0)
+for window in args.windows:
+    label = "off" if window == 0 else f"window {window * 1000:.1f} ms"
+    if window not in best:
+        print(f"  {label:>16}: no concurrency level met the target")
+        continue
+    gain = f" ({best[window] / baseline:.1f}x)" if baseline and window != 0 else ""
+    print(f"  {label:>16}: {best[window]:.1f} requests/s{gain}")
@@ -0,0 +1,44 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from functions.functions_embeddings import CachedEmbeddings, HashEmbeddings
+
+# Offline benchmark of the embedding cache using the local stand-in embedder
+parser = argparse.ArgumentParser(description="Benchmark the embedding cache without calling OpenAI.")
+parser.add_argument('--chunks', type=int, default=20000, help="Number of chunks to embed per pass")
+parser.add_argument('--unique', type=float, default=0.7, help="Fraction of chunks with unique text")
+parser.add_argument('--latency', type=float, default=0.05, help="Simulated seconds per embedding call")
+args = parser.parse_args()
+
+
+class SlowHashEmbeddings(HashEmbeddings):
+    # Adds a fixed per-call delay to mimic an embedding API round trip
+    def embed_documents(self, texts):
+        self.calls = getattr(self, 'calls', 0) + 1
+        time.sleep(args.latency)
+        return super().embed_documents(texts)
+
+
+random.seed(0)
+unique_texts = [f"Section {i} reactor coolant pressure boundary requirement {i * 7}"
+                for i in range(max(1, int(args.chunks * args.unique)))]
+chunks = [random.choice(unique_texts) for _ in range(args.chunks)]
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    base = SlowHashEmbeddings(size=256)
+    cache = CachedEmbeddings(base, cache_file=os.path.join(tmp_dir, 'embeddings.sqlite'))
+
+    for name in ("cold", "warm (memory)"):
+        start = time.perf_counter()
+        cache.embed_documents(chunks)
+        print(f"{name:>14}: {time.perf_counter() - start:.2f}s, {getattr(base, 'calls', 0)} embedding calls so far")
+
+    # A fresh wrapper over the same file only has the disk tier to rely on
+    cache = CachedEmbeddings(base, cache_file=os.path.join(tmp_dir, 'embeddings.sqlite'))
+    start = time.perf_counter()
+    cache.embed_documents(chunks)
+    print(f"{'warm (disk)':>14}: {time.perf_counter() - start:.2f}s, {base.calls} embedding calls so far")
+    print(f"Cache stats: {cache.stats()}")
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Modules the web applications import to serve from a prebuilt index
+SERVING_MODULES = ['functions.functions_context', 'app', 'app_async']
+
+# Parsing, ingestion and evaluation libraries that serving must not load
+HEAVY_MODULES = ['spacy', 'deepeval', 'fitz', 'pymupdf', 'pypdf', 'pdfplumber', 'rank_bm25', 'tqdm',
+                 'langchain.text_splitter', 'langchain_openai', 'langchain_community.chat_models']
+
+# Printed by the child process before its result
+RESULT_MARKER = "IMPORT_BENCHMARK_RESULT "
+
+# Child process: time one import and list the heavy modules it loaded
+CHILD_CODE = f"""
+import sys, time, json, importlib
+start = time.perf_counter()
+if sys.argv[1]:
+    importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print({RESULT_MARKER!r} + json.dumps({{'seconds': seconds,
+      'heavy': [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))
+"""
+
+parser = argparse.ArgumentParser(description="Benchmark the cold import time of the serving modules.")
+parser.add_argument('modules', nargs='*', default=SERVING_MODULES, help="Modules to import")
+parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per module (the median is reported)")
+parser.add_argument('--top', type=int, default=10, help="Slowest imports to list per module (from -X importtime)")
+parser.add_argument('--max-seconds', type=float, default=None,
+                    help="Exit with an error if a module takes longer to import")
+parser.add_argument('--json', default=None, help="Also write the results to this JSON file")
+args = parser.parse_args()
+
+# The applications build their context on import: run them offline unless configured otherwise
+repo_folder = os.path.dirname(os.path.abspath(__file__))
+env = dict(os.environ)
+env.setdefault('LLM_MODEL', 'fake')
+env.setdefault('EMBEDDING_MODEL', 'hash-384')
+env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_folder, env.get('PYTHONPATH')]))
+
+
+def import_once(module, importtime=False):
+    # Import the module in a fresh interpreter and return its result (with the process's wall time)
+    # and, with importtime, the -X importtime report (which slows the import down)
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD_CODE, module]
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=repo_folder, env=env, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if completed.returncode != 0 or not lines:
+        sys.exit(f"Importing {module or 'nothing'} failed:\n{completed.stderr[-2000:]}")
+
+    imports = []
+    for line in completed.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if line.startswith('import time:') and not line.endswith('imported package'):
+            _, cumulative, name = line.split('|')
+            imports.append((int(cumulative), name.rstrip()))
+    result = json.loads(lines[-1][len(RESULT_MARKER):])
+    result['wall_seconds'] = wall_seconds
+    return result, imports
+
+
+baseline = statistics.median(import_once('')[0]['wall_seconds'] for _ in range(args.runs))
+print(f"Interpreter startup (nothing imported): {baseline * 1000:.0f} ms\n")
+
+results = {}
+failed = False
+for module in args.modules:
+    runs = [import_once(module)[0] for _ in range(args.runs)]
+    seconds = statistics.median(result['seconds'] for result in runs)
+    wall_seconds = statistics.median(result['wall_seconds'] for result in runs)
+    heavy = runs[0]['heavy']
+    # Direct imports of the top-level modules (one level of indentation), slowest first
+    _, imports = import_once(module, importtime=True)
+    slowest = sorted(((cumulative, name.strip()) for cumulative, name in imports
+                      if name.startswith('   ') and not name.startswith('     ')), reverse=True)[:args.top]
+    results[module] = {'seconds': seconds, 'process_seconds': wall_seconds, 'heavy_modules': heavy,
+                       'slowest_imports': [{'module': name, 'seconds': cumulative / 1e6} for cumulative, name in slowest]}
+
+    print(f"{module}: import {seconds * 1000:.0f} ms, process {wall_seconds * 1000:.0f} ms (median of {args.runs})")
+    for cumulative, name in slowest:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    if heavy:
+        print(f"  Heavy modules loaded: {', '.join(heavy)}")
+    if heavy and module in SERVING_MODULES:
+        failed = True
+    if args.max_seconds is not None and seconds > args.max_seconds:
+        print(f"  Slower than --max-seconds {args.max_seconds}")
+        failed = True
+    print()
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump({'startup_seconds': baseline, 'modules': results}, f, indent=2)
+
+if failed:
+    sys.exit("Import time regression: see the modules above.")
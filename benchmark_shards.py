@@ -0,0 +1,89 @@
+import os
+import time
+import argparse
+import tempfile
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from functions.functions_embeddings import HashEmbeddings
+from functions.functions_shards import SHARD_KEYS, ShardedIndex, build_shards
+from functions.functions_vector_index import build_faiss_index
+
+# Query latency of the sharded index against the number of shards, on synthetic documents
+# split into chapters. Each shard count is built in the same folder, so the output also
+# shows how many chunks rebalancing moves when shards are added.
+parser = argparse.ArgumentParser(description="Benchmark sharded vector search latency against the shard count.")
+parser.add_argument('--chunks', type=int, default=200000, help="Number of synthetic chunks")
+parser.add_argument('--dim', type=int, default=384, help="Embedding dimension")
+parser.add_argument('--documents', type=int, default=2000, help="Number of synthetic documents (of 19 chapters)")
+parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8], help="Shard counts, in build order")
+parser.add_argument('--shard-key', choices=SHARD_KEYS, default='document', help="Group kept in one shard")
+parser.add_argument('--index-type', default='flat', help="Index type of each shard (see benchmark_vector_index.py)")
+parser.add_argument('--queries', type=int, default=200, help="Number of queries")
+parser.add_argument('--batch', type=int, default=1, help="Queries per search (1 as in the app, more when coalescing)")
+parser.add_argument('--k', type=int, default=20, help="Hits per query")
+parser.add_argument('--threads', type=int, default=1, help="FAISS threads per shard process")
+args = parser.parse_args()
+
+
+def synthetic_vectors(n_vectors, dim, n_clusters=200, seed=0):
+    # Clustered, L2-normalized vectors, closer to text embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(n_clusters, size=n_vectors)] + 0.5 * rng.standard_normal((n_vectors, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def search_latencies(index, queries, k, batch):
+    latencies = []
+    for start in range(0, len(queries), batch):
+        began = time.perf_counter()
+        index.search(queries[start:start + batch], k)
+        latencies.append(time.perf_counter() - began)
+    return np.array(latencies)
+
+
+vectors = synthetic_vectors(args.chunks, args.dim)
+rng = np.random.default_rng(1)
+queries = vectors[rng.integers(len(vectors), size=args.queries)]
+queries = np.ascontiguousarray(queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32), dtype=np.float32)
+
+# Documents of log-normally distributed lengths, stored one after the other like the PDFs of the index
+lengths = rng.lognormal(0.0, 1.0, size=args.documents)
+bounds = np.round(np.cumsum(lengths) / lengths.sum() * args.chunks).astype(np.int64)
+document_of = np.searchsorted(bounds, np.arange(args.chunks), side='right')
+metadatas = [{'source': f'database/manual/NUREG0800_Chapter{document % 19 + 1}/{document}.pdf',
+              'chapter': int(document % 19 + 1), 'section': str(document)} for document in document_of]
+
+print(f"Building a store of {args.chunks} synthetic chunks of dimension {args.dim} ({os.cpu_count()} CPUs)...")
+vectorstore = FAISS.from_embeddings([(f"chunk {i}", vector) for i, vector in enumerate(vectors)],
+                                    HashEmbeddings(size=args.dim), metadatas=metadatas)
+
+single = build_faiss_index(vectors, args.index_type)
+faiss.omp_set_num_threads(args.threads)
+truth = single.search(queries, args.k)[1]
+latencies = search_latencies(single, queries, args.k, args.batch)
+print(f"\n{'shards':>6} {'largest':>8} {'moved':>8} {'p50 ms':>8} {'p99 ms':>8} {'q/s':>8} {'recall':>7}")
+print(f"{'none':>6} {args.chunks:>8} {'':>8} {np.median(latencies) * 1000:>8.2f} "
+      f"{np.percentile(latencies, 99) * 1000:>8.2f} {args.queries / latencies.sum():>8.0f} {1.0:>7.3f}")
+
+with tempfile.TemporaryDirectory() as index_folder:
+    for n_shards in args.shards:
+        info = build_shards(vectorstore, index_folder, n_shards, 'benchmark', args.shard_key, args.index_type)
+        index = ShardedIndex(index_folder, threads=args.threads)
+        try:
+            # Warm up the connections before timing
+            index.search(queries[:1], args.k)
+            latencies = search_latencies(index, queries, args.k, args.batch)
+            found = index.search(queries, args.k)[1]
+        finally:
+            index.close()
+
+        recall = np.mean([len(set(f[f >= 0]) & set(t)) / len(t) for f, t in zip(found, truth)])
+        print(f"{n_shards:>6} {max(info['sizes']):>8} {info['moved_chunks']:>8} {np.median(latencies) * 1000:>8.2f} "
+              f"{np.percentile(latencies, 99) * 1000:>8.2f} {args.queries / latencies.sum():>8.0f} {recall:>7.3f}")
+
+print("\nlargest: chunks in the largest shard (the vectors one process holds); moved: chunks that changed "
+      "shard when rebalancing from the previous row")
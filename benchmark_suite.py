@@ -0,0 +1,408 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import threading
+import subprocess
+
+import numpy as np
+
+# Stages in the order they run. Each runs in a fresh process, so its peak RSS is its own.
+STAGES = ('ingest', 'index', 'retrieval', 'ask')
+
+# Printed by a stage process before its result
+RESULT_MARKER = "BENCHMARK_SUITE_RESULT "
+
+# Settings of the stage processes: the local stand-in LLM, no simulated latency, and every optional
+# feature at its default, so that runs on different commits compare. EMBEDDING_MODEL follows --dim.
+STAGE_ENV = {
+    'LLM_MODEL': 'fake',
+    'FAKE_LLM_LATENCY': '0',
+    'FAKE_EMBEDDING_LATENCY': '0',
+    'RERANKER': '',
+    'COALESCE_WINDOW': '0',
+    'SHARED_INDEX': '0',
+    'SHARDED_INDEX': '0',
+    'INDEX_SHARDS': '0',
+    'QUERY_EXPANSION_TERMS': '0',
+    'METRICS_ENABLED': '0',
+    'TIMING_HEADER': '0',
+}
+
+# Metrics --compare checks, by name suffix. Throughputs should not drop, the others should not rise.
+HIGHER_IS_BETTER = ('_per_second',)
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb', 'index_bytes')
+
+# Words of the synthetic pages: review plan vocabulary, mixed with Zipf-distributed filler terms
+DOMAIN_TERMS = (
+    'reactor', 'coolant', 'pressure', 'boundary', 'containment', 'isolation', 'valve', 'pump', 'seismic',
+    'emergency', 'core', 'cooling', 'RCIC', 'ECCS', 'turbine', 'steam', 'generator', 'feedwater',
+    'instrumentation', 'control', 'electrical', 'power', 'fuel', 'handling', 'radiation', 'protection', 'fire',
+    'quality', 'assurance', 'inspection', 'testing', 'acceptance', 'criteria', 'review', 'procedures',
+    'technical', 'specifications', 'accident', 'analysis', 'design', 'basis', 'structural', 'integrity',
+    'piping', 'welding', 'materials', 'fracture', 'toughness', 'overpressure', 'relief', 'heat', 'removal',
+    'decay', 'flooding', 'missile', 'ventilation', 'shutdown', 'safety', 'licensee', 'applicant', 'staff',
+)
+FILLER_TERMS = 20000
+WORDS_PER_PAGE = 350
+
+# The review plan has 19 chapters
+CHAPTERS = 19
+
+
+def page_text(rng, document, page):
+    # About a page of text: a heading, then domain terms and filler terms in sentences
+    words = np.where(rng.random(WORDS_PER_PAGE) < 0.3,
+                     np.array(DOMAIN_TERMS)[rng.integers(len(DOMAIN_TERMS), size=WORDS_PER_PAGE)],
+                     np.char.add('term', np.minimum(rng.zipf(1.3, size=WORDS_PER_PAGE), FILLER_TERMS).astype(str)))
+    sentences = [" ".join(words[start:start + 15]).capitalize() + "."
+                 for start in range(0, WORDS_PER_PAGE, 15)]
+    return f"Document {document} page {page} per 10 CFR 50.{document % 100}\n" + " ".join(sentences)
+
+
+def generate_corpus(folder, pages, pages_per_document, seed):
+    """
+    Write a deterministic synthetic corpus of PDFs, laid out like the crawled manual.
+
+    Documents are saved as database/manual/NUREG0800_ChapterN/N_M.pdf, so the chapter
+    and section metadata are read from their paths as for the real dataset. An
+    existing corpus with the same parameters is reused.
+
+    Args:
+        folder (str): The work folder.
+        pages (int): The total number of pages.
+        pages_per_document (int): The number of pages per PDF.
+        seed (int): The seed of the page texts.
+
+    Returns:
+        dict: The corpus description ('documents', 'pages', 'bytes', 'generate_seconds').
+    """
+    import fitz
+
+    manifest_path = os.path.join(folder, 'corpus.json')
+    params = {'pages': pages, 'pages_per_document': pages_per_document, 'seed': seed}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, mode='r', encoding='utf-8') as f:
+            corpus = json.load(f)
+        if corpus['params'] == params:
+            print(f"Reusing the synthetic corpus in {folder}")
+            return corpus
+
+    database_folder = os.path.join(folder, 'database')
+    shutil.rmtree(database_folder, ignore_errors=True)
+    print(f"Generating {pages} synthetic pages in {database_folder}...")
+    start = time.perf_counter()
+    documents = 0
+    total_bytes = 0
+    for first_page in range(0, pages, pages_per_document):
+        chapter = documents % CHAPTERS + 1
+        path = os.path.join(database_folder, 'manual', f'NUREG0800_Chapter{chapter}', f'{chapter}_{documents}.pdf')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rng = np.random.default_rng([seed, documents])
+        with fitz.open() as doc:
+            for page in range(min(pages_per_document, pages - first_page)):
+                doc.new_page().insert_textbox(fitz.Rect(50, 50, 560, 780), page_text(rng, documents, page),
+                                              fontsize=9)
+            # Without dates and a random file id, the same parameters give the same bytes
+            doc.set_metadata({})
+            doc.save(path, garbage=3, deflate=True, no_new_id=True)
+        total_bytes += os.path.getsize(path)
+        documents += 1
+
+    corpus = {'params': params, 'documents': documents, 'pages': pages, 'bytes': total_bytes,
+              'generate_seconds': time.perf_counter() - start}
+    with open(manifest_path, mode='w', encoding='utf-8') as f:
+        json.dump(corpus, f, indent=2)
+    return corpus
+
+
+def make_questions(n_questions, seed, tag):
+    # Distinct questions, so neither the embedding cache nor the answer cache answers them
+    rng = np.random.default_rng([seed, n_questions, len(tag)])
+    terms = np.array(DOMAIN_TERMS)
+    return [f"What does the review plan require for {' '.join(terms[rng.integers(len(terms), size=3)])} "
+            f"and term{rng.integers(1, 200)} ({tag} {i})?" for i in range(n_questions)]
+
+
+def latency_stats(latencies, seconds, unit):
+    """
+    Summarize latencies in seconds, and the throughput over the elapsed seconds.
+    """
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {unit: len(latencies), 'seconds': seconds,
+            f'{unit}_per_second': len(latencies) / seconds if seconds else 0.0,
+            'p50_ms': p50 * 1000, 'p95_ms': p95 * 1000, 'p99_ms': p99 * 1000}
+
+
+def folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+
+def peak_rss_mb(who='self'):
+    # Peak resident set size in MB of this process, or of its largest finished child process
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss / ((1 << 20) if sys.platform == 'darwin' else 1024)
+
+
+def run_ingest(args):
+    # Parse, chunk and embed every PDF on its own, as encode_pdf does, with a cold text cache
+    from functions.functions_embeddings import HashEmbeddings
+    from functions.functions_rag import encode_pdf
+    from functions.functions_utils import find_all_pdfs
+
+    shutil.rmtree('./cache', ignore_errors=True)
+    embeddings = HashEmbeddings(size=args.dim)
+    latencies, chunks = [], 0
+    start = time.perf_counter()
+    for pdf_file in sorted(find_all_pdfs('./database')):
+        began = time.perf_counter()
+        chunks += encode_pdf(pdf_file, embeddings=embeddings).index.ntotal
+        latencies.append(time.perf_counter() - began)
+    seconds = time.perf_counter() - start
+    return dict(latency_stats(latencies, seconds, 'files'), chunks=chunks, chunks_per_second=chunks / seconds,
+                pages_per_second=args.pages / seconds)
+
+
+def run_index(args):
+    # Build the index from scratch with worker processes, as build_index.py --rebuild does
+    from functions.functions_index import create_embeddings, update_index
+    from functions.functions_utils import find_all_pdfs
+
+    shutil.rmtree('./cache', ignore_errors=True)
+    shutil.rmtree('./index', ignore_errors=True)
+    start = time.perf_counter()
+    vectorstore = update_index(find_all_pdfs('./database'), './index', rebuild=True, workers=args.workers,
+                               embeddings=create_embeddings(f'hash-{args.dim}'), index_type=args.index_type)
+    seconds = time.perf_counter() - start
+    chunks = vectorstore.index.ntotal
+    return {'chunks': chunks, 'seconds': seconds, 'chunks_per_second': chunks / seconds,
+            'pages_per_second': args.pages / seconds, 'index_bytes': folder_bytes('./index'),
+            'workers_peak_rss_mb': peak_rss_mb('children') if args.workers > 1 else None}
+
+
+def run_retrieval(args):
+    # Single-question retrieval against the saved index: vector, BM25 and hybrid
+    from functions.functions_index import create_embeddings, load_bm25_index, load_index
+    from functions.functions_rag import bm25_retrieval, retrieve_context_per_question
+    from functions.functions_retrieval import HybridRetriever
+
+    start = time.perf_counter()
+    vectorstore = load_index('./index', create_embeddings(f'hash-{args.dim}'), args.index_type)
+    bm25 = load_bm25_index('./index')
+    cleaned_texts = [vectorstore.docstore.search(doc_id).page_content for doc_id in bm25.doc_ids]
+    retriever = HybridRetriever(vectorstore, bm25, k=args.k)
+    results = {'load_seconds': time.perf_counter() - start}
+
+    searches = {
+        'vector': lambda question: retrieve_context_per_question(
+            question, vectorstore.as_retriever(search_kwargs={'k': args.k})),
+        'bm25': lambda question: bm25_retrieval(bm25, cleaned_texts, question, args.k),
+        'hybrid': lambda question: retriever.retrieve_with_timings(question),
+    }
+    for name, search in searches.items():
+        # The first search of a kind opens caches and allocates buffers
+        search(make_questions(1, args.seed, f'warm-up {name}')[0])
+        latencies = []
+        start = time.perf_counter()
+        for question in make_questions(args.queries, args.seed, name):
+            began = time.perf_counter()
+            search(question)
+            latencies.append(time.perf_counter() - began)
+        results[name] = latency_stats(latencies, time.perf_counter() - start, 'queries')
+    return results
+
+
+def run_ask(args):
+    # Full /ask requests through the Flask application, from --concurrency client threads
+    import app
+
+    start = time.perf_counter()
+    app.app_context.get_retriever()
+    load_seconds = time.perf_counter() - start
+    app.app.test_client().post('/ask', json={'question': make_questions(1, args.seed, 'warm-up ask')[0]})
+
+    questions = make_questions(args.requests, args.seed, 'ask')
+    latencies, errors = [], []
+    lock = threading.Lock()
+    position = iter(range(len(questions)))
+
+    def client():
+        test_client = app.app.test_client()
+        while True:
+            with lock:
+                i = next(position, None)
+            if i is None:
+                return
+            began = time.perf_counter()
+            response = test_client.post('/ask', json={'question': questions[i]})
+            with lock:
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - began)
+                else:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict(latency_stats(latencies, time.perf_counter() - start, 'requests'),
+                load_seconds=load_seconds, errors=len(errors))
+
+
+def run_stage_process(stage, args, work_folder, env):
+    # Run one stage in a fresh interpreter inside the work folder and return its result
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--stage', stage,
+                                                                              '--work-folder', work_folder]
+    completed = subprocess.run(command, cwd=work_folder, env=env, stdout=subprocess.PIPE, text=True)
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if completed.returncode != 0 or not lines:
+        sys.exit(f"The {stage} stage failed with exit code {completed.returncode}.")
+    return json.loads(lines[-1][len(RESULT_MARKER):])
+
+
+def git_commit(repo_folder):
+    # The commit the code was run at, with '-dirty' if tracked files were modified
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_folder, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_folder,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def flatten(results, prefix=''):
+    """
+    Yield the numeric metrics of nested stage results as ('stage.name', value) pairs.
+    """
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(report, baseline, tolerance, min_ms=1.0):
+    """
+    Print the metrics that changed by more than tolerance against a baseline report.
+
+    Args:
+        report (dict): The report of this run.
+        baseline (dict): A report of an earlier run.
+        tolerance (float): The relative change allowed, e.g. 0.2 for 20%.
+        min_ms (float): Latencies changing by fewer milliseconds are within noise.
+
+    Returns:
+        list: The names of the metrics that got worse by more than tolerance.
+    """
+    if baseline['params'] != report['params'] or baseline['machine'] != report['machine']:
+        print("Warning: the baseline was run with other parameters or on another machine.")
+
+    old, new = dict(flatten(baseline['stages'])), dict(flatten(report['stages']))
+    regressions = []
+    print(f"\nAgainst {baseline.get('commit') or 'the baseline'} (tolerance {tolerance:.0%}):")
+    for name in sorted(old.keys() & new.keys()):
+        higher_is_better = name.endswith(HIGHER_IS_BETTER)
+        if not (higher_is_better or name.endswith(LOWER_IS_BETTER)) or not old[name]:
+            continue
+        change = new[name] / old[name] - 1
+        worse = -change if higher_is_better else change
+        if name.endswith('_ms') and abs(new[name] - old[name]) < min_ms:
+            continue
+        if worse > tolerance:
+            regressions.append(name)
+            status = "REGRESSION"
+        elif worse < -tolerance:
+            status = "improved"
+        else:
+            continue
+        print(f"  {name:<36} {old[name]:>12.2f} -> {new[name]:>12.2f} ({change:+.0%}) {status}")
+    if not regressions:
+        print("  No regressions.")
+    return regressions
+
+
+# The guard keeps the ingest worker processes from re-running the suite when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ingest, index build, retrieval and /ask on a synthetic "
+                                                 "corpus with the local embedder and LLM, and report JSON.")
+    parser.add_argument('--pages', type=int, default=1000, help="Pages of the synthetic corpus (e.g. 100 to 100000)")
+    parser.add_argument('--pages-per-document', type=int, default=20, help="Pages per synthetic PDF")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the corpus and the questions")
+    parser.add_argument('--work-folder', default=None,
+                        help="Folder of the corpus, index and caches (default ./benchmark/<pages>-pages)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help="Stages to run")
+    parser.add_argument('--dim', type=int, default=1536, help="Dimension of the local hash embeddings")
+    parser.add_argument('--index-type', default='flat', help="Serving index type (see benchmark_vector_index.py)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Ingest processes of the index stage")
+    parser.add_argument('--queries', type=int, default=200, help="Questions per retrieval method")
+    parser.add_argument('--k', type=int, default=4, help="Chunks retrieved per question")
+    parser.add_argument('--requests', type=int, default=100, help="Requests sent to /ask")
+    parser.add_argument('--concurrency', type=int, default=1, help="Clients sending /ask requests at once")
+    parser.add_argument('--output', default=None, help="JSON report file (default <work folder>/results.json)")
+    parser.add_argument('--compare', default=None, help="Earlier JSON report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative change of a metric reported as a regression by --compare")
+    parser.add_argument('--min-ms', type=float, default=1.0,
+                        help="Latency changes below this many milliseconds are ignored by --compare")
+    parser.add_argument('--stage', choices=STAGES, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage is not None:
+        # Stage process, started by the suite in the work folder
+        run_stage = {'ingest': run_ingest, 'index': run_index, 'retrieval': run_retrieval, 'ask': run_ask}[args.stage]
+        result = run_stage(args)
+        result['peak_rss_mb'] = peak_rss_mb()
+        print(RESULT_MARKER + json.dumps(result), flush=True)
+        sys.exit(0)
+
+    repo_folder = os.path.dirname(os.path.abspath(__file__))
+    work_folder = os.path.abspath(args.work_folder or os.path.join('benchmark', f'{args.pages}-pages'))
+    os.makedirs(work_folder, exist_ok=True)
+    corpus = generate_corpus(work_folder, args.pages, args.pages_per_document, args.seed)
+
+    env = dict(os.environ, **STAGE_ENV, EMBEDDING_MODEL=f'hash-{args.dim}', INDEX_TYPE=args.index_type)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_folder, env.get('PYTHONPATH')]))
+    stages = {}
+    for stage in STAGES:
+        if stage in args.stages:
+            print(f"Running the {stage} stage...", flush=True)
+            stages[stage] = run_stage_process(stage, args, work_folder, env)
+
+    report = {
+        'commit': git_commit(repo_folder),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpus': os.cpu_count()},
+        'params': {'pages': args.pages, 'pages_per_document': args.pages_per_document, 'seed': args.seed,
+                   'dim': args.dim, 'index_type': args.index_type, 'workers': args.workers, 'queries': args.queries,
+                   'k': args.k, 'requests': args.requests, 'concurrency': args.concurrency},
+        'corpus': corpus,
+        'stages': stages,
+    }
+    output = args.output or os.path.join(work_folder, 'results.json')
+    with open(output, mode='w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    print()
+    for name, value in flatten(stages):
+        if name.endswith(HIGHER_IS_BETTER + LOWER_IS_BETTER):
+            print(f"  {name:<36} {value:>12.2f}")
+    print(f"\nReport written to {output}")
+
+    if args.compare:
+        with open(args.compare, mode='r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.tolerance, args.min_ms):
+            sys.exit("Performance regression: see the metrics above.")
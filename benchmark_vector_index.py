@@ -0,0 +1,96 @@
+import time
+import argparse
+
+import faiss
+import numpy as np
+
+from functions.functions_vector_index import (
+    INDEX_TYPES,
+    NPROBE,
+    EF_SEARCH,
+    build_faiss_index,
+    get_factory_string,
+    index_memory_bytes,
+    set_search_parameters
+)
+
+# Compares vector index types against the exact flat index on the saved index or on synthetic vectors
+parser = argparse.ArgumentParser(description="Benchmark recall, latency and memory of vector index types.")
+parser.add_argument('--index', default=None, help="Benchmark the vectors of a saved index folder (e.g. ./index)")
+parser.add_argument('--vectors', type=int, default=100000, help="Number of synthetic vectors (without --index)")
+parser.add_argument('--dim', type=int, default=1536, help="Dimension of the synthetic vectors")
+parser.add_argument('--queries', type=int, default=500, help="Number of queries")
+parser.add_argument('--k', type=int, default=10, help="Recall is measured at k")
+parser.add_argument('--types', nargs='+', default=list(INDEX_TYPES), help="Index types or FAISS factory strings")
+parser.add_argument('--nprobe', type=int, nargs='+', default=[NPROBE], help="IVF lists probed per query")
+parser.add_argument('--ef-search', type=int, nargs='+', default=[EF_SEARCH], help="HNSW candidate list sizes")
+args = parser.parse_args()
+
+
+def synthetic_vectors(n_vectors, dim, n_clusters=200, seed=0):
+    # Clustered, L2-normalized vectors, closer to text embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(n_clusters, size=n_vectors)] + 0.5 * rng.standard_normal((n_vectors, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors, n_queries, seed=1):
+    # Perturbed corpus vectors, so every query has close neighbours
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.integers(len(vectors), size=n_queries)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    return np.ascontiguousarray(queries / np.linalg.norm(queries, axis=1, keepdims=True), dtype=np.float32)
+
+
+def recall_at_k(found, truth):
+    return np.mean([len(set(f[f >= 0]) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+
+def query_latencies(index, queries, k):
+    # One query per call, as in the web application
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+if args.index:
+    index = faiss.read_index(f"{args.index}/index.faiss")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    print(f"Loaded {len(vectors)} vectors of dimension {vectors.shape[1]} from {args.index}")
+else:
+    vectors = synthetic_vectors(args.vectors, args.dim)
+    print(f"Generated {len(vectors)} synthetic vectors of dimension {args.dim}")
+
+queries = make_queries(vectors, args.queries)
+k = min(args.k, len(vectors))
+
+# Ground truth from the exact index
+flat = build_faiss_index(vectors, 'flat')
+_, truth = flat.search(queries, k)
+
+print(f"\n{'index':<28} {'search':<12} {'recall@' + str(k):>9} {'p50 ms':>8} {'p99 ms':>8} {'MB':>9} {'build s':>8}")
+for index_type in args.types:
+    start = time.perf_counter()
+    index = build_faiss_index(vectors, index_type)
+    build_time = time.perf_counter() - start
+    memory = index_memory_bytes(index) / 2 ** 20
+    factory = get_factory_string(index_type, vectors.shape[1], len(vectors))
+
+    # Sweep the search-time parameter of the index type, if it has one
+    if faiss.try_extract_index_ivf(index) is not None:
+        settings = [(f"nprobe={nprobe}", {'nprobe': nprobe}) for nprobe in args.nprobe]
+    elif hasattr(faiss.downcast_index(index), 'hnsw'):
+        settings = [(f"efSearch={ef}", {'ef_search': ef}) for ef in args.ef_search]
+    else:
+        settings = [("exact scan", {})]
+
+    for label, params in settings:
+        set_search_parameters(index, **params)
+        _, found = index.search(queries, k)
+        latencies = query_latencies(index, queries, k) * 1000
+        print(f"{factory:<28} {label:<12} {recall_at_k(found, truth):>9.3f} {np.percentile(latencies, 50):>8.2f} "
+              f"{np.percentile(latencies, 99):>8.2f} {memory:>9.1f} {build_time:>8.1f}")
@@ -0,0 +1,51 @@
+import os
+import argparse
+from dotenv import load_dotenv
+
+# Load environment variables (OPENAI_API_KEY, EMBEDDING_MODEL) before the functions modules read them
+load_dotenv()
+
+from functions.functions_utils import find_all_pdfs, load_file_titles
+from functions.functions_index import update_index, INDEX_FOLDER
+from functions.functions_metrics import METRICS_ENABLED, stage_totals
+from functions.functions_ingest import DEFAULT_WORKERS
+from functions.functions_vector_index import INDEX_TYPE, INDEX_TYPES
+from functions.functions_shared_index import SHARED_INDEX
+from functions.functions_shards import INDEX_SHARDS, SHARD_KEY, SHARD_KEYS
+
+# Directory path to scan for PDF files
+DATABASE_FOLDER = './database'
+
+# Titles saved by get_dataset.py, stored with the chunks
+FILE_TITLES_CSV = './file_titles.csv'
+
+# The guard keeps worker processes from re-running the build when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or incrementally update the vector index.")
+    parser.add_argument('--rebuild', action='store_true', help="Re-embed every PDF instead of only the changed ones")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Number of processes used to parse PDFs")
+    parser.add_argument('--index-type', default=INDEX_TYPE,
+                        help=f"Serving index: one of {', '.join(INDEX_TYPES)} or a FAISS factory string")
+    parser.add_argument('--shared', action='store_true', default=SHARED_INDEX,
+                        help="Also publish a memory-mapped snapshot that server workers share and switch to")
+    parser.add_argument('--shards', type=int, default=INDEX_SHARDS,
+                        help="Also split the index into this many shards, searched in parallel when serving")
+    parser.add_argument('--shard-key', choices=SHARD_KEYS, default=SHARD_KEY,
+                        help="Keep the chunks of each chapter or each document in one shard")
+    args = parser.parse_args()
+
+    # Embed new or changed PDFs and save the merged index for the web app
+    pdf_files = find_all_pdfs(DATABASE_FOLDER)
+    file_titles = load_file_titles(FILE_TITLES_CSV) if os.path.isfile(FILE_TITLES_CSV) else {}
+    vectorstore = update_index(pdf_files, INDEX_FOLDER, rebuild=args.rebuild, workers=args.workers,
+                               index_type=args.index_type, file_titles=file_titles, shared=args.shared,
+                               shards=args.shards, shard_key=args.shard_key)
+    if vectorstore is None:
+        print(f"No text to index in {DATABASE_FOLDER}, the index was removed.")
+    else:
+        print(f"Indexed {len(pdf_files)} PDF files ({vectorstore.index.ntotal} chunks) into {INDEX_FOLDER}")
+
+    # Where the build spent its time, including the parsing done in the worker processes
+    if METRICS_ENABLED:
+        for stage, (count, seconds) in sorted(stage_totals().items(), key=lambda item: -item[1][1]):
+            print(f"{stage:>20}: {seconds:8.2f}s over {count} calls")
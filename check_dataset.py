@@ -1,34 +1,70 @@
 import os
-import pypdf
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+from functions.functions_utils import find_all_pdfs
+from functions.functions_text_cache import validate_pdf, TEXT_CACHE_FOLDER, VALIDATION_MANIFEST_FILE
 
 # Directory path to scan for PDF files
 DATABASE_FOLDER = './database'
 
-# Function to check if a PDF is valid
-def is_valid_pdf(file_path):
-    try:
-        with open(file_path, 'rb') as f:
-            reader = pypdf.PdfReader(f)
-            return True  # The file is a valid PDF
-    except Exception as e:
-        return False  # The file is invalid or corrupted
-
-# Function to find all invalid PDF files in the specified folder
-def find_invalid_pdfs(root_folder):
-    invalid_files = []
-    for dirpath, _, filenames in os.walk(root_folder):
-        for file in filenames:
-            if file.endswith('.pdf'):  # Only check files with .pdf extension
-                full_path = os.path.join(dirpath, file)
-                if not is_valid_pdf(full_path):
-                    invalid_files.append(full_path)  # Add invalid files to the list
-    return invalid_files
-
-# Execute the PDF check
-invalid_files = find_invalid_pdfs(DATABASE_FOLDER)
-if invalid_files:
-    print("The following files are either corrupted or not valid PDF files:")
-    for file in invalid_files:
-        print(file)
-else:
-    print("All PDF files are valid.")
+# Load the results of the previous check
+def load_validation_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# Save the results of this check, replacing the previous ones atomically
+def save_validation_manifest(manifest, manifest_file):
+    os.makedirs(os.path.dirname(manifest_file) or '.', exist_ok=True)
+    with open(manifest_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+# Validate all PDFs in a process pool, skipping files that passed before and did not change
+def find_invalid_pdfs(root_folder, manifest_file=VALIDATION_MANIFEST_FILE, cache_folder=TEXT_CACHE_FOLDER,
+                      workers=None):
+    old_manifest = load_validation_manifest(manifest_file)
+    manifest = {}
+    to_check = []
+
+    for pdf_file in find_all_pdfs(root_folder):
+        key = os.path.normpath(pdf_file).replace("\\", "/")
+        stat = os.stat(pdf_file)
+        entry = old_manifest.get(key)
+        if entry is not None and entry['valid'] and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            manifest[key] = entry
+        else:
+            to_check.append((key, pdf_file))
+
+    # Each worker hashes, parses and caches the page text of a file in one pass
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(validate_pdf, pdf_file, cache_folder): key for key, pdf_file in to_check}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Checking PDFs", unit="file"):
+            manifest[futures[future]] = future.result()
+
+    save_validation_manifest(manifest, manifest_file)
+
+    cached = sum(1 for key, _ in to_check if manifest[key].get('cached'))
+    print(f"Checked {len(manifest)} PDF files: {len(manifest) - len(to_check)} unchanged, "
+          f"{cached} already extracted, {len(to_check) - cached} parsed.")
+    return sorted((key, entry['error']) for key, entry in manifest.items() if not entry['valid'])
+
+# The guard keeps worker processes from re-running the check when they import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that every PDF parses and cache its page text for indexing.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes (defaults to the CPU count)")
+    args = parser.parse_args()
+
+    # Execute the PDF check
+    invalid_files = find_invalid_pdfs(DATABASE_FOLDER, workers=args.workers)
+    if invalid_files:
+        print("The following files are either corrupted or not valid PDF files:")
+        for file, error in invalid_files:
+            print(f"{file} ({error})")
+    else:
+        print("All PDF files are valid.")
@@ -0,0 +1,60 @@
+import time
+import asyncio
+import argparse
+from dotenv import load_dotenv
+
+# Load environment variables (before the functions modules read their settings)
+load_dotenv()
+
+from functions.functions_batch import (
+    BATCH_CONCURRENCY,
+    answer_batch,
+    build_test_cases,
+    load_questions,
+    to_test_case_record,
+    write_jsonl
+)
+from functions.functions_context import create_app_context
+from functions.functions_filters import parse_filters
+from functions.functions_index import INDEX_FOLDER
+
+# Offline evaluation run: answers a file of questions and writes the results and deepeval test cases.
+# With LLM_MODEL=fake and EMBEDDING_MODEL=hash-1536 it runs without OpenAI.
+parser = argparse.ArgumentParser(description="Answer a file of questions and write deepeval test cases.")
+parser.add_argument('questions', help="Questions file (.jsonl, .csv or one question per line)")
+parser.add_argument('--results', default='./eval/results.jsonl', help="Output file for the answers")
+parser.add_argument('--test-cases', default='./eval/test_cases.jsonl', help="Output file for the deepeval test cases")
+parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY, help="Concurrent LLM calls")
+parser.add_argument('--limit', type=int, default=None, help="Only answer the first N questions")
+parser.add_argument('--chapter', type=int, nargs='+', default=None, help="Only search these chapters")
+parser.add_argument('--section', nargs='+', default=None, help="Only search these sections (and their subsections)")
+args = parser.parse_args()
+
+
+async def main():
+    items = load_questions(args.questions)[:args.limit]
+    filters = parse_filters({'chapter': args.chapter, 'section': args.section})
+    app_context = create_app_context(INDEX_FOLDER, './database', './file_titles.csv')
+    retriever = app_context.get_retriever()
+    if retriever is None:
+        raise SystemExit("No index found. Run build_index.py first.")
+
+    start = time.perf_counter()
+    try:
+        results = await answer_batch(items, retriever, app_context.qa_chain, app_context.get_file_titles(),
+                                     concurrency=args.concurrency, filters=filters)
+    finally:
+        await app_context.aclose()
+    elapsed = time.perf_counter() - start
+
+    write_jsonl(results, args.results)
+    test_cases = build_test_cases(results)
+    write_jsonl((to_test_case_record(test_case) for test_case in test_cases), args.test_cases)
+
+    failed = sum(1 for result in results if 'error' in result)
+    print(f"Answered {len(results) - failed} of {len(results)} questions in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.1f} questions/s), {failed} failed.")
+    print(f"Results written to {args.results}, {len(test_cases)} test cases to {args.test_cases}")
+
+
+asyncio.run(main())
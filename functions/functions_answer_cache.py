@@ -0,0 +1,201 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_question(question):
+    """
+    Normalize question text for exact cache matching.
+
+    Args:
+        question (str): The question as typed by the user.
+
+    Returns:
+        str: The lowercased question with collapsed whitespace and no trailing punctuation.
+    """
+    return re.sub(r'\s+', ' ', question).strip().lower().rstrip('?!. ')
+
+
+class AnswerCache:
+    """
+    Two-tier cache of answers for repeated and near-duplicate questions.
+
+    The exact tier matches on normalized question text and needs no embedding.
+    The semantic tier embeds the question and returns the cached answer of the
+    most similar question if their cosine similarity is at least threshold.
+    Entries are tagged with the index version they were answered from and are
+    ignored once the index changes. Answers retrieved under search filters are
+    cached under a scope and only match questions asked with the same filters.
+    Entries expire after ttl seconds, and the least recently used entry is
+    evicted once max_items is reached.
+    """
+
+    def __init__(self, embed_query=None, threshold=0.95, ttl=24 * 3600, max_items=1000, aembed_query=None):
+        self.embed_query = embed_query
+        self.aembed_query = aembed_query
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+
+    def _normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _embed(self, question):
+        return self._normalize(self.embed_query(question)) if self.embed_query is not None else None
+
+    async def _aembed(self, question):
+        if self.aembed_query is not None:
+            return self._normalize(await self.aembed_query(question))
+        return self._embed(question)
+
+    def _is_valid(self, entry, index_version, now, scope=None):
+        return (entry['index_version'] == index_version and entry['scope'] == scope
+                and now - entry['created'] <= self.ttl)
+
+    def _key(self, question, scope):
+        return normalize_question(question) if scope is None else (scope, normalize_question(question))
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._matrix = None
+
+    def _semantic_matrix(self):
+        # Stack the cached question embeddings once per change instead of per lookup
+        if self._matrix is None:
+            self._matrix_keys = [key for key, entry in self._entries.items() if entry['embedding'] is not None]
+            if self._matrix_keys:
+                self._matrix = np.stack([self._entries[key]['embedding'] for key in self._matrix_keys])
+        return self._matrix
+
+    def _get_exact(self, key, index_version, now, scope=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_valid(entry, index_version, now, scope):
+                    self._entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return entry['result'], 'exact'
+                self._remove(key)
+        return None, None
+
+    def _get_semantic(self, vector, index_version, now, scope=None):
+        with self._lock:
+            matrix = self._semantic_matrix() if vector is not None else None
+            if matrix is not None:
+                similarities = matrix @ vector
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    match_key = self._matrix_keys[position]
+                    match = self._entries.get(match_key)
+                    if match is not None and self._is_valid(match, index_version, now, scope):
+                        self._entries.move_to_end(match_key)
+                        self.semantic_hits += 1
+                        return match['result'], 'semantic'
+            self.misses += 1
+        return None, None
+
+    def get(self, question, index_version=None, scope=None):
+        """
+        Look up a cached answer for a question.
+
+        Args:
+            question (str): The question.
+            index_version (str): The version of the index currently being served.
+            scope (str): The search filters of the question (see filter_key), or None.
+
+        Returns:
+            tuple: The cached result and the tier that matched ('exact' or 'semantic'),
+                or (None, None) on a miss.
+        """
+        now = time.time()
+        result, tier = self._get_exact(self._key(question, scope), index_version, now, scope)
+        if result is not None:
+            return result, tier
+        return self._get_semantic(self._embed(question), index_version, now, scope)
+
+    async def aget(self, question, index_version=None, scope=None):
+        """
+        Asynchronous version of get, which awaits the question embedding.
+        """
+        now = time.time()
+        result, tier = self._get_exact(self._key(question, scope), index_version, now, scope)
+        if result is not None:
+            return result, tier
+        return self._get_semantic(await self._aembed(question), index_version, now, scope)
+
+    def _put(self, key, result, index_version, vector, scope=None):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                'result': result,
+                'embedding': vector,
+                'index_version': index_version,
+                'scope': scope,
+                'created': time.time(),
+            }
+            self._matrix = None
+
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, question, result, index_version=None, scope=None):
+        """
+        Cache the result of answering a question.
+
+        Args:
+            question (str): The question.
+            result (dict): The answer payload to return on later hits.
+            index_version (str): The version of the index the answer was retrieved from.
+            scope (str): The search filters the answer was retrieved with, or None.
+        """
+        self._put(self._key(question, scope), result, index_version, self._embed(question), scope)
+
+    async def aput(self, question, result, index_version=None, scope=None):
+        """
+        Asynchronous version of put, which awaits the question embedding.
+        """
+        self._put(self._key(question, scope), result, index_version, await self._aembed(question), scope)
+
+    def invalidate(self):
+        """
+        Drop every cached answer, e.g. after the index was rebuilt.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        """
+        Return the cache counters.
+
+        Returns:
+            dict: Hits per tier, misses, hit rate, evictions and the number of cached answers.
+        """
+        with self._lock:
+            total = self.exact_hits + self.semantic_hits + self.misses
+            return {
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'hit_rate': (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
@@ -0,0 +1,402 @@
+import time
+
+from functions.functions_batch import answer_batch, parse_batch_request
+from functions.functions_context_assembly import assemble_context
+from functions.functions_filters import filter_key, parse_filters
+from functions.functions_metrics import (
+    METRICS_ENABLED,
+    observe_context,
+    observe_prompt,
+    observe_stage,
+    observe_timings,
+    render_metrics,
+    span
+)
+from functions.functions_rag import (
+    aanswer_question_from_context,
+    answer_question_from_context,
+    astream_answer_question_from_context,
+    stream_answer_question_from_context
+)
+from functions.functions_utils import format_sse, get_references
+
+# Content type of the /metrics response (Prometheus text format)
+METRICS_MIMETYPE = 'text/plain; version=0.0.4'
+
+# Headers of streamed answers, which disable caching and proxy buffering so events reach the browser immediately
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+class RequestError(Exception):
+    """
+    A request that cannot be answered, returned to the client as {'error': message} with the status.
+
+    app.py and app_async.py register an error handler for it, so the request
+    handling below does not depend on the web framework.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_question_request(data):
+    """
+    Validate the JSON body of an /ask or /ask/stream request.
+
+    Args:
+        data (dict): The request body, with a 'question' and optional 'filters'
+            restricting the search to chapters or sections, e.g. {"chapter": 5, "section": "5_2"}.
+
+    Returns:
+        tuple: The question and the filters returned by parse_filters.
+
+    Raises:
+        RequestError: If the body is not an object, the question is missing or the filters are invalid.
+    """
+    if not isinstance(data, dict):
+        raise RequestError('The request body must be a JSON object')
+    question = data.get('question')
+    if not question:
+        raise RequestError('Missing question')
+    try:
+        return question, parse_filters(data.get('filters'))
+    except ValueError as e:
+        raise RequestError(str(e))
+
+
+def parse_batch(data):
+    """
+    Validate the JSON body of an /ask/batch request.
+
+    Returns:
+        tuple: The questions returned by parse_batch_request and the filters returned by parse_filters.
+
+    Raises:
+        RequestError: If the body is malformed.
+    """
+    try:
+        return parse_batch_request(data), parse_filters(data.get('filters'))
+    except ValueError as e:
+        raise RequestError(str(e))
+
+
+def get_retriever(app_context, filters=None):
+    """
+    Return the retriever of the application context.
+
+    A question whose filters match no chunk is refused here, so the LLM is not
+    asked to answer from an empty context and no such answer is cached.
+
+    Args:
+        app_context (AppContext): The application context.
+        filters (dict): The filters returned by parse_filters.
+
+    Raises:
+        RequestError: If there are no PDFs to search or no chunk matches the filters.
+    """
+    retriever = app_context.get_retriever()
+    if retriever is None:
+        raise RequestError('No files uploaded')
+    if filters and retriever.count_matching(filters) == 0:
+        raise RequestError('No documents match these filters', 404)
+    return retriever
+
+
+def _prepare_context(context_docs, timings, file_titles):
+    # The references and assembled context of the retrieved chunks, as sent to the client
+    observe_timings(timings, 'retrieval')
+    references = get_references(context_docs, file_titles)
+    with span('assemble_context'):
+        context_text, context_stats = assemble_context(context_docs)
+    observe_context(context_stats)
+    return {'context': context_text, 'references': references, 'timings': timings, 'context_tokens': context_stats}
+
+
+def retrieve_context(app_context, retriever, question, filters):
+    """
+    Retrieve the chunks relevant to a question and assemble the LLM context.
+
+    Args:
+        app_context (AppContext): The application context.
+        retriever (HybridRetriever): The retriever.
+        question (str): The question.
+        filters (dict): The filters returned by parse_filters.
+
+    Returns:
+        dict: The 'context' text, 'references', retrieval 'timings' and 'context_tokens'.
+    """
+    file_titles = app_context.get_file_titles()
+    context_docs, timings = retriever.retrieve_with_timings(question, filters=filters)
+    return _prepare_context(context_docs, timings, file_titles)
+
+
+async def aretrieve_context(app_context, retriever, question, filters):
+    """
+    Asynchronous version of retrieve_context.
+    """
+    file_titles = app_context.get_file_titles()
+    context_docs, timings = await retriever.aretrieve_with_timings(question, filters=filters)
+    return _prepare_context(context_docs, timings, file_titles)
+
+
+def _cached_response(cached_result, cache_tier):
+    return None if cached_result is None else dict(cached_result, cached=cache_tier)
+
+
+def get_cached_answer(app_context, question, filters, index_version):
+    """
+    Return a cached answer to the question (marked with its cache tier), or None.
+    """
+    with span('answer_cache'):
+        return _cached_response(*app_context.answer_cache.get(question, index_version, filter_key(filters)))
+
+
+async def aget_cached_answer(app_context, question, filters, index_version):
+    """
+    Asynchronous version of get_cached_answer.
+    """
+    with span('answer_cache'):
+        return _cached_response(*await app_context.answer_cache.aget(question, index_version, filter_key(filters)))
+
+
+def ask(app_context, data):
+    """
+    Answer an /ask request: from the answer cache, or by retrieval and the LLM.
+
+    Args:
+        app_context (AppContext): The application context.
+        data (dict): The request body.
+
+    Returns:
+        dict: The 'answer', 'context', 'references', 'timings' and 'context_tokens',
+            and 'cached' (the cache tier) for a cached answer.
+
+    Raises:
+        RequestError: If the request is invalid, there are no PDFs to search or no chunk matches the filters.
+    """
+    question, filters = parse_question_request(data)
+    retriever = get_retriever(app_context, filters)
+    index_version = app_context.index_version
+    cached = get_cached_answer(app_context, question, filters, index_version)
+    if cached is not None:
+        return cached
+
+    prepared = retrieve_context(app_context, retriever, question, filters)
+    result = answer_question_from_context(question, prepared['context'], app_context.qa_chain)
+    observe_prompt(question, prepared['context'], result['answer'])
+    response = dict(prepared, answer=result['answer'])
+    app_context.answer_cache.put(question, response, index_version, filter_key(filters))
+    return response
+
+
+async def aask(app_context, data):
+    """
+    Asynchronous version of ask. The LLM call is retried with exponential backoff on rate limits.
+    """
+    question, filters = parse_question_request(data)
+    retriever = get_retriever(app_context, filters)
+    index_version = app_context.index_version
+    cached = await aget_cached_answer(app_context, question, filters, index_version)
+    if cached is not None:
+        return cached
+
+    prepared = await aretrieve_context(app_context, retriever, question, filters)
+    result = await aanswer_question_from_context(question, prepared['context'], app_context.qa_chain)
+    observe_prompt(question, prepared['context'], result['answer'])
+    response = dict(prepared, answer=result['answer'])
+    await app_context.answer_cache.aput(question, response, index_version, filter_key(filters))
+    return response
+
+
+def _cached_events(cached):
+    # A cached answer is sent as a single token event
+    yield format_sse('context', {'context': cached['context'], 'references': cached['references'],
+                                 'timings': cached['timings'], 'cached': cached['cached']})
+    yield format_sse('token', {'token': cached['answer']})
+    yield format_sse('done', {})
+
+
+def _finish_stream(question, prepared, tokens, start):
+    # Record a completely streamed answer and return the response to cache
+    observe_stage('llm_stream', time.perf_counter() - start)
+    observe_prompt(question, prepared['context'], "".join(tokens))
+    return dict(prepared, answer="".join(tokens))
+
+
+def ask_stream(app_context, data):
+    """
+    Answer an /ask/stream request with server-sent events.
+
+    The request is validated, and the answer looked up in the cache or the context
+    retrieved, before this returns, so errors are raised before the response
+    starts and the first event is sent right after retrieval. The events are a
+    'context' event, one 'token' event per piece of the answer, then 'done' (or
+    'error' if the LLM fails). Only complete answers are cached.
+
+    Args:
+        app_context (AppContext): The application context.
+        data (dict): The request body.
+
+    Returns:
+        generator: The server-sent events, as strings.
+
+    Raises:
+        RequestError: If the request is invalid, there are no PDFs to search or no chunk matches the filters.
+    """
+    question, filters = parse_question_request(data)
+    retriever = get_retriever(app_context, filters)
+    index_version = app_context.index_version
+    cached = get_cached_answer(app_context, question, filters, index_version)
+    if cached is not None:
+        return _cached_events(cached)
+
+    prepared = retrieve_context(app_context, retriever, question, filters)
+
+    def generate():
+        yield format_sse('context', prepared)
+        tokens = []
+        start = time.perf_counter()
+        try:
+            for token in stream_answer_question_from_context(question, prepared['context'], app_context.qa_chain):
+                if not tokens:
+                    observe_stage('llm_first_token', time.perf_counter() - start)
+                tokens.append(token)
+                yield format_sse('token', {'token': token})
+        except Exception as e:
+            yield format_sse('error', {'error': str(e)})
+            return
+        response = _finish_stream(question, prepared, tokens, start)
+        app_context.answer_cache.put(question, response, index_version, filter_key(filters))
+        yield format_sse('done', {})
+
+    return generate()
+
+
+async def aask_stream(app_context, data):
+    """
+    Asynchronous version of ask_stream.
+
+    Returns:
+        async generator: The server-sent events, as strings.
+    """
+    question, filters = parse_question_request(data)
+    retriever = get_retriever(app_context, filters)
+    index_version = app_context.index_version
+    cached = await aget_cached_answer(app_context, question, filters, index_version)
+    if cached is not None:
+        async def generate_cached():
+            for event in _cached_events(cached):
+                yield event
+        return generate_cached()
+
+    prepared = await aretrieve_context(app_context, retriever, question, filters)
+
+    async def generate():
+        yield format_sse('context', prepared)
+        tokens = []
+        start = time.perf_counter()
+        try:
+            async for token in astream_answer_question_from_context(question, prepared['context'],
+                                                                    app_context.qa_chain):
+                if not tokens:
+                    observe_stage('llm_first_token', time.perf_counter() - start)
+                tokens.append(token)
+                yield format_sse('token', {'token': token})
+        except Exception as e:
+            yield format_sse('error', {'error': str(e)})
+            return
+        response = _finish_stream(question, prepared, tokens, start)
+        await app_context.answer_cache.aput(question, response, index_version, filter_key(filters))
+        yield format_sse('done', {})
+
+    return generate()
+
+
+async def aask_batch(app_context, data):
+    """
+    Answer an /ask/batch request: one vectorized retrieval pass, then concurrent answers.
+
+    Args:
+        app_context (AppContext): The application context.
+        data (dict): The request body.
+
+    Returns:
+        dict: The 'results' returned by answer_batch.
+
+    Raises:
+        RequestError: If the request is invalid, there are no PDFs to search or no chunk matches the filters.
+    """
+    items, filters = parse_batch(data)
+    retriever = get_retriever(app_context, filters)
+    results = await answer_batch(items, retriever, app_context.qa_chain, app_context.get_file_titles(),
+                                 filters=filters)
+    return {'results': results}
+
+
+def metrics_text():
+    """
+    Return the metrics in the Prometheus text format.
+
+    Raises:
+        RequestError: If metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        raise RequestError('Metrics are disabled, set METRICS_ENABLED=1', 404)
+    return render_metrics()
+
+
+def _int_arg(args, name, default, low, high):
+    # A query string number clamped to [low, high], the default if missing or invalid
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    return min(max(value, low), high)
+
+
+def _require_keyword_index(keyword_index):
+    if keyword_index is None:
+        raise RequestError('No keyword index, run build_index.py', 404)
+    return keyword_index
+
+
+def document_keywords(keyword_index, args):
+    """
+    Answer a /keywords request: the top keywords of one document (?document=<file path>) or of the corpus.
+
+    Args:
+        keyword_index (KeywordIndex): The keyword index, or None if none has been built.
+        args (dict): The query string arguments.
+
+    Returns:
+        dict: The 'document' and its 'keywords' (term and score).
+
+    Raises:
+        RequestError: If there is no keyword index or the document is unknown.
+    """
+    keyword_index = _require_keyword_index(keyword_index)
+    document = args.get('document')
+    terms = keyword_index.keywords(document, _int_arg(args, 'n', 10, 1, keyword_index.top_n))
+    if terms is None:
+        raise RequestError('Unknown document', 404)
+    return {'document': document, 'keywords': [{'term': term, 'score': score} for term, score in terms]}
+
+
+def keyword_suggestions(keyword_index, args):
+    """
+    Answer a /keywords/autocomplete request: completions of a partially typed query (?q=reactor co).
+
+    Args:
+        keyword_index (KeywordIndex): The keyword index, or None if none has been built.
+        args (dict): The query string arguments.
+
+    Returns:
+        dict: The 'query' and its 'suggestions'.
+
+    Raises:
+        RequestError: If there is no keyword index.
+    """
+    keyword_index = _require_keyword_index(keyword_index)
+    query = args.get('q', '')
+    return {'query': query, 'suggestions': keyword_index.suggest(query, _int_arg(args, 'n', 8, 1, 50))}
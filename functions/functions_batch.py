@@ -0,0 +1,183 @@
+import os
+import csv
+import json
+import time
+import asyncio
+
+from functions.functions_context_assembly import assemble_context
+from functions.functions_metrics import in_request_context, observe_context, observe_timings
+from functions.functions_rag import aanswer_question_from_context, create_deep_eval_test_cases
+from functions.functions_utils import get_references
+
+# Questions answered by the LLM at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+
+# Questions retrieved per vectorized pass (bounds the BM25 score matrix)
+RETRIEVAL_BATCH_SIZE = 64
+
+# Maximum number of questions accepted by one /ask/batch request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 500))
+
+
+def load_questions(questions_file):
+    """
+    Load questions, and optionally their ground-truth answers, from a file.
+
+    Supported formats are JSON lines ({"question": ..., "ground_truth": ...} per line),
+    CSV with a 'question' column and an optional 'ground_truth' column, and plain
+    text with one question per line.
+
+    Args:
+        questions_file (str): The file to read.
+
+    Returns:
+        list: One dict per question with 'question' and 'ground_truth' (None if not given).
+    """
+    with open(questions_file, mode='r', newline='', encoding='utf-8') as f:
+        if questions_file.endswith('.jsonl'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        elif questions_file.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [{'question': line.strip()} for line in f if line.strip()]
+
+    return [{'question': row['question'], 'ground_truth': row.get('ground_truth') or row.get('expected_output')}
+            for row in rows]
+
+
+def parse_batch_request(data, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Validate the JSON body of an /ask/batch request.
+
+    The body holds 'questions', a list of question strings or of objects with a
+    'question' and an optional 'ground_truth'.
+
+    Args:
+        data (dict): The request body.
+        max_batch_size (int): The maximum number of questions.
+
+    Returns:
+        list: One dict per question with 'question' and 'ground_truth'.
+
+    Raises:
+        ValueError: If the body is malformed, a question is missing or there are too many questions.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("The request body must be a JSON object")
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions:
+        raise ValueError("Missing questions")
+    if len(questions) > max_batch_size:
+        raise ValueError(f"At most {max_batch_size} questions per batch")
+
+    items = []
+    for question in questions:
+        item = {'question': question} if isinstance(question, str) else question
+        if not isinstance(item, dict) or not item.get('question'):
+            raise ValueError("Missing question")
+        items.append({'question': item['question'], 'ground_truth': item.get('ground_truth')})
+    return items
+
+
+def to_test_case_record(test_case):
+    """
+    Convert a deepeval LLMTestCase into a JSON-serializable dict.
+    """
+    return {
+        'input': test_case.input,
+        'expected_output': test_case.expected_output,
+        'actual_output': test_case.actual_output,
+        'retrieval_context': test_case.retrieval_context,
+    }
+
+
+async def answer_batch(items, retriever, qa_chain, file_titles=None, concurrency=BATCH_CONCURRENCY,
+                       max_retries=5, retrieval_batch_size=RETRIEVAL_BATCH_SIZE, filters=None):
+    """
+    Answer many questions: batched retrieval, then concurrent generation with bounded parallelism.
+
+    Retrieval runs one vectorized FAISS and BM25 pass per retrieval_batch_size
+    questions in a worker thread. At most concurrency LLM calls are in flight at a
+    time, each retried with exponential backoff on rate limits. A question that
+    fails is reported with its error instead of failing the batch.
+
+    Args:
+        items (list): Dicts with a 'question' and an optional 'ground_truth'.
+        retriever (HybridRetriever): The retriever.
+        qa_chain: The question answering chain.
+        file_titles (dict): Maps file paths to titles, for the references.
+        concurrency (int): The maximum number of concurrent LLM calls.
+        max_retries (int): The maximum number of attempts per question on rate limits.
+        retrieval_batch_size (int): The number of questions retrieved per pass.
+        filters (dict): Optional filters returned by parse_filters, restricting every search.
+
+    Returns:
+        list: One result dict per question, in input order, with the question, ground truth,
+            answer, retrieved chunks, references, context token counts and latency (or an 'error').
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(item, context_docs):
+        result = {
+            'question': item['question'],
+            'ground_truth': item.get('ground_truth'),
+            'retrieved_documents': [doc.page_content for doc in context_docs],
+            'references': get_references(context_docs, file_titles or {}),
+        }
+        context_text, result['context_tokens'] = assemble_context(context_docs)
+        observe_context(result['context_tokens'])
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                output = await aanswer_question_from_context(item['question'], context_text, qa_chain, max_retries)
+                result['answer'] = output['answer']
+            except Exception as e:
+                result['error'] = f"{type(e).__name__}: {e}"
+            result['latency'] = time.perf_counter() - start
+        return result
+
+    tasks = []
+    for batch_start in range(0, len(items), retrieval_batch_size):
+        batch = items[batch_start:batch_start + retrieval_batch_size]
+        batch_docs, timings = await loop.run_in_executor(None, in_request_context(
+            retriever.retrieve_batch, [item['question'] for item in batch], None, filters))
+        observe_timings(timings, 'batch_retrieval')
+        # Generation of this batch starts while the next batch is retrieved
+        tasks.extend(asyncio.ensure_future(answer(item, context_docs)) for item, context_docs in zip(batch, batch_docs))
+    return await asyncio.gather(*tasks)
+
+
+def build_test_cases(results):
+    """
+    Build deepeval test cases from answered questions that have a ground truth.
+
+    Args:
+        results (list): Result dicts returned by answer_batch.
+
+    Returns:
+        list: The LLMTestCase objects.
+    """
+    answered = [result for result in results if 'answer' in result and result.get('ground_truth') is not None]
+    return create_deep_eval_test_cases(
+        [result['question'] for result in answered],
+        [result['ground_truth'] for result in answered],
+        [result['answer'] for result in answered],
+        [result['retrieved_documents'] for result in answered]
+    )
+
+
+def write_jsonl(records, output_file):
+    """
+    Write records to a JSON lines file, one record per line.
+
+    Args:
+        records (iterable): JSON-serializable dicts.
+        output_file (str): The file to write.
+    """
+    folder = os.path.dirname(output_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(output_file, mode='w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,235 @@
+import json
+from typing import List
+
+import numpy as np
+from scipy import sparse
+
+
+def tokenize(text):
+    """
+    Tokenize text the same way bm25_retrieval tokenizes queries.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        List[str]: The whitespace-separated tokens.
+    """
+    return text.split()
+
+
+def top_k_indices(scores, k):
+    """
+    Return the indices of the k highest scores, best first, without sorting every score.
+
+    Args:
+        scores (np.ndarray): A 1-D array of scores.
+        k (int): The number of indices to return.
+
+    Returns:
+        np.ndarray: The indices of the top k scores in descending score order.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class BM25Index:
+    """
+    Okapi BM25 index over a sparse term-document matrix.
+
+    Scores match rank_bm25.BM25Okapi with the same k1, b and epsilon, but the
+    per-term weights idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+    are precomputed into a CSR matrix with one row of postings per term. Scoring
+    a batch of queries is then a single sparse matrix product.
+
+    Attributes:
+        vocabulary (dict): Maps each term to its row in the weight matrix.
+        weights (sparse.csr_matrix): Term-by-document BM25 weights.
+        doc_ids (list): Optional ids of the indexed documents (e.g. docstore ids).
+    """
+
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocabulary = {}
+        self.weights = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self.doc_ids = []
+
+    @property
+    def corpus_size(self):
+        return self.weights.shape[1]
+
+    def fit(self, texts: List[str], doc_ids=None):
+        """
+        Build the index from a list of texts.
+
+        Args:
+            texts (List[str]): The documents to index.
+            doc_ids (list): Optional ids to return alongside the document positions.
+
+        Returns:
+            BM25Index: The fitted index.
+        """
+        rows, cols = [], []
+        doc_len = np.zeros(len(texts), dtype=np.float64)
+        for doc_index, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc_index] = len(tokens)
+            for token in tokens:
+                rows.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                cols.append(doc_index)
+
+        # Duplicate (term, doc) entries are summed into term frequencies
+        term_freqs = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(len(self.vocabulary), len(texts))
+        )
+        term_freqs.sum_duplicates()
+
+        corpus_size = len(texts)
+        doc_freqs = np.diff(term_freqs.indptr)
+        idf = np.log(corpus_size - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        if len(idf):
+            idf[idf < 0] = self.epsilon * idf.mean()
+
+        avgdl = doc_len.mean() if corpus_size else 0.0
+        length_norm = self.k1 * (1 - self.b + self.b * doc_len / avgdl) if avgdl else np.full(corpus_size, self.k1)
+
+        tf = term_freqs.data
+        term_of_entry = np.repeat(np.arange(len(self.vocabulary)), doc_freqs)
+        term_freqs.data = idf[term_of_entry] * tf * (self.k1 + 1) / (tf + length_norm[term_freqs.indices])
+
+        self.weights = term_freqs.astype(np.float32)
+        self.doc_ids = list(doc_ids) if doc_ids is not None else list(range(corpus_size))
+        return self
+
+    def _query_matrix(self, queries):
+        rows, cols = [], []
+        for query_index, query in enumerate(queries):
+            for token in tokenize(query):
+                term = self.vocabulary.get(token)
+                if term is not None:
+                    rows.append(query_index)
+                    cols.append(term)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(queries), len(self.vocabulary))
+        )
+
+    def get_batch_scores(self, queries: List[str]):
+        """
+        Score every document against many queries at once.
+
+        Args:
+            queries (List[str]): The query strings.
+
+        Returns:
+            np.ndarray: A (number of queries, number of documents) array of BM25 scores.
+        """
+        return (self._query_matrix(queries) @ self.weights).toarray()
+
+    def get_scores(self, query: str):
+        """
+        Score every document against a single query.
+
+        Args:
+            query (str): The query string.
+
+        Returns:
+            np.ndarray: The BM25 score of each document.
+        """
+        return self.get_batch_scores([query])[0]
+
+    def search_batch(self, queries: List[str], k=5):
+        """
+        Return the top k documents for each of many queries.
+
+        Args:
+            queries (List[str]): The query strings.
+            k (int): The number of documents to return per query.
+
+        Returns:
+            list: For each query, a list of (document position, score) tuples, best first.
+        """
+        results = []
+        for scores in self.get_batch_scores(queries):
+            indices = top_k_indices(scores, k)
+            results.append([(int(i), float(scores[i])) for i in indices])
+        return results
+
+    def search(self, query: str, k=5):
+        """
+        Return the top k documents for a single query.
+
+        Args:
+            query (str): The query string.
+            k (int): The number of documents to return.
+
+        Returns:
+            list: A list of (document position, score) tuples, best first.
+        """
+        return self.search_batch([query], k)[0]
+
+    def subset(self, columns):
+        """
+        Return an index over some of the documents, sharing this index's vocabulary and weights.
+
+        Scores are unchanged (the weights were computed over the whole corpus), but a
+        search only scans the postings of the selected documents.
+
+        Args:
+            columns (np.ndarray): The positions of the documents to keep.
+
+        Returns:
+            BM25Index: The index over the selected documents.
+        """
+        index = BM25Index(self.k1, self.b, self.epsilon)
+        index.vocabulary = self.vocabulary
+        index.weights = self.weights[:, columns].tocsr()
+        index.doc_ids = [self.doc_ids[column] for column in columns]
+        return index
+
+    def save(self, path):
+        """
+        Save the index to a single .npz file.
+
+        Args:
+            path (str): The file to write.
+        """
+        terms = [None] * len(self.vocabulary)
+        for term, row in self.vocabulary.items():
+            terms[row] = term
+        params = {'k1': self.k1, 'b': self.b, 'epsilon': self.epsilon}
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                data=self.weights.data,
+                indices=self.weights.indices,
+                indptr=self.weights.indptr,
+                shape=np.array(self.weights.shape),
+                terms=np.array(json.dumps(terms)),
+                doc_ids=np.array(json.dumps(self.doc_ids)),
+                params=np.array(json.dumps(params)),
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save().
+
+        Args:
+            path (str): The .npz file to read.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        with np.load(path) as data:
+            index = cls(**json.loads(str(data['params'])))
+            index.weights = sparse.csr_matrix(
+                (data['data'], data['indices'], data['indptr']), shape=tuple(data['shape'])
+            )
+            index.vocabulary = {term: row for row, term in enumerate(json.loads(str(data['terms'])))}
+            index.doc_ids = json.loads(str(data['doc_ids']))
+        return index
@@ -0,0 +1,256 @@
+import os
+import time
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+from functions.functions_metrics import observe_batch
+
+# Seconds a question waits for the questions of concurrent requests before its batch is sent (0 turns
+# coalescing off), and the largest batch, which is sent as soon as it is full
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0.0))
+COALESCE_MAX_BATCH = int(os.getenv("COALESCE_MAX_BATCH", 32))
+
+
+class _Query:
+    # A question waiting in a batch. Without k it is only embedded.
+    __slots__ = ('question', 'k', 'params', 'index', 'future', 'submitted')
+
+    def __init__(self, question, k, params, index, future):
+        self.question = question
+        self.k = k
+        self.params = params
+        self.index = index
+        self.future = future
+        self.submitted = time.perf_counter()
+
+
+class QueryCoalescer:
+    """
+    Coalesces the question embeddings and vector searches of concurrent requests.
+
+    A question is held for at most window seconds (or until max_batch questions
+    are waiting). The batch is then embedded in one call and searched with one
+    index.search over the query matrix per search scope, and every request gets
+    its own row of the results back. Under concurrent load this replaces one
+    embedding round trip and one single-vector search per request with one per
+    batch, at the cost of up to window seconds of added latency.
+
+    Threaded servers call embed and search: a worker thread collects the
+    batches (it exits when no question is waiting) and runs them in the
+    executor. Asynchronous servers call aembed and asearch, which batch the
+    questions of one event loop.
+    """
+
+    def __init__(self, embed_documents, aembed_documents, search_vectors, executor,
+                 window=COALESCE_WINDOW, max_batch=COALESCE_MAX_BATCH):
+        """
+        Args:
+            embed_documents: Embeds a list of texts, e.g. CachedEmbeddings.embed_queries.
+            aembed_documents: Asynchronous version of embed_documents.
+            search_vectors: Searches the index with (embeddings, k, params, index) and returns
+                the hits of each embedding, like vector_search_by_vectors.
+            executor (ThreadPoolExecutor): Runs the batches.
+            window (float): Seconds the first question of a batch waits for more.
+            max_batch (int): The largest number of questions per batch.
+        """
+        self.embed_documents = embed_documents
+        self.aembed_documents = aembed_documents
+        self.search_vectors = search_vectors
+        self.executor = executor
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+
+        self._pending = []
+        self._condition = threading.Condition()
+        self._worker = None
+
+        self._apending = []
+        self._aloop = None
+        self._atimer = None
+
+    def _embed_batch(self, batch):
+        # Embed each distinct question of the batch once
+        observe_batch(len(batch))
+        start = time.perf_counter()
+        questions = list(dict.fromkeys(query.question for query in batch))
+        vectors = dict(zip(questions, self.embed_documents(questions)))
+        embedding_time = time.perf_counter() - start
+        return vectors, embedding_time
+
+    def _search_batch(self, batch, vectors):
+        # Search once per scope (the same partition), with the largest k of the scope
+        start = time.perf_counter()
+        scopes = {}
+        for query in batch:
+            if query.k is not None:
+                scopes.setdefault((id(query.params), id(query.index)), []).append(query)
+
+        hits = {}
+        for queries in scopes.values():
+            k = max(query.k for query in queries)
+            results = self.search_vectors([vectors[query.question] for query in queries], k,
+                                          queries[0].params, queries[0].index)
+            for query, query_hits in zip(queries, results):
+                hits[id(query)] = query_hits[:query.k]
+        return hits, time.perf_counter() - start
+
+    def _resolve(self, batch, vectors, embedding_time, hits, vector_time):
+        # The result of each query: its embedding or its hits, with the batch's timings
+        results = []
+        for query in batch:
+            if query.k is None:
+                results.append(vectors[query.question])
+            else:
+                results.append((hits[id(query)], {'embedding': embedding_time, 'vector': vector_time}))
+        return results
+
+    def _execute(self, batch):
+        try:
+            vectors, embedding_time = self._embed_batch(batch)
+            hits, vector_time = self._search_batch(batch, vectors)
+            results = self._resolve(batch, vectors, embedding_time, hits, vector_time)
+        except Exception as e:
+            for query in batch:
+                query.future.set_exception(e)
+            return
+        for query, result in zip(batch, results):
+            query.future.set_result(result)
+
+    def _collect(self):
+        # Worker thread: wait for each batch to fill or for its window to pass, then hand it to the executor
+        while True:
+            with self._condition:
+                if not self._pending:
+                    self._worker = None
+                    return
+                deadline = self._pending[0].submitted + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self.executor.submit(self._execute, batch)
+
+    def _submit(self, question, k=None, params=None, index=None):
+        query = _Query(question, k, params, index, Future())
+        with self._condition:
+            self._pending.append(query)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._collect, daemon=True)
+                self._worker.start()
+            elif len(self._pending) >= self.max_batch:
+                self._condition.notify()
+        return query
+
+    def embed(self, question):
+        """
+        Embed a question together with the questions of concurrent requests.
+
+        Args:
+            question (str): The question.
+
+        Returns:
+            list: The question embedding.
+        """
+        return self._submit(question).future.result()
+
+    def search(self, question, k, params=None, index=None):
+        """
+        Embed a question and search the index with it, together with the questions of concurrent requests.
+
+        Args:
+            question (str): The question.
+            k (int): The number of hits to return.
+            params (faiss.SearchParameters): Optional search parameters, e.g. restricting the search to a partition.
+            index (faiss.Index): The index to search in place of the store's index, with the same positions.
+
+        Returns:
+            tuple: A list of (docstore id, score) tuples, best first, and a dict of timings in seconds
+                ('coalesce' waiting for the batch, and the batch's 'embedding' and 'vector').
+        """
+        query = self._submit(question, k, params, index)
+        hits, timings = query.future.result()
+        return hits, self._with_wait(query, timings)
+
+    def _with_wait(self, query, timings):
+        waited = time.perf_counter() - query.submitted - timings['embedding'] - timings['vector']
+        return dict(timings, coalesce=max(waited, 0.0))
+
+    def _aflush(self):
+        if self._atimer is not None:
+            self._atimer.cancel()
+            self._atimer = None
+        batch = self._apending[:self.max_batch]
+        del self._apending[:self.max_batch]
+        # The batch serves several requests, so it runs outside the context of the one that flushed it;
+        # each query gets the batch's timings back with its result
+        contextvars.Context().run(self._aloop.create_task, self._aexecute(batch))
+        if self._apending:
+            # Questions beyond a full batch start the next window
+            self._atimer = self._aloop.call_later(self.window, self._aflush)
+
+    async def _aexecute(self, batch):
+        try:
+            observe_batch(len(batch))
+            start = time.perf_counter()
+            questions = list(dict.fromkeys(query.question for query in batch))
+            vectors = dict(zip(questions, await self.aembed_documents(questions)))
+            embedding_time = time.perf_counter() - start
+            # The CPU-bound search runs in the executor, so the event loop keeps serving
+            hits, vector_time = await self._aloop.run_in_executor(self.executor, self._search_batch, batch, vectors)
+            results = self._resolve(batch, vectors, embedding_time, hits, vector_time)
+        except Exception as e:
+            for query in batch:
+                if not query.future.done():
+                    query.future.set_exception(e)
+            return
+        for query, result in zip(batch, results):
+            if not query.future.done():
+                query.future.set_result(result)
+
+    def _asubmit(self, question, k=None, params=None, index=None):
+        loop = asyncio.get_running_loop()
+        if loop is not self._aloop:
+            # Questions of a previous event loop can no longer be answered
+            self._aloop, self._apending, self._atimer = loop, [], None
+        query = _Query(question, k, params, index, loop.create_future())
+        self._apending.append(query)
+        if len(self._apending) >= self.max_batch:
+            self._aflush()
+        elif self._atimer is None:
+            self._atimer = loop.call_later(self.window, self._aflush)
+        return query
+
+    async def aembed(self, question):
+        """
+        Asynchronous version of embed.
+
+        Args:
+            question (str): The question.
+
+        Returns:
+            list: The question embedding.
+        """
+        return await self._asubmit(question).future
+
+    async def asearch(self, question, k, params=None, index=None):
+        """
+        Asynchronous version of search.
+
+        Args:
+            question (str): The question.
+            k (int): The number of hits to return.
+            params (faiss.SearchParameters): Optional search parameters, e.g. restricting the search to a partition.
+            index (faiss.Index): The index to search in place of the store's index, with the same positions.
+
+        Returns:
+            tuple: A list of (docstore id, score) tuples, best first, and a dict of timings in seconds
+                ('coalesce', 'embedding' and 'vector').
+        """
+        query = self._asubmit(question, k, params, index)
+        hits, timings = await query.future
+        return hits, self._with_wait(query, timings)
@@ -0,0 +1,374 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from functions.functions_answer_cache import AnswerCache
+from functions.functions_coalescer import COALESCE_MAX_BATCH, COALESCE_WINDOW
+from functions.functions_rag import create_llm, create_question_answer_from_context_chain
+from functions.functions_utils import find_all_pdfs, load_file_titles
+from functions.functions_index import (
+    EMBEDDING_MODEL,
+    KEYWORDS_FILE,
+    build_index,
+    build_bm25_index,
+    create_embeddings,
+    get_index_version,
+    index_exists,
+    load_index,
+    load_bm25_index,
+    load_manifest
+)
+from functions.functions_keywords import QUERY_EXPANSION_TERMS, KeywordIndex
+from functions.functions_rerank import create_reranker
+from functions.functions_shared_index import SHARED_INDEX, current_snapshot, load_shared_index
+from functions.functions_shards import SHARD_ADDRESSES, SHARDED_INDEX, load_shards_info, load_sharded_index
+from functions.functions_retrieval import HybridRetriever
+
+# Chat model used to answer questions ("fake" runs a local stand-in) and the fake model's latency
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4")
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", 0.0))
+
+# Number of chunks passed to the LLM and retrieval candidates per retriever
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 2))
+CANDIDATE_K = int(os.getenv("CANDIDATE_K", 20))
+
+# Answer cache: cosine similarity for near-duplicate questions, lifetime in seconds and size
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+
+# Optional reranking of a wider candidate pool ('' off, 'embedding' or 'cross-encoder[:<model>]'),
+# the pool size and the seconds reranking may take before the fused ranking is used instead
+RERANKER = os.getenv("RERANKER", "")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 50))
+RERANK_BUDGET = float(os.getenv("RERANK_BUDGET", 0.2))
+
+# Maximum number of pooled connections to the OpenAI API
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 100))
+
+# Seconds between checks for a new shared index snapshot
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", 1.0))
+
+
+class AppContext:
+    """
+    Process-wide objects shared by every request of the web application.
+
+    The context is created once at startup and owns the chat model, the question
+    answering chain, the embeddings and the retriever, so requests no longer pay
+    for constructing them. The chat model and the embeddings share one pooled
+    HTTP client (one for synchronous and one for asynchronous calls), so keep-alive
+    connections to the API are reused across requests.
+    The file title map is re-read only when file_titles.csv changes on disk.
+
+    Answers are cached in an AnswerCache tagged with the version of the loaded
+    index, and the cache is cleared whenever the index is (re)loaded.
+
+    With shared_index, the index is opened from the memory-mapped snapshot that
+    build_index.py publishes, so worker processes share its pages. A newly
+    published snapshot is loaded in a background thread, so the event loop of an
+    asynchronous server never waits for it, and swapped in once ready; until then,
+    and for requests in flight, the previous snapshot keeps serving.
+
+    With a coalesce_window, the question embeddings of the answer cache and of
+    retrieval, and the vector searches, are batched across concurrent requests.
+
+    With sharded_index, vector searches go to the shards build_index.py --shards
+    wrote, searched in parallel by shard processes started on first use (or by
+    the shard servers at shard_addresses), and only the docstore is loaded here.
+
+    The keyword index is loaded on first use and re-read when build_index.py
+    replaces it. With query_expansion_terms, BM25 searches each question with
+    that many related keyword terms appended.
+    """
+
+    def __init__(self, llm_model, index_folder, upload_folder, file_titles_csv='./file_titles.csv',
+                 retrieval_k=2, candidate_k=20, max_connections=100, answer_cache_threshold=0.95,
+                 answer_cache_ttl=24 * 3600, answer_cache_size=1000, fake_llm_latency=0.0, reranker='',
+                 rerank_candidates=50, rerank_budget=0.2, shared_index=False,
+                 snapshot_check_interval=SNAPSHOT_CHECK_INTERVAL, coalesce_window=0.0,
+                 coalesce_max_batch=COALESCE_MAX_BATCH, sharded_index=False, shard_addresses=None,
+                 query_expansion_terms=0):
+        self.index_folder = index_folder
+        self.upload_folder = upload_folder
+        self.file_titles_csv = file_titles_csv
+        self.retrieval_k = retrieval_k
+        self.candidate_k = candidate_k
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget = rerank_budget
+        self.shared_index = shared_index
+        self.snapshot_check_interval = snapshot_check_interval
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_batch = coalesce_max_batch
+        self.sharded_index = sharded_index
+        self.shard_addresses = shard_addresses
+        self.query_expansion_terms = query_expansion_terms
+
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        timeout = httpx.Timeout(120.0, connect=10.0)
+        self.http_client = httpx.Client(limits=limits, timeout=timeout)
+        self.http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self.llm = create_llm(llm_model, http_client=self.http_client, http_async_client=self.http_async_client,
+                              fake_latency=fake_llm_latency)
+        self.qa_chain = create_question_answer_from_context_chain(self.llm)
+
+        self.index_version = None
+        self.answer_cache = AnswerCache(self._embed_question, threshold=answer_cache_threshold,
+                                        ttl=answer_cache_ttl, max_items=answer_cache_size,
+                                        aembed_query=self._aembed_question)
+
+        self._retriever = None
+        self._snapshot = None
+        self._snapshot_checked = 0.0
+        self._snapshot_loading = False
+        # Shared by the retrievers of successive snapshots
+        self._executor = ThreadPoolExecutor()
+        self._file_titles = {}
+        self._file_titles_mtime = None
+        self._retriever_lock = threading.Lock()
+        self._file_titles_lock = threading.Lock()
+        self._keywords = None
+        self._keywords_mtime = None
+        self._keywords_lock = threading.Lock()
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def get_retriever(self):
+        """
+        Return the hybrid retriever, loading (or building) the indexes on first use.
+
+        Returns:
+            HybridRetriever or None: The retriever, or None if there are no PDFs to index.
+        """
+        if self.shared_index:
+            self._check_snapshot()
+        if self._retriever is None:
+            with self._retriever_lock:
+                if self._retriever is None:
+                    self._retriever = self._create_retriever()
+        return self._retriever
+
+    def _check_snapshot(self):
+        # Start loading a newly published shared snapshot (at most one check per interval)
+        now = time.monotonic()
+        if now - self._snapshot_checked < self.snapshot_check_interval:
+            return
+        self._snapshot_checked = now
+        snapshot = current_snapshot(self.index_folder)
+        if snapshot is None and self._snapshot is not None:
+            # build_index.py removed the index when every PDF was deleted
+            with self._retriever_lock:
+                self._retriever = None
+                self._snapshot = None
+                self.answer_cache.invalidate()
+            return
+        if snapshot is None or snapshot == self._snapshot or self._retriever is None:
+            return
+        with self._retriever_lock:
+            if self._snapshot_loading or snapshot == self._snapshot:
+                return
+            self._snapshot_loading = True
+        threading.Thread(target=self._swap_snapshot, daemon=True).start()
+
+    def _swap_snapshot(self):
+        # Load the current snapshot off the request path, then serve it from the next request on
+        try:
+            embeddings = self._create_embeddings()
+            vector_store, bm25, snapshot = load_shared_index(self.index_folder, embeddings)
+            retriever = self._hybrid_retriever(vector_store, bm25, embeddings)
+        except Exception as e:
+            # The previous snapshot keeps serving; the next check tries again
+            print(f"Loading the shared index snapshot failed: {type(e).__name__}: {e}")
+            with self._retriever_lock:
+                self._snapshot_loading = False
+            return
+        with self._retriever_lock:
+            self._use_snapshot(retriever, snapshot)
+            self._snapshot_loading = False
+
+    def _use_snapshot(self, retriever, snapshot):
+        self._retriever = retriever
+        self._snapshot = snapshot['name']
+        self.index_version = snapshot['version']
+        self.answer_cache.invalidate()
+
+    def _embed_question(self, question):
+        # Embed with the loaded index's CachedEmbeddings, so retrieval reuses the vector
+        retriever = self.get_retriever()
+        if retriever.coalescer is not None:
+            return retriever.coalescer.embed(question)
+        return retriever.vectorstore.embedding_function.embed_query(question)
+
+    async def _aembed_question(self, question):
+        retriever = self.get_retriever()
+        if retriever.coalescer is not None:
+            return await retriever.coalescer.aembed(question)
+        return await retriever.vectorstore.embedding_function.aembed_query(question)
+
+    def _create_embeddings(self):
+        # Queries must be embedded with the model the index was built with
+        manifest = load_manifest(self.index_folder)
+        return create_embeddings(manifest['embedding_model'] if manifest else EMBEDDING_MODEL,
+                                 http_client=self.http_client, http_async_client=self.http_async_client)
+
+    def _create_retriever(self):
+        manifest = load_manifest(self.index_folder)
+        embeddings = self._create_embeddings()
+
+        if self.shared_index and current_snapshot(self.index_folder) is not None:
+            vector_store, bm25, snapshot = load_shared_index(self.index_folder, embeddings)
+            retriever = self._hybrid_retriever(vector_store, bm25, embeddings)
+            self._use_snapshot(retriever, snapshot)
+            return retriever
+
+        if self.sharded_index and index_exists(self.index_folder) and load_shards_info(self.index_folder):
+            # The vectors stay in the shard processes
+            version = manifest.get('version') if manifest else None
+            vector_store = load_sharded_index(self.index_folder, embeddings, version, self.shard_addresses)
+        elif index_exists(self.index_folder):
+            # Serve with the (possibly compressed) index type the index was built with
+            index_type = manifest.get('index_type', 'flat') if manifest else 'flat'
+            vector_store = load_index(self.index_folder, embeddings, index_type)
+        else:
+            # No prebuilt index yet: build it from the uploaded PDFs and save it
+            pdf_files = find_all_pdfs(self.upload_folder)
+            if not pdf_files:
+                return None
+            vector_store = build_index(pdf_files, self.index_folder, embeddings=embeddings,
+                                       file_titles=self.get_file_titles())
+            if vector_store is None:
+                # None of the PDFs has text
+                return None
+
+        try:
+            bm25 = load_bm25_index(self.index_folder)
+        except FileNotFoundError:
+            # Indexes built before BM25 was added only have the vector store
+            bm25 = build_bm25_index(vector_store)
+
+        # Answers retrieved from a previous index must not be served any more
+        self.index_version = get_index_version(self.index_folder)
+        self.answer_cache.invalidate()
+
+        return self._hybrid_retriever(vector_store, bm25, embeddings)
+
+    def _hybrid_retriever(self, vector_store, bm25, embeddings):
+        return HybridRetriever(vector_store, bm25, k=self.retrieval_k, candidate_k=self.candidate_k,
+                               reranker=create_reranker(self.reranker, embeddings),
+                               rerank_candidates=self.rerank_candidates, rerank_budget=self.rerank_budget,
+                               executor=self._executor, coalesce_window=self.coalesce_window,
+                               coalesce_max_batch=self.coalesce_max_batch,
+                               query_expander=self._expand_query if self.query_expansion_terms > 0 else None)
+
+    def get_keyword_index(self):
+        """
+        Return the TF-IDF keyword index, re-reading it only if it changed on disk.
+
+        Returns:
+            KeywordIndex or None: The keyword index, or None if none has been built.
+        """
+        keywords_path = os.path.join(self.index_folder, KEYWORDS_FILE)
+        try:
+            mtime = os.stat(keywords_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        if mtime != self._keywords_mtime:
+            with self._keywords_lock:
+                if mtime != self._keywords_mtime:
+                    self._keywords = KeywordIndex.load(keywords_path)
+                    self._keywords_mtime = mtime
+        return self._keywords
+
+    def _expand_query(self, question):
+        keywords = self.get_keyword_index()
+        return keywords.expand_query(question, self.query_expansion_terms) if keywords is not None else question
+
+    def get_file_titles(self):
+        """
+        Return the file path to title map, re-reading the CSV only if it changed.
+
+        Returns:
+            dict: Maps normalized file paths to document titles.
+        """
+        try:
+            mtime = os.stat(self.file_titles_csv).st_mtime
+        except FileNotFoundError:
+            return {}
+
+        if mtime != self._file_titles_mtime:
+            with self._file_titles_lock:
+                if mtime != self._file_titles_mtime:
+                    self._file_titles = load_file_titles(self.file_titles_csv)
+                    self._file_titles_mtime = mtime
+        return self._file_titles
+
+    def run_async(self, coroutine):
+        """
+        Run a coroutine from synchronous code and wait for its result.
+
+        Coroutines run on one event loop thread owned by the context, so the pooled
+        asynchronous HTTP connections (which belong to a single loop) are reused
+        across requests of a threaded server.
+
+        Args:
+            coroutine: The coroutine to run.
+
+        Returns:
+            The result of the coroutine.
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _close_shards(self):
+        # Stop the shard processes of a sharded index
+        index = self._retriever.vectorstore.index if self._retriever is not None else None
+        if hasattr(index, 'close'):
+            index.close()
+
+    def close(self):
+        """
+        Close the pooled synchronous HTTP connections, stop the event loop thread and the shard processes.
+        """
+        self.http_client.close()
+        self._close_shards()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def aclose(self):
+        """
+        Close all pooled HTTP connections and stop the shard processes.
+        """
+        self.http_client.close()
+        await self.http_async_client.aclose()
+        self._close_shards()
+
+
+def create_app_context(index_folder, upload_folder, file_titles_csv='./file_titles.csv'):
+    """
+    Create the application context from the settings in the environment.
+
+    Args:
+        index_folder (str): The folder the index is saved to.
+        upload_folder (str): The folder holding the PDF files.
+        file_titles_csv (str): The CSV file mapping file paths to titles.
+
+    Returns:
+        AppContext: The application context.
+    """
+    return AppContext(LLM_MODEL, index_folder, upload_folder, file_titles_csv,
+                      retrieval_k=RETRIEVAL_K, candidate_k=CANDIDATE_K, max_connections=MAX_CONNECTIONS,
+                      answer_cache_threshold=ANSWER_CACHE_THRESHOLD, answer_cache_ttl=ANSWER_CACHE_TTL,
+                      answer_cache_size=ANSWER_CACHE_SIZE, fake_llm_latency=FAKE_LLM_LATENCY, reranker=RERANKER,
+                      rerank_candidates=RERANK_CANDIDATES, rerank_budget=RERANK_BUDGET, shared_index=SHARED_INDEX,
+                      coalesce_window=COALESCE_WINDOW, coalesce_max_batch=COALESCE_MAX_BATCH,
+                      sharded_index=SHARDED_INDEX, shard_addresses=SHARD_ADDRESSES,
+                      query_expansion_terms=QUERY_EXPANSION_TERMS)
@@ -0,0 +1,164 @@
+import os
+
+from functions.functions_metrics import count_tokens
+
+# Maximum number of context tokens sent to the LLM per question
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+
+# Chunks of the same page at most this many characters apart are merged (the splitter strips whitespace)
+ADJACENT_GAP = 2
+
+# Shortest shared text that counts as an overlap when chunks have no start_index
+MIN_OVERLAP = 20
+
+# Separator between the merged passages of the context
+PASSAGE_SEPARATOR = "\n\n"
+
+
+def _text_overlap(text, following):
+    # Length of the longest suffix of text that is a prefix of following
+    probe = following[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    position = text.find(probe, max(0, len(text) - len(following)))
+    while position != -1:
+        if following.startswith(text[position:]):
+            return len(text) - position
+        position = text.find(probe, position + 1)
+    return 0
+
+
+def _merge_into(passage, doc):
+    # Merge doc into the passage if they overlap or are adjacent on the page, return whether it was merged
+    text = doc.page_content
+    start = doc.metadata.get('start_index')
+    if passage['start'] is not None and start is not None:
+        end = start + len(text)
+        if start > passage['end'] + ADJACENT_GAP or end < passage['start'] - ADJACENT_GAP:
+            return False
+        if start >= passage['start'] and end <= passage['end']:
+            return True
+        if start < passage['start'] and end > passage['end']:
+            passage['text'], passage['start'], passage['end'] = text, start, end
+            return True
+        if start >= passage['start']:
+            overlap = passage['end'] - start
+            passage['text'] += text[overlap:] if overlap > 0 else " " + text
+            passage['end'] = end
+        else:
+            overlap = end - passage['start']
+            passage['text'] = (text[:-overlap] if overlap > 0 else text + " ") + passage['text']
+            passage['start'] = start
+        return True
+
+    # Without positions, chunks are merged when one repeats the end of the other
+    if text in passage['text']:
+        return True
+    overlap = _text_overlap(passage['text'], text)
+    if overlap:
+        passage['text'] += text[overlap:]
+        return True
+    overlap = _text_overlap(text, passage['text'])
+    if overlap:
+        passage['text'] = text + passage['text'][overlap:]
+        return True
+    return False
+
+
+def merge_chunks(docs):
+    """
+    Merge overlapping and adjacent chunks of the same source and page into passages.
+
+    Args:
+        docs (list): The retrieved documents, best first.
+
+    Returns:
+        list: Dicts with the 'source', 'page', 'start', 'text' and 'rank' (the best rank
+            of the merged chunks) of each passage, best first.
+    """
+    passages = []
+    for rank, doc in enumerate(docs):
+        source, page = doc.metadata.get('source'), doc.metadata.get('page')
+        same_page = [passage for passage in passages if passage['source'] == source and passage['page'] == page]
+        target = next((passage for passage in same_page if _merge_into(passage, doc)), None)
+        if target is None:
+            start = doc.metadata.get('start_index')
+            passages.append({'source': source, 'page': page, 'start': start,
+                             'end': None if start is None else start + len(doc.page_content),
+                             'text': doc.page_content, 'rank': rank})
+            continue
+
+        # A chunk can bridge two passages, which are then merged too
+        for other in same_page:
+            if other is not target and _merge_into(target, _PassageDoc(other)):
+                target['rank'] = min(target['rank'], other['rank'])
+                passages.remove(other)
+    return passages
+
+
+class _PassageDoc:
+    # A passage seen as a document, for merging two passages
+    def __init__(self, passage):
+        self.page_content = passage['text']
+        self.metadata = {'start_index': passage['start']}
+
+
+def assemble_context(docs, max_tokens=CONTEXT_TOKEN_BUDGET):
+    """
+    Build the LLM context from retrieved chunks within a token budget.
+
+    Overlapping and adjacent chunks of the same source and page are merged, so the
+    splitter's chunk overlap is sent once. Passages are packed greedily, best rank
+    first, skipping any that no longer fit (the best passage is cut to the budget if
+    it is larger on its own), and are then ordered by source and page so text from
+    one document reads in order.
+
+    Args:
+        docs (list): The retrieved documents, best first.
+        max_tokens (int): The token budget of the context.
+
+    Returns:
+        tuple: The context text and a dict with the 'context_tokens', 'naive_tokens'
+            (tokens of the chunks joined as they are), 'tokens_saved' and 'passages_dropped'.
+    """
+    token_counts = {}
+
+    def tokens_of(text):
+        if text not in token_counts:
+            token_counts[text] = count_tokens(text)
+        return token_counts[text]
+
+    naive_tokens = sum(tokens_of(doc.page_content) for doc in docs) + max(len(docs) - 1, 0)
+    passages = merge_chunks(docs)
+
+    # The separator costs about one token, which the budget reserves per passage
+    selected, used = [], 0
+    for passage in passages:
+        cost = tokens_of(passage['text']) + (1 if selected else 0)
+        if used + cost <= max_tokens:
+            selected.append(passage)
+            used += cost
+        elif not selected and max_tokens > 0:
+            # The best passage alone is over the budget: send as much of it as fits
+            passage['text'] = passage['text'][:len(passage['text']) * max_tokens // cost]
+            while passage['text'] and tokens_of(passage['text']) > max_tokens:
+                passage['text'] = passage['text'][:int(len(passage['text']) * 0.9)]
+            selected.append(passage)
+            used += tokens_of(passage['text'])
+
+    # Sources in the order of their best passage, pages and positions in reading order
+    source_ranks = {}
+    for passage in selected:
+        source_ranks.setdefault(passage['source'], passage['rank'])
+    selected.sort(key=lambda passage: (source_ranks[passage['source']], passage['page'] or 0,
+                                       passage['start'] or 0, passage['rank']))
+
+    context = PASSAGE_SEPARATOR.join(passage['text'] for passage in selected)
+    context_tokens = sum(tokens_of(passage['text']) for passage in selected) + max(len(selected) - 1, 0)
+    stats = {
+        'context_tokens': context_tokens,
+        'naive_tokens': naive_tokens,
+        'tokens_saved': max(naive_tokens - context_tokens, 0),
+        'passages_dropped': len(passages) - len(selected),
+    }
+    return context, stats
@@ -0,0 +1,298 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Manifest recording the validators (ETag, Last-Modified) of every downloaded file
+DOWNLOAD_MANIFEST_FILE = './database/download_manifest.json'
+
+# Requests per second allowed per host, and how many may be sent back to back
+REQUESTS_PER_SECOND = 2.0
+BURST = 4
+
+# Size of the blocks a download is streamed to disk in
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+# Seconds to wait for a connection and between received bytes
+REQUEST_TIMEOUT = (10, 60)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that limits requests to rate per second.
+
+    The bucket holds up to capacity tokens and refills continuously, so short
+    bursts are sent immediately while the long-run rate never exceeds rate.
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def load_download_manifest(manifest_file=DOWNLOAD_MANIFEST_FILE):
+    """
+    Load the download manifest.
+
+    Args:
+        manifest_file (str): The manifest file.
+
+    Returns:
+        dict: Maps URLs to their file path, size, sha256, ETag and Last-Modified, or {} if there is no manifest.
+    """
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_download_manifest(manifest, manifest_file=DOWNLOAD_MANIFEST_FILE):
+    """
+    Atomically write the download manifest, so an interrupted crawl never leaves a truncated file.
+
+    Args:
+        manifest (dict): The manifest to save.
+        manifest_file (str): The manifest file.
+    """
+    folder = os.path.dirname(manifest_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+class Crawler:
+    """
+    Polite, resumable HTTP downloader shared by many worker threads.
+
+    Every thread reuses its own pooled requests session (keep-alive connections
+    and retries with backoff on 429 and 5xx responses), and a token bucket per
+    host limits the request rate across all threads.
+
+    Downloads are streamed to a '.part' file in blocks and renamed into place
+    once complete. The ETag and Last-Modified of each file are kept in a
+    manifest, so a later crawl sends conditional requests and skips files that
+    did not change (304), and an interrupted download is continued with a
+    Range request when the server supports it.
+    """
+
+    def __init__(self, manifest_file=DOWNLOAD_MANIFEST_FILE, rate=REQUESTS_PER_SECOND, burst=BURST,
+                 pool_size=10, max_retries=3, timeout=REQUEST_TIMEOUT):
+        self.manifest_file = manifest_file
+        self.manifest = load_download_manifest(manifest_file)
+        self.rate = rate
+        self.burst = burst
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._manifest_lock = threading.Lock()
+
+    def _session(self):
+        # requests sessions are not thread-safe, so each thread gets its own pool
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            retry = Retry(total=self.max_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET'], respect_retry_after_header=True)
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+        return session
+
+    def _wait_for_host(self, url):
+        host = urlparse(url).netloc
+        with self._buckets_lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
+
+    def get(self, url, **kwargs):
+        """
+        Send a rate-limited GET request with the thread's pooled session.
+
+        Args:
+            url (str): The URL to fetch.
+            **kwargs: Passed on to requests.Session.get.
+
+        Returns:
+            requests.Response: The response.
+        """
+        self._wait_for_host(url)
+        kwargs.setdefault('timeout', self.timeout)
+        return self._session().get(url, **kwargs)
+
+    def fetch_page(self, url):
+        """
+        Fetch a page and return its body.
+
+        Args:
+            url (str): The page URL.
+
+        Returns:
+            bytes: The page content.
+        """
+        response = self.get(url)
+        response.raise_for_status()
+        return response.content
+
+    def is_complete(self, url, path):
+        """
+        Check whether a URL was fully downloaded to path by an earlier crawl.
+
+        Args:
+            url (str): The file URL.
+            path (str): The file the URL is saved to.
+
+        Returns:
+            bool: True if the manifest has the download and the file on disk has the recorded size.
+        """
+        entry = self.manifest.get(url)
+        return (entry is not None and entry.get('path') == path and os.path.isfile(path)
+                and os.path.getsize(path) == entry.get('size'))
+
+    def download(self, url, path):
+        """
+        Download a URL to path, streaming the body to disk.
+
+        Args:
+            url (str): The file URL.
+            path (str): The file to save the download to.
+
+        Returns:
+            str: 'downloaded', 'resumed' (an interrupted download was continued) or 'not_modified'.
+        """
+        entry = self.manifest.get(url, {})
+        part_path = path + '.part'
+        part_validators = _load_part_validators(part_path)
+        headers = {}
+
+        if os.path.isfile(part_path) and part_validators:
+            # Continue an interrupted download, unless the file changed since it started
+            offset = os.path.getsize(part_path)
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = part_validators.get('etag') or part_validators['last_modified']
+        elif self.is_complete(url, path):
+            # Only download again if the server has a newer version
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        with self.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                return 'not_modified'
+            restart = 'Range' in headers and (
+                response.status_code == 416
+                or (response.status_code == 206 and _content_range_start(response) != offset))
+            if not restart:
+                response.raise_for_status()
+                validators = {'etag': response.headers.get('ETag'),
+                              'last_modified': response.headers.get('Last-Modified')}
+                resumed = response.status_code == 206
+                sha256 = _download_body(response, part_path, validators, resumed)
+
+        if restart:
+            # The server cannot continue from the end of the .part file (it may already hold the whole file,
+            # or the server sent another range), so start over with a full download
+            _remove_part(part_path)
+            return self.download(url, path)
+
+        os.replace(part_path, path)
+        self._update_manifest(url, dict(validators, path=path, size=os.path.getsize(path),
+                                        sha256=sha256.hexdigest()))
+        _remove_part(part_path)
+        return 'resumed' if resumed else 'downloaded'
+
+    def _update_manifest(self, url, values):
+        # Saved once per completed download; the validators of a download in progress are kept next to its .part file
+        with self._manifest_lock:
+            entry = self.manifest.setdefault(url, {})
+            entry.update(values)
+            save_download_manifest(self.manifest, self.manifest_file)
+
+
+def _load_part_validators(part_path):
+    # The ETag and Last-Modified of an interrupted download, or None
+    try:
+        with open(part_path + '.json', 'r', encoding='utf-8') as f:
+            validators = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return validators if validators.get('etag') or validators.get('last_modified') else None
+
+
+def _content_range_start(response):
+    # The first byte of a 206 response, from 'Content-Range: bytes <start>-<end>/<total>'
+    match = re.match(r'bytes\s+(\d+)-', response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+
+def _remove_part(part_path):
+    for file in (part_path, part_path + '.json'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _download_body(response, part_path, validators, resumed):
+    """
+    Stream a response body to a .part file.
+
+    The validators are written next to the .part file before the body, so an
+    interrupted download can be resumed without saving the whole manifest.
+
+    Args:
+        response (requests.Response): A 200 or 206 response.
+        part_path (str): The .part file.
+        validators (dict): The 'etag' and 'last_modified' of the response.
+        resumed (bool): Whether the response continues the .part file.
+
+    Returns:
+        hashlib._Hash: The sha256 of the whole file.
+    """
+    sha256 = hashlib.sha256()
+    if resumed:
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b''):
+                sha256.update(block)
+
+    os.makedirs(os.path.dirname(part_path) or '.', exist_ok=True)
+    with open(part_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(validators, f)
+    with open(part_path, 'ab' if resumed else 'wb') as f:
+        for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+            f.write(block)
+            sha256.update(block)
+    return sha256
@@ -0,0 +1,261 @@
+import os
+import re
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Default location of the on-disk embedding cache
+EMBEDDING_CACHE_FILE = './cache/embeddings.sqlite'
+
+
+def normalize_chunk_text(text):
+    """
+    Normalize chunk text before hashing so whitespace-only differences share a cache entry.
+
+    Args:
+        text (str): The chunk text.
+
+    Returns:
+        str: The text with runs of whitespace collapsed to single spaces.
+    """
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def embedding_cache_key(model, text):
+    """
+    Compute the content-addressed cache key for a chunk embedded with a given model.
+
+    Args:
+        model (str): The embedding model name.
+        text (str): The chunk text.
+
+    Returns:
+        str: The SHA-256 hex digest of the model name and normalized text.
+    """
+    return hashlib.sha256(f"{model}\0{normalize_chunk_text(text)}".encode('utf-8')).hexdigest()
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for OpenAIEmbeddings.
+
+    Tokens are hashed into a fixed number of dimensions and the result is L2
+    normalized, so texts that share words get similar vectors. No network access
+    is needed, which makes it suitable for offline tests and benchmarks. A latency
+    in seconds is waited once per call, to mimic an API round trip.
+    """
+
+    def __init__(self, size=1536, latency=0.0):
+        self.size = size
+        self.latency = latency
+        self.model = f"hash-{size}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in text.lower().split():
+            digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.size
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[index] += sign
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that memoizes vectors by (model, normalized chunk text hash).
+
+    Lookups go to an in-memory LRU first and then to a SQLite file on disk. Texts
+    missing from both are de-duplicated and sent to the underlying embeddings in
+    batches of up to batch_size, and the results are written back to both tiers.
+
+    Questions (embed_query and embed_queries) are only kept in the memory LRU,
+    which evicts them, so the disk cache holds the chunks of the indexes and does
+    not grow with every question asked.
+
+    Attributes:
+        hits (int): Number of texts served from the memory or disk cache.
+        misses (int): Number of texts that had to be embedded.
+    """
+
+    def __init__(self, embeddings, model=None, cache_file=EMBEDDING_CACHE_FILE, max_memory_items=10000,
+                 batch_size=512):
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, 'model', type(embeddings).__name__)
+        self.max_memory_items = max_memory_items
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        if os.path.dirname(cache_file):
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        self._connection = sqlite3.connect(cache_file, check_same_thread=False)
+
+        # Write-ahead logging without a sync per commit keeps small writes (e.g. single queries) cheap
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._connection.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys, disk=True):
+        found = {}
+        disk_keys = []
+        for key in keys:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                found[key] = self._memory[key]
+            else:
+                disk_keys.append(key)
+
+        if not disk:
+            return found
+
+        # SQLite limits the number of bound parameters, so query in slices
+        for start in range(0, len(disk_keys), 500):
+            batch = disk_keys[start:start + 500]
+            rows = self._connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            for key, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                found[key] = vector
+                self._remember(key, vector)
+        return found
+
+    def _find_missing(self, texts, disk=True):
+        keys = [embedding_cache_key(self.model, text) for text in texts]
+
+        with self._lock:
+            found = self._lookup(set(keys), disk)
+
+        # Embed each distinct missing text once, in large batches
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        return keys, found, missing
+
+    def _store(self, found, batch_keys, vectors, disk=True):
+        with self._lock:
+            if disk:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(batch_keys, vectors)]
+                )
+                self._connection.commit()
+            for key, vector in zip(batch_keys, vectors):
+                self._remember(key, vector)
+        found.update(zip(batch_keys, vectors))
+
+    def _count(self, keys, missing):
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+
+    def _embed(self, texts, disk):
+        keys, found, missing = self._find_missing(texts, disk)
+        missing_keys = list(missing)
+
+        for start in range(0, len(missing_keys), self.batch_size):
+            batch_keys = missing_keys[start:start + self.batch_size]
+            vectors = self.embeddings.embed_documents([missing[key] for key in batch_keys])
+            self._store(found, batch_keys, vectors, disk)
+
+        self._count(keys, missing)
+        return [found[key] for key in keys]
+
+    async def _aembed(self, texts, disk):
+        keys, found, missing = self._find_missing(texts, disk)
+        missing_keys = list(missing)
+
+        for start in range(0, len(missing_keys), self.batch_size):
+            batch_keys = missing_keys[start:start + self.batch_size]
+            vectors = await self.embeddings.aembed_documents([missing[key] for key in batch_keys])
+            self._store(found, batch_keys, vectors, disk)
+
+        self._count(keys, missing)
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, disk=True)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed several questions at once, caching their vectors in memory only.
+
+        Args:
+            texts (list): The questions.
+
+        Returns:
+            list: One vector per question.
+        """
+        return self._embed(texts, disk=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self._aembed(texts, disk=True)
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Asynchronous version of embed_queries.
+        """
+        return await self._aembed(texts, disk=False)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_queries([text]))[0]
+
+    def stats(self):
+        """
+        Return the cache counters.
+
+        Returns:
+            dict: Hits, misses, hit rate and the number of vectors held in memory and on disk.
+        """
+        total = self.hits + self.misses
+        with self._lock:
+            disk_items = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'memory_items': len(self._memory),
+            'disk_items': disk_items,
+        }
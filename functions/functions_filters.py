@@ -0,0 +1,241 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from functions.functions_vector_index import bitmap_selector, filtered_search
+
+# Metadata fields a search can be restricted to
+FILTER_FIELDS = ('chapter', 'section')
+
+# Filtered searches whose partition (FAISS selector and BM25 sub-index) is kept for reuse
+PARTITION_CACHE_SIZE = 64
+
+
+def normalize_section(section):
+    """
+    Normalize a section number the way get_dataset.py names the section PDFs ("5.2.1" becomes "5_2_1").
+
+    Args:
+        section (str): The section number.
+
+    Returns:
+        str: The normalized section number.
+    """
+    return re.sub(r'[.\s-]', '_', str(section).strip())
+
+
+def parse_document_path(path):
+    """
+    Read the chapter and section of a PDF from its path.
+
+    get_dataset.py saves each section as database/manual/NUREG0800_ChapterN/<section>.pdf.
+    The chapter comes from the folder name, or else from the leading number of the section.
+
+    Args:
+        path (str): The path of the PDF.
+
+    Returns:
+        dict: The 'chapter' (int or None) and 'section' (str) of the PDF.
+    """
+    section = os.path.splitext(os.path.basename(path))[0]
+    chapter = re.search(r'Chapter(\d+)', path.replace("\\", "/"))
+    if chapter is None:
+        chapter = re.match(r'(\d+)(?:_|$)', section)
+    return {'chapter': int(chapter.group(1)) if chapter else None, 'section': section}
+
+
+def document_metadata(path, file_titles=None):
+    """
+    Build the structured metadata stored with every chunk of a PDF.
+
+    Args:
+        path (str): The path of the PDF.
+        file_titles (dict): Maps normalized file paths to titles (from file_titles.csv).
+
+    Returns:
+        dict: The 'chapter', 'section' and 'title' of the PDF.
+    """
+    metadata = parse_document_path(path)
+    metadata['title'] = (file_titles or {}).get(os.path.normpath(path).replace("\\", "/"))
+    return metadata
+
+
+def parse_filters(filters):
+    """
+    Validate the filters of a search request.
+
+    Filters restrict the search to chunks of some chapters and/or sections, e.g.
+    {"chapter": 5, "section": "5_2"}. Each value may be a single value or a list.
+    A section matches itself and its subsections ("5_2" matches "5_2_1" but not "5_20").
+
+    Args:
+        filters (dict): The filters, or None.
+
+    Returns:
+        dict or None: The filters with sorted tuples of values, or None if there are none.
+
+    Raises:
+        ValueError: If a field is unknown or a value is malformed.
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+
+    parsed = {}
+    for field, values in filters.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter: {field}. Filters are {', '.join(FILTER_FIELDS)}")
+        if values is None or values == []:
+            continue
+        values = values if isinstance(values, list) else [values]
+        if field == 'chapter':
+            try:
+                parsed[field] = tuple(sorted({int(value) for value in values}))
+            except (TypeError, ValueError):
+                raise ValueError("chapter must be a number or a list of numbers") from None
+        else:
+            if not all(isinstance(value, (str, int, float)) and str(value).strip() for value in values):
+                raise ValueError("section must be a section number or a list of section numbers")
+            parsed[field] = tuple(sorted({normalize_section(value) for value in values}))
+    return parsed or None
+
+
+def filter_key(filters):
+    """
+    Return a string identifying parsed filters, e.g. to scope cached answers.
+
+    Args:
+        filters (dict): Filters returned by parse_filters, or None.
+
+    Returns:
+        str or None: The key, or None without filters.
+    """
+    if not filters:
+        return None
+    return ";".join(f"{field}={','.join(map(str, filters[field]))}" for field in FILTER_FIELDS if field in filters)
+
+
+def _section_matches(section, prefixes):
+    return any(section == prefix or section.startswith(prefix + '_') for prefix in prefixes)
+
+
+class Partition:
+    """
+    The chunks matching some filters: their FAISS positions, a selector and a BM25 sub-index.
+    """
+
+    def __init__(self, positions, total, bm25):
+        self.positions = positions
+        self.size = len(positions)
+        self.selectivity = self.size / total if total else 0.0
+        # The bitmap has one bit per FAISS position, so membership tests cost one lookup. It lives
+        # as long as the search parameters using it, even when the partition is evicted mid-search
+        self.selector = bitmap_selector(positions, total)
+        self.bm25 = bm25
+        # How to search the partition's vectors, set on first use
+        self.search = None
+
+
+class MetadataPartitions:
+    """
+    Partitions of an index by chunk metadata, for searches restricted by filters.
+
+    The chapter and section of every chunk are read once from the docstore (from
+    the path of the source PDF for chunks indexed before they were stored). A
+    filtered search then scans only the matching chunks: FAISS skips the other
+    vectors through an ID-selector bitmap, and BM25 scores a column slice of its
+    term-document matrix. Partitions of recent filters are cached.
+    """
+
+    def __init__(self, vectorstore, bm25, cache_size=PARTITION_CACHE_SIZE):
+        self.vectorstore = vectorstore
+        self.bm25 = bm25
+        self.cache_size = cache_size
+        self._chapters = None
+        self._section_codes = None
+        self._sections = None
+        self._bm25_columns = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load_metadata(self):
+        # Chapter and section code of every FAISS position, and the FAISS position of every BM25 column
+        docstore_ids = [self.vectorstore.index_to_docstore_id[position]
+                        for position in range(len(self.vectorstore.index_to_docstore_id))]
+        chapters = np.full(len(docstore_ids), -1, dtype=np.int32)
+        sections = []
+        # A memory-mapped docstore reads the metadata without the chunk texts
+        get_metadata = getattr(self.vectorstore.docstore, 'get_metadata', None)
+        for position, docstore_id in enumerate(docstore_ids):
+            if get_metadata is not None:
+                metadata = get_metadata(docstore_id)
+            else:
+                metadata = self.vectorstore.docstore.search(docstore_id).metadata
+            if 'section' not in metadata:
+                metadata = dict(parse_document_path(metadata.get('source', '')), **metadata)
+            if metadata.get('chapter') is not None:
+                chapters[position] = metadata['chapter']
+            sections.append(metadata.get('section') or '')
+
+        self._sections, self._section_codes = np.unique(np.array(sections, dtype=str), return_inverse=True)
+        positions = {docstore_id: position for position, docstore_id in enumerate(docstore_ids)}
+        self._bm25_columns = np.array([positions.get(doc_id, -1) for doc_id in self.bm25.doc_ids], dtype=np.int64)
+        self._chapters = chapters
+
+    def _build(self, filters):
+        mask = np.ones(len(self._chapters), dtype=bool)
+        if 'chapter' in filters:
+            mask &= np.isin(self._chapters, filters['chapter'])
+        if 'section' in filters:
+            codes = [code for code, section in enumerate(self._sections)
+                     if _section_matches(section, filters['section'])]
+            mask &= np.isin(self._section_codes, codes)
+
+        columns = np.flatnonzero(mask[self._bm25_columns] & (self._bm25_columns >= 0))
+        return Partition(np.flatnonzero(mask), len(mask), self.bm25.subset(columns))
+
+    def get(self, filters):
+        """
+        Return the partition of the chunks matching filters.
+
+        Args:
+            filters (dict): Filters returned by parse_filters.
+
+        Returns:
+            Partition: The matching chunks.
+        """
+        key = filter_key(filters)
+        with self._lock:
+            if self._chapters is None:
+                self._load_metadata()
+            partition = self._cache.get(key)
+            if partition is None:
+                partition = self._cache[key] = self._build(filters)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+            return partition
+
+    def search_parameters(self, partition):
+        """
+        Return how to restrict a FAISS search to a partition.
+
+        Args:
+            partition (Partition): The partition.
+
+        Returns:
+            tuple: The FAISS index to search and the faiss.SearchParameters to pass to its search.
+        """
+        if partition.search is None:
+            index = self.vectorstore.index
+            if hasattr(index, 'restrict'):
+                # A memory-mapped exact index scans the partition's rows in place
+                partition.search = index.restrict(partition.positions), None
+            else:
+                partition.search = filtered_search(index, partition.selector, partition.selectivity)
+        return partition.search
@@ -0,0 +1,481 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+
+import openai
+from langchain_community.vectorstores import FAISS
+
+from functions.functions_bm25 import BM25Index
+from functions.functions_filters import document_metadata
+from functions.functions_embeddings import CachedEmbeddings, HashEmbeddings, EMBEDDING_CACHE_FILE
+from functions.functions_ingest import iter_pdf_chunks, DEFAULT_WORKERS
+from functions.functions_keywords import KeywordIndex, update_keyword_index
+from functions.functions_utils import hash_file
+from functions.functions_metrics import observe_stage, span
+from functions.functions_shared_index import (
+    SHARED_FOLDER,
+    SHARED_INDEX,
+    current_snapshot,
+    export_shared_index,
+    snapshot_name
+)
+from functions.functions_shards import INDEX_SHARDS, SHARD_KEY, SHARDS_FOLDER, build_shards, load_shards_info
+from functions.functions_vector_index import INDEX_TYPE, load_serving_vectorstore, save_serving_index
+
+# Default location of the prebuilt vector index
+INDEX_FOLDER = './index'
+
+# Manifest recording which files (and which vectors) are in the index
+MANIFEST_FILE = 'manifest.json'
+
+# BM25 keyword index saved next to the vector index
+BM25_FILE = 'bm25.npz'
+
+# TF-IDF keyword index (suggestions, document keywords and query expansion) saved next to the vector index
+KEYWORDS_FILE = 'keywords.npz'
+
+# Chunking parameters used when building the index
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Embedding model used to encode the chunks ("hash-<size>" selects the local stand-in)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-ada-002')
+
+# Seconds the local stand-in waits per embedding call, like an API round trip
+FAKE_EMBEDDING_LATENCY = float(os.getenv('FAKE_EMBEDDING_LATENCY', 0.0))
+
+
+def index_exists(index_folder=INDEX_FOLDER):
+    """
+    Check whether a saved FAISS index is present in the given folder.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+
+    Returns:
+        bool: True if both the FAISS index and its docstore exist.
+    """
+    return (
+        os.path.isfile(os.path.join(index_folder, 'index.faiss'))
+        and os.path.isfile(os.path.join(index_folder, 'index.pkl'))
+    )
+
+
+def save_index(vectorstore, index_folder=INDEX_FOLDER):
+    """
+    Save a FAISS vector store (index and docstore) to disk.
+
+    The store is first written to a temporary folder next to the target and then
+    swapped in, so a reader never sees a half-written index.
+
+    Args:
+        vectorstore (FAISS): The vector store to save.
+        index_folder (str): The folder to save the index to.
+    """
+    tmp_folder = index_folder.rstrip('/\\') + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    vectorstore.save_local(tmp_folder)
+
+    os.makedirs(index_folder, exist_ok=True)
+    for file_name in os.listdir(tmp_folder):
+        os.replace(os.path.join(tmp_folder, file_name), os.path.join(index_folder, file_name))
+    shutil.rmtree(tmp_folder)
+
+
+def remove_index(index_folder=INDEX_FOLDER):
+    """
+    Remove the saved index and everything built from it, once there is nothing left to index.
+
+    The manifest goes first, so an interrupted removal is followed by a full
+    rebuild. The shard key is kept for the shard servers.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+    """
+    if not os.path.isdir(index_folder):
+        return
+    for file_name in [MANIFEST_FILE, 'index.faiss', 'index.pkl', BM25_FILE, KEYWORDS_FILE]:
+        if os.path.isfile(os.path.join(index_folder, file_name)):
+            os.remove(os.path.join(index_folder, file_name))
+    # Serving indexes of every type
+    for file_name in os.listdir(index_folder):
+        if file_name.startswith('index.') and file_name.endswith('.faiss'):
+            os.remove(os.path.join(index_folder, file_name))
+    for folder in [SHARDS_FOLDER, SHARED_FOLDER]:
+        shutil.rmtree(os.path.join(index_folder, folder), ignore_errors=True)
+
+
+def create_embeddings(embedding_model=EMBEDDING_MODEL, cache_file=EMBEDDING_CACHE_FILE, http_client=None,
+                      http_async_client=None, fake_latency=FAKE_EMBEDDING_LATENCY):
+    """
+    Create OpenAI embeddings wrapped in the on-disk embedding cache.
+
+    Args:
+        embedding_model (str): The OpenAI embedding model to use, or "hash-<size>" for the
+            local HashEmbeddings stand-in, which needs no API key.
+        cache_file (str): The SQLite file holding cached vectors.
+        http_client: An optional shared httpx.Client so API connections are pooled.
+        http_async_client: An optional shared httpx.AsyncClient for asynchronous calls.
+        fake_latency (float): Seconds the local stand-in waits per call.
+
+    Returns:
+        CachedEmbeddings: The cached embeddings.
+    """
+    if embedding_model.startswith('hash-'):
+        embeddings = HashEmbeddings(size=int(embedding_model.split('-', 1)[1]), latency=fake_latency)
+    else:
+        from langchain_openai import OpenAIEmbeddings
+
+        # The OpenAI clients are built here because OpenAIEmbeddings would pass one http_client to both
+        clients = {}
+        if http_client is not None:
+            clients['client'] = openai.OpenAI(http_client=http_client).embeddings
+        if http_async_client is not None:
+            clients['async_client'] = openai.AsyncOpenAI(http_client=http_async_client).embeddings
+        embeddings = OpenAIEmbeddings(model=embedding_model, **clients)
+    return CachedEmbeddings(embeddings, model=embedding_model, cache_file=cache_file)
+
+
+def load_index(index_folder=INDEX_FOLDER, embeddings=None, index_type='flat'):
+    """
+    Load a saved FAISS vector store from disk.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+        embeddings: The embeddings used to encode queries. Defaults to cached OpenAI embeddings.
+        index_type (str): 'flat' loads the exact index, which incremental updates modify.
+            Other types load the compressed serving index built by update_index.
+
+    Returns:
+        FAISS: The loaded vector store.
+
+    Raises:
+        FileNotFoundError: If no index has been built in the folder.
+    """
+    if not index_exists(index_folder):
+        raise FileNotFoundError(f"No index found in {index_folder}. Run build_index.py first.")
+
+    if embeddings is None:
+        # Queries must be embedded with the model the index was built with
+        manifest = load_manifest(index_folder)
+        embeddings = create_embeddings(manifest['embedding_model'] if manifest else EMBEDDING_MODEL)
+    if index_type != 'flat':
+        return load_serving_vectorstore(index_folder, embeddings, index_type)
+    return FAISS.load_local(index_folder, embeddings)
+
+
+def build_bm25_index(vectorstore):
+    """
+    Build a BM25 index over every chunk in a FAISS vector store.
+
+    Args:
+        vectorstore (FAISS): The vector store whose chunks to index.
+
+    Returns:
+        BM25Index: The BM25 index, with the docstore ids of the chunks as doc_ids.
+    """
+    doc_ids = list(vectorstore.index_to_docstore_id.values())
+    texts = [vectorstore.docstore.search(doc_id).page_content for doc_id in doc_ids]
+    return BM25Index().fit(texts, doc_ids)
+
+
+def load_bm25_index(index_folder=INDEX_FOLDER):
+    """
+    Load the BM25 index saved next to the vector index.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+
+    Returns:
+        BM25Index: The loaded BM25 index.
+
+    Raises:
+        FileNotFoundError: If no BM25 index has been built in the folder.
+    """
+    bm25_path = os.path.join(index_folder, BM25_FILE)
+    if not os.path.isfile(bm25_path):
+        raise FileNotFoundError(f"No BM25 index found in {index_folder}. Run build_index.py first.")
+    return BM25Index.load(bm25_path)
+
+
+def load_keyword_index(index_folder=INDEX_FOLDER):
+    """
+    Load the TF-IDF keyword index saved next to the vector index.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+
+    Returns:
+        KeywordIndex: The loaded keyword index.
+
+    Raises:
+        FileNotFoundError: If no keyword index has been built in the folder.
+    """
+    keywords_path = os.path.join(index_folder, KEYWORDS_FILE)
+    if not os.path.isfile(keywords_path):
+        raise FileNotFoundError(f"No keyword index found in {index_folder}. Run build_index.py first.")
+    return KeywordIndex.load(keywords_path)
+
+
+def normalize_path(file_path):
+    """
+    Normalize a file path so it matches the keys used in file_titles.csv.
+
+    Args:
+        file_path (str): The file path to normalize.
+
+    Returns:
+        str: The normalized path with forward slashes.
+    """
+    return os.path.normpath(file_path).replace("\\", "/")
+
+
+def load_manifest(index_folder=INDEX_FOLDER):
+    """
+    Load the index manifest, or return None if the index has none.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+
+    Returns:
+        dict or None: The manifest with the indexing parameters and per-file entries.
+    """
+    manifest_path = os.path.join(index_folder, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, mode='r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_index_version(index_folder=INDEX_FOLDER):
+    """
+    Return the version of the saved index, which changes whenever its contents change.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+
+    Returns:
+        str or None: The version recorded in the manifest, or None if there is none.
+    """
+    manifest = load_manifest(index_folder)
+    return manifest.get('version') if manifest is not None else None
+
+
+def save_manifest(manifest, index_folder=INDEX_FOLDER):
+    """
+    Save the index manifest next to the index, replacing any previous one atomically.
+
+    Args:
+        manifest (dict): The manifest to save.
+        index_folder (str): The folder the index was saved to.
+    """
+    os.makedirs(index_folder, exist_ok=True)
+    manifest_path = os.path.join(index_folder, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', mode='w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def update_index(pdf_files, index_folder=INDEX_FOLDER, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                 embedding_model=EMBEDDING_MODEL, rebuild=False, embeddings=None, workers=DEFAULT_WORKERS,
+                 index_type=INDEX_TYPE, file_titles=None, shared=SHARED_INDEX, shards=INDEX_SHARDS,
+                 shard_key=SHARD_KEY):
+    """
+    Bring the saved index in line with the given PDF files, re-embedding only what changed.
+
+    A manifest stored next to the index records, for every indexed file, its size,
+    modification time, content hash and the ids of its vectors. Files whose size and
+    mtime are unchanged are skipped without hashing; files whose content hash is
+    unchanged are skipped without embedding. Changed files have their old vectors
+    replaced, and files that disappeared have their vectors removed. If the chunking
+    parameters or embedding model differ from the manifest, the index is rebuilt.
+
+    Every chunk is stored with the chapter, section and title of its PDF (and its
+    page), so searches can be restricted to parts of the corpus.
+
+    The TF-IDF keyword index is updated from the same chunks, tokenizing only the
+    added ones, so keyword suggestions never re-read a PDF.
+
+    PDFs are parsed and chunked in a pool of worker processes, and finished files
+    are embedded and merged into the index in this process as they arrive.
+
+    Args:
+        pdf_files (list): Paths of the PDF files that should be in the index.
+        index_folder (str): The folder the index is saved to.
+        chunk_size (int): The desired size of each text chunk.
+        chunk_overlap (int): The amount of overlap between consecutive chunks.
+        embedding_model (str): The OpenAI embedding model to encode the chunks with.
+        rebuild (bool): Whether to ignore the existing index and re-embed every file.
+        embeddings: The embeddings to encode the chunks with. Defaults to cached OpenAI embeddings.
+        workers (int): The number of processes used to parse and chunk PDFs.
+        index_type (str): The serving index built from the exact index ('flat', 'fp16', 'sq8',
+            'ivf', 'ivfpq', 'hnsw' or a FAISS factory string). Changing it needs no re-embedding.
+        file_titles (dict): Maps normalized file paths to titles, stored with the chunks.
+        shared (bool): Whether to also publish a memory-mapped snapshot for shared serving.
+        shards (int): The number of shards to split the index into for sharded serving (0 for none).
+        shard_key (str): Whether the shards hold whole 'chapter's or whole 'document's.
+
+    Returns:
+        FAISS or None: The updated vector store, or None if there is nothing to index,
+            in which case the saved index is removed.
+    """
+    params = {
+        'chunk_size': chunk_size,
+        'chunk_overlap': chunk_overlap,
+        'embedding_model': embedding_model,
+    }
+    if embeddings is None:
+        embeddings = create_embeddings(embedding_model)
+
+    manifest = None if rebuild else load_manifest(index_folder)
+    if manifest is not None and (
+        any(manifest.get(key) != value for key, value in params.items()) or not index_exists(index_folder)
+    ):
+        print("Indexing parameters changed, rebuilding the index...")
+        manifest = None
+
+    vectorstore = load_index(index_folder, embeddings) if manifest is not None else None
+    old_entries = manifest['files'] if manifest is not None else {}
+    new_entries = {}
+    to_encode = []
+    file_hashes = {}
+
+    # Decide which files are unchanged, cheapest checks first
+    check_start = time.perf_counter()
+    for pdf_file in pdf_files:
+        key = normalize_path(pdf_file)
+        stat = os.stat(pdf_file)
+        entry = old_entries.get(key)
+
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            new_entries[key] = entry
+            continue
+
+        file_hash = hash_file(pdf_file)
+        if entry is not None and entry['sha256'] == file_hash:
+            new_entries[key] = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+            continue
+
+        new_entries[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash, 'ids': []}
+        to_encode.append(pdf_file)
+        file_hashes[pdf_file] = file_hash
+    observe_stage('check_files', time.perf_counter() - check_start)
+
+    # Remove vectors of deleted files and of files about to be re-embedded
+    encode_keys = {normalize_path(pdf_file) for pdf_file in to_encode}
+    stale_ids = []
+    for key, entry in old_entries.items():
+        if key not in new_entries or key in encode_keys:
+            stale_ids.extend(entry['ids'])
+    if vectorstore is not None and stale_ids:
+        vectorstore.delete(stale_ids)
+
+    from tqdm import tqdm
+
+    file_chunks = iter_pdf_chunks(to_encode, chunk_size, chunk_overlap, workers, file_hashes)
+    progress = tqdm(total=len(to_encode), desc="Processing PDFs")
+    for pdf_file, chunks in file_chunks:
+        if chunks is None:
+            # All chunks of the file are indexed (scanned or empty PDFs have none)
+            progress.update()
+            continue
+
+        metadata = document_metadata(pdf_file, file_titles)
+        for chunk in chunks:
+            chunk.metadata.update(metadata)
+
+        with span('embed_chunks'):
+            batch_vectorstore = FAISS.from_documents(chunks, embeddings)
+        new_entries[normalize_path(pdf_file)]['ids'].extend(batch_vectorstore.index_to_docstore_id.values())
+
+        if vectorstore is None:
+            vectorstore = batch_vectorstore
+        else:
+            vectorstore.merge_from(batch_vectorstore)
+    progress.close()
+
+    if vectorstore is None or vectorstore.index.ntotal == 0:
+        # Every PDF was deleted (or none has text): nothing of the old index may be served any more
+        remove_index(index_folder)
+        print(f"Index removed: no chunks left to index, {len(set(old_entries) - set(new_entries))} files removed.")
+        return None
+
+    bm25_path = os.path.join(index_folder, BM25_FILE)
+    if to_encode or stale_ids or manifest is None or not os.path.isfile(bm25_path):
+        with span('save_index'):
+            save_index(vectorstore, index_folder)
+
+        # Tokenizing is cheap next to embedding, so the keyword index is rebuilt in full
+        with span('bm25_index'):
+            build_bm25_index(vectorstore).save(bm25_path + '.tmp')
+            os.replace(bm25_path + '.tmp', bm25_path)
+    index_changed = to_encode or stale_ids or manifest is None
+    keywords_path = os.path.join(index_folder, KEYWORDS_FILE)
+    if index_changed or not os.path.isfile(keywords_path):
+        with span('keyword_index'):
+            _, added, removed = update_keyword_index(vectorstore, keywords_path, rebuild=manifest is None)
+        print(f"Keyword index: {added} chunks added, {removed} removed.")
+    # Compressed serving indexes are retrained from the exact vectors whenever they change
+    if index_changed or manifest.get('index_type', 'flat') != index_type:
+        if index_type != 'flat':
+            print(f"Building the {index_type} serving index...")
+        with span('serving_index'):
+            save_serving_index(vectorstore, index_folder, index_type)
+
+    # The version identifies the indexed contents, so caches can tell when answers went stale
+    version = hashlib.sha256(json.dumps(
+        [params, sorted((key, entry['sha256']) for key, entry in new_entries.items())]
+    ).encode('utf-8')).hexdigest()[:16]
+    save_manifest(dict(params, version=version, index_type=index_type, files=new_entries), index_folder)
+
+    # Serving workers switch to a new snapshot once it is published
+    if shared and current_snapshot(index_folder) != snapshot_name(version, index_type):
+        print("Publishing the shared index snapshot...")
+        with span('shared_snapshot'):
+            export_shared_index(vectorstore, load_bm25_index(index_folder), index_folder, version, index_type)
+
+    # Shards are rebuilt when the contents or the layout change, moving as few chunks as possible
+    shards_info = load_shards_info(index_folder)
+    layout = {'version': version, 'n_shards': shards, 'key': shard_key, 'index_type': index_type}
+    if shards > 0 and (shards_info is None or any(shards_info[key] != value for key, value in layout.items())):
+        print(f"Building {shards} index shards...")
+        with span('build_shards'):
+            shards_info = build_shards(vectorstore, index_folder, shards, version, shard_key, index_type)
+        print(f"Shard sizes: {shards_info['sizes']} chunks, {len(shards_info['moved'])} groups "
+              f"({shards_info['moved_chunks']} chunks) moved between shards.")
+
+    print(f"Index updated: {len(to_encode)} files embedded, "
+          f"{len(set(old_entries) - set(new_entries))} removed, "
+          f"{len(new_entries) - len(to_encode)} unchanged.")
+    if isinstance(embeddings, CachedEmbeddings):
+        print(f"Embedding cache: {embeddings.stats()}")
+    return vectorstore
+
+
+def build_index(pdf_files, index_folder=INDEX_FOLDER, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                embeddings=None, file_titles=None):
+    """
+    Encode all PDF files into a single FAISS vector store and save it to disk.
+
+    Args:
+        pdf_files (list): Paths of the PDF files to encode.
+        index_folder (str): The folder to save the index to.
+        chunk_size (int): The desired size of each text chunk.
+        chunk_overlap (int): The amount of overlap between consecutive chunks.
+        embeddings: The embeddings to encode the chunks with. Defaults to cached OpenAI embeddings.
+        file_titles (dict): Maps normalized file paths to titles, stored with the chunks.
+
+    Returns:
+        FAISS: The merged vector store.
+
+    Raises:
+        ValueError: If no PDF files are given.
+    """
+    if not pdf_files:
+        raise ValueError("No PDF files to index.")
+
+    return update_index(pdf_files, index_folder, chunk_size, chunk_overlap, rebuild=True, embeddings=embeddings,
+                        file_titles=file_titles)
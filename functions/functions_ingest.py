@@ -0,0 +1,105 @@
+import os
+import time
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+
+from functions.functions_metrics import observe_stage
+from functions.functions_rag import load_and_split_pdf
+
+# Number of processes used to parse and chunk PDFs
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Seconds between checks that no worker process died while the parent waits for chunks
+WORKER_CHECK_INTERVAL = 1.0
+
+
+def _timed_batches(pdf_file, chunk_size, chunk_overlap, file_hash, seconds):
+    # The chunk batches of a file; seconds[0] adds up the time spent parsing, not waiting for the consumer
+    batches = load_and_split_pdf(pdf_file, chunk_size, chunk_overlap, file_hash)
+    while True:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        seconds[0] += time.perf_counter() - start
+        if batch is None:
+            return
+        yield batch
+
+
+def _load_and_split_to_queue(position, pdf_file, chunk_size, chunk_overlap, file_hash, batches):
+    # Runs in a worker process, whose metrics are not collected: the duration goes back as the result
+    seconds = [0.0]
+    try:
+        for batch in _timed_batches(pdf_file, chunk_size, chunk_overlap, file_hash, seconds):
+            batches.put((position, batch))
+    finally:
+        # Marks the file as done, also when parsing failed (the parent then raises the error)
+        batches.put((position, None))
+    return seconds[0]
+
+
+def iter_pdf_chunks(pdf_files, chunk_size=1000, chunk_overlap=200, workers=DEFAULT_WORKERS, file_hashes=None):
+    """
+    Parse and chunk PDFs in a process pool, yielding batches of chunks as soon as they are split.
+
+    Parsing is CPU-bound, so it runs in worker processes while the caller consumes
+    the batches (e.g. embeds and indexes them) in the main process. Each worker
+    parses one file at a time and sends its chunks a few pages at a time through a
+    bounded queue, so neither a large PDF nor a slow consumer makes memory grow.
+    Batches of different files are interleaved. The parsing time of each file is
+    recorded as the load_and_split_pdf stage in this process.
+
+    Args:
+        pdf_files (list): Paths of the PDF files to parse.
+        chunk_size (int): The desired size of each text chunk.
+        chunk_overlap (int): The amount of overlap between consecutive chunks.
+        workers (int): The number of worker processes. 1 parses in the calling process.
+        file_hashes (dict): Maps paths to content hashes already computed by the caller,
+            used to find the page text cached by check_dataset.py.
+
+    Yields:
+        tuple: The PDF path and a list of its document chunks. Once all its chunks
+            were yielded, the path is yielded with None.
+    """
+    file_hashes = file_hashes or {}
+    if workers <= 1:
+        for pdf_file in pdf_files:
+            seconds = [0.0]
+            for batch in _timed_batches(pdf_file, chunk_size, chunk_overlap, file_hashes.get(pdf_file), seconds):
+                yield pdf_file, batch
+            observe_stage('load_and_split_pdf', seconds[0])
+            yield pdf_file, None
+        return
+
+    pdf_files = list(pdf_files)
+    pending_files = iter(enumerate(pdf_files))
+    # The manager is shut down first, so workers blocked on a full queue stop if the caller stops early
+    with ProcessPoolExecutor(max_workers=workers) as executor, Manager() as manager:
+        batches = manager.Queue(maxsize=workers * 2)
+        futures = {}
+
+        def submit_next():
+            position, pdf_file = next(pending_files, (None, None))
+            if pdf_file is not None:
+                futures[position] = executor.submit(_load_and_split_to_queue, position, pdf_file, chunk_size,
+                                                    chunk_overlap, file_hashes.get(pdf_file), batches)
+
+        for _ in range(workers):
+            submit_next()
+
+        while futures:
+            try:
+                position, batch = batches.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                # A worker process that crashed never marks its file as done
+                for future in futures.values():
+                    if future.done() and future.exception() is not None:
+                        future.result()
+                continue
+            if batch is not None:
+                yield pdf_files[position], batch
+                continue
+            future = futures.pop(position)
+            submit_next()
+            observe_stage('load_and_split_pdf', future.result())
+            yield pdf_files[position], None
@@ -0,0 +1,423 @@
+import os
+import re
+import json
+import bisect
+
+import numpy as np
+from scipy import sparse
+
+from functions.functions_bm25 import top_k_indices
+
+# Number of query expansion terms added to the BM25 query before retrieval (0 disables expansion)
+QUERY_EXPANSION_TERMS = int(os.getenv("QUERY_EXPANSION_TERMS", 0))
+
+# Keywords precomputed per document, the most a /keywords request can return
+KEYWORDS_TOP_N = int(os.getenv("KEYWORDS_TOP_N", 50))
+
+# Two-word phrases must appear in this many chunks to be suggested or used as keywords
+MIN_PHRASE_DF = 2
+
+# Chunks whose terms are used to expand a query (pseudo-relevance feedback)
+EXPANSION_FEEDBACK = 10
+
+# Words of keyword terms: lowercase letters, digits, dots and hyphens ("50.55a", "pre-service")
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9.\-]*[a-z0-9]")
+LETTER_PATTERN = re.compile(r"[a-z]")
+MIN_WORD_LENGTH = 3
+MAX_WORD_LENGTH = 30
+
+STOPWORDS = frozenset("""
+a about above after again against all also an and any are as at be because been before being below between
+both but by can could did do does doing down during e.g each either etc few for from further had has have
+having here how however i.e if in into is it its itself may might more most must no nor not of off on once
+only or other our out over own per same shall should since so some such than that the their them then there
+these they this those through thus to too under until upon very via was were what when where whether which
+while who whom why will with within without would yet
+""".split())
+
+
+def keyword_terms(text):
+    """
+    Split text into the terms of the keyword index: words and two-word phrases.
+
+    Words are lowercased, and stopwords, numbers and very short or long words are
+    dropped. Phrases are only formed from words that are adjacent in the text.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        List[str]: The words followed by the phrases, with repetitions.
+    """
+    words = [
+        word if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH and word not in STOPWORDS
+        and LETTER_PATTERN.search(word) else None
+        for word in TOKEN_PATTERN.findall(text.lower())
+    ]
+    terms = [word for word in words if word is not None]
+    terms.extend(f"{first} {second}" for first, second in zip(words, words[1:]) if first and second)
+    return terms
+
+
+def normalize_source(source):
+    # Document keys match the file paths of get_references and file_titles.csv
+    return os.path.normpath(source).replace("\\", "/")
+
+
+class KeywordIndex:
+    """
+    TF-IDF keyword index over the chunks of the vector store.
+
+    Term counts are kept in a chunk-by-term CSR matrix, so an update only tokenizes
+    the chunks that were added and drops the rows of removed ones. The TF-IDF
+    weights (sublinear tf, L2-normalized rows), the top keywords of
+    every document and a sorted vocabulary for prefix lookups are derived from the
+    counts after each update, so serving needs no tokenizing of the corpus.
+
+    Attributes:
+        terms (list): The terms, in column order.
+        vocabulary (dict): Maps each term to its column.
+        counts (sparse.csr_matrix): Chunk-by-term counts.
+        tfidf (sparse.csr_matrix): Chunk-by-term TF-IDF weights, with the structure of counts.
+        doc_ids (list): The docstore id of each chunk.
+        sources (np.ndarray): The document of each chunk, as a position in documents.
+        documents (list): The normalized file paths of the documents.
+        term_weights (np.ndarray): The mean TF-IDF weight of each term over all chunks, which
+            ranks the corpus keywords (0 for phrases in fewer than min_phrase_df chunks).
+        suggestion_weights (np.ndarray): The number of chunks holding each term, which ranks
+            suggestions (0 for phrases in fewer than min_phrase_df chunks).
+    """
+
+    def __init__(self, top_n=KEYWORDS_TOP_N, min_phrase_df=MIN_PHRASE_DF):
+        self.top_n = top_n
+        self.min_phrase_df = min_phrase_df
+        self.terms = []
+        self.vocabulary = {}
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.uint16)
+        self.tfidf = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self.doc_ids = []
+        self.sources = np.zeros(0, dtype=np.int32)
+        self.documents = []
+        self.term_weights = np.zeros(0, dtype=np.float32)
+        self.suggestion_weights = np.zeros(0, dtype=np.int32)
+        self.document_terms = np.zeros((0, top_n), dtype=np.int32)
+        self.document_scores = np.zeros((0, top_n), dtype=np.float32)
+        self.sorted_order = np.zeros(0, dtype=np.int32)
+        self._sorted_terms = []
+        self._document_rows = {}
+        self._postings = None
+
+    def update(self, vectorstore):
+        """
+        Bring the index in line with the chunks of a vector store.
+
+        Rows of chunks no longer in the store are dropped and only new chunks are
+        tokenized, then the weights and keywords are recomputed from the counts.
+
+        Args:
+            vectorstore (FAISS): The vector store whose chunks to index.
+
+        Returns:
+            tuple: The numbers of chunks added and removed.
+        """
+        store_ids = list(vectorstore.index_to_docstore_id.values())
+        current = set(store_ids)
+        keep = np.array([doc_id in current for doc_id in self.doc_ids], dtype=bool)
+        removed = int(len(keep) - keep.sum())
+        if removed:
+            self.counts = self.counts[np.flatnonzero(keep)]
+            self.sources = self.sources[keep]
+            self.doc_ids = [doc_id for doc_id, kept in zip(self.doc_ids, keep) if kept]
+
+        indexed = set(self.doc_ids)
+        added_ids = [doc_id for doc_id in store_ids if doc_id not in indexed]
+        if added_ids:
+            self._add_chunks(added_ids, [vectorstore.docstore.search(doc_id) for doc_id in added_ids])
+        if added_ids or removed or not self.terms:
+            self._compute_weights()
+        return len(added_ids), removed
+
+    def _add_chunks(self, doc_ids, docs):
+        rows, cols = [], []
+        document_positions = {document: position for position, document in enumerate(self.documents)}
+        sources = np.empty(len(docs), dtype=np.int32)
+        for row, doc in enumerate(docs):
+            for term in keyword_terms(doc.page_content):
+                column = self.vocabulary.get(term)
+                if column is None:
+                    column = self.vocabulary[term] = len(self.terms)
+                    self.terms.append(term)
+                rows.append(row)
+                cols.append(column)
+            source = normalize_source(doc.metadata.get('source', ''))
+            if source not in document_positions:
+                document_positions[source] = len(self.documents)
+                self.documents.append(source)
+            sources[row] = document_positions[source]
+
+        # Duplicate (chunk, term) entries are summed into counts
+        counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                   shape=(len(docs), len(self.terms)))
+        counts.sum_duplicates()
+        counts.data = np.minimum(counts.data, np.iinfo(np.uint16).max)
+        previous = self.counts
+        previous.resize((previous.shape[0], len(self.terms)))
+        self.counts = sparse.vstack([previous, counts.astype(np.uint16)], format='csr')
+        self.sources = np.concatenate([self.sources, sources])
+        self.doc_ids.extend(doc_ids)
+
+    def _compute_weights(self):
+        # Drop terms and documents that no chunk holds any more
+        n_chunks = self.counts.shape[0]
+        doc_freqs = np.bincount(self.counts.indices, minlength=len(self.terms))
+        if not doc_freqs.all():
+            kept = np.flatnonzero(doc_freqs)
+            columns = np.full(len(self.terms), -1, dtype=np.int32)
+            columns[kept] = np.arange(len(kept), dtype=np.int32)
+            self.counts = sparse.csr_matrix((self.counts.data, columns[self.counts.indices], self.counts.indptr),
+                                            shape=(n_chunks, len(kept)))
+            self.terms = [self.terms[column] for column in kept]
+            doc_freqs = doc_freqs[kept]
+        used = np.unique(self.sources)
+        if len(used) < len(self.documents):
+            positions = np.zeros(len(self.documents), dtype=np.int32)
+            positions[used] = np.arange(len(used), dtype=np.int32)
+            self.sources = positions[self.sources]
+            self.documents = [self.documents[position] for position in used]
+
+        # Terms found in every chunk say nothing about any of them, so their idf is 0
+        idf = np.log((1 + n_chunks) / (1 + doc_freqs))
+        weights = ((1 + np.log(self.counts.data.astype(np.float32))) * idf[self.counts.indices]).astype(np.float32)
+        self.tfidf = sparse.csr_matrix((weights, self.counts.indices, self.counts.indptr), shape=self.counts.shape)
+        row_norms = np.sqrt(np.asarray(self.tfidf.multiply(self.tfidf).sum(axis=1)).ravel())
+        row_norms[row_norms == 0] = 1
+        self.tfidf.data /= np.repeat(row_norms, np.diff(self.counts.indptr)).astype(np.float32)
+
+        # Rare phrases are mostly accidents of the text, so they are never suggested
+        is_phrase = np.array([' ' in term for term in self.terms], dtype=bool)
+        usable = ~is_phrase | (doc_freqs >= self.min_phrase_df)
+        self.term_weights = np.asarray(self.tfidf.sum(axis=0)).ravel().astype(np.float32) / max(n_chunks, 1)
+        self.term_weights[~usable] = 0
+        self.suggestion_weights = np.where(usable, doc_freqs, 0).astype(np.int32)
+
+        # Mean TF-IDF of each term over the chunks of each document
+        membership = sparse.csr_matrix((np.ones(n_chunks, dtype=np.float32), (self.sources, np.arange(n_chunks))),
+                                       shape=(len(self.documents), n_chunks))
+        document_weights = (membership @ self.tfidf).tocsr()
+        chunks_per_document = np.maximum(np.bincount(self.sources, minlength=len(self.documents)), 1)
+        self.document_terms = np.full((len(self.documents), self.top_n), -1, dtype=np.int32)
+        self.document_scores = np.zeros((len(self.documents), self.top_n), dtype=np.float32)
+        for document in range(len(self.documents)):
+            start, end = document_weights.indptr[document], document_weights.indptr[document + 1]
+            columns = document_weights.indices[start:end]
+            scores = document_weights.data[start:end] * usable[columns]
+            best = top_k_indices(scores, self.top_n)
+            best = best[scores[best] > 0]
+            self.document_terms[document, :len(best)] = columns[best]
+            self.document_scores[document, :len(best)] = scores[best] / chunks_per_document[document]
+
+        self.sorted_order = np.array(sorted(range(len(self.terms)), key=self.terms.__getitem__), dtype=np.int32)
+        self._prepare()
+
+    def _prepare(self):
+        # Lookup structures rebuilt after loading
+        self.vocabulary = {term: column for column, term in enumerate(self.terms)}
+        self._sorted_terms = [self.terms[column] for column in self.sorted_order]
+        self._document_rows = {document: position for position, document in enumerate(self.documents)}
+        self._postings = None
+
+    def keywords(self, document=None, n=10):
+        """
+        Return the top keywords of a document, or of the whole corpus.
+
+        Args:
+            document (str): The file path of the document, or None for the corpus.
+            n (int): The number of keywords to return (at most top_n for a document).
+
+        Returns:
+            list or None: (term, score) tuples, best first, or None if the document is not indexed.
+        """
+        if document is None:
+            best = top_k_indices(self.term_weights, n)
+            return [(self.terms[column], float(self.term_weights[column]))
+                    for column in best if self.term_weights[column] > 0]
+
+        position = self._document_rows.get(normalize_source(document))
+        if position is None:
+            return None
+        return [(self.terms[column], float(score))
+                for column, score in zip(self.document_terms[position, :n], self.document_scores[position, :n])
+                if column >= 0]
+
+    def _complete(self, prefix, n):
+        # The n highest weighted terms starting with prefix, from a binary search of the sorted vocabulary
+        start = bisect.bisect_left(self._sorted_terms, prefix)
+        end = bisect.bisect_left(self._sorted_terms, prefix + '\U0010ffff', start)
+        columns = self.sorted_order[start:end]
+        weights = self.suggestion_weights[columns]
+        return [self.terms[columns[i]] for i in top_k_indices(weights, n) if weights[i] > 0]
+
+    def suggest(self, text, n=8):
+        """
+        Suggest completions of a partially typed query.
+
+        The last word is completed from the vocabulary. Phrases that continue the
+        previous word come first; a trailing space suggests the next word.
+
+        Args:
+            text (str): The query typed so far.
+            n (int): The number of suggestions to return.
+
+        Returns:
+            List[str]: The completed queries, best first.
+        """
+        words = text.lower().split()
+        if not words:
+            return []
+        if text[-1:].isspace():
+            head, prefix = words, ''
+        else:
+            head, prefix = words[:-1], words[-1]
+
+        suggestions = []
+        if head:
+            suggestions.extend(" ".join(head[:-1] + [term]) for term in self._complete(f"{head[-1]} {prefix}", n))
+        if prefix:
+            suggestions.extend(" ".join(head + [term]) for term in self._complete(prefix, n))
+        return list(dict.fromkeys(suggestions))[:n]
+
+    def expansion_terms(self, question, n=3, feedback=EXPANSION_FEEDBACK):
+        """
+        Find terms related to a question by pseudo-relevance feedback.
+
+        The feedback chunks richest in the question's terms are summed, and their
+        highest weighted words that the question does not already contain are returned.
+
+        Args:
+            question (str): The question to expand.
+            n (int): The number of terms to return.
+            feedback (int): The number of chunks the terms are taken from.
+
+        Returns:
+            List[str]: The expansion words, best first.
+        """
+        query_terms = set(keyword_terms(question))
+        columns = [self.vocabulary[term] for term in query_terms if term in self.vocabulary]
+        if not columns or n <= 0:
+            return []
+        if self._postings is None:
+            # Term-by-chunk weights, so a query only reads the postings of its terms
+            self._postings = self.tfidf.T.tocsr()
+
+        scores = np.asarray(self._postings[columns].sum(axis=0)).ravel()
+        chunks = self.tfidf[top_k_indices(scores, feedback)]
+        candidates, positions = np.unique(chunks.indices, return_inverse=True)
+        totals = np.bincount(positions, weights=chunks.data, minlength=len(candidates))
+        totals *= self.suggestion_weights[candidates] > 0
+
+        # Phrases rank the feedback chunks, but only words are added, as BM25 matches words
+        expansion = []
+        for i in top_k_indices(totals, len(totals)):
+            term = self.terms[candidates[i]]
+            if totals[i] <= 0 or len(expansion) == n:
+                break
+            if ' ' not in term and term not in query_terms:
+                expansion.append(term)
+        return expansion
+
+    def expand_query(self, question, n=QUERY_EXPANSION_TERMS):
+        """
+        Append the expansion terms of a question to it.
+
+        Args:
+            question (str): The question to expand.
+            n (int): The number of terms to add.
+
+        Returns:
+            str: The question followed by its expansion terms.
+        """
+        terms = self.expansion_terms(question, n)
+        return " ".join([question] + terms) if terms else question
+
+    def save(self, path):
+        """
+        Save the index to a single .npz file.
+
+        Args:
+            path (str): The file to write.
+        """
+        params = {'top_n': self.top_n, 'min_phrase_df': self.min_phrase_df}
+        # Term lists are stored as UTF-8 JSON, a quarter of the size of a NumPy string array
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                counts=self.counts.data,
+                weights=self.tfidf.data,
+                indices=self.counts.indices,
+                indptr=self.counts.indptr,
+                shape=np.array(self.counts.shape),
+                terms=np.array(json.dumps(self.terms).encode('utf-8')),
+                doc_ids=np.array(json.dumps(self.doc_ids).encode('utf-8')),
+                sources=self.sources,
+                documents=np.array(json.dumps(self.documents).encode('utf-8')),
+                term_weights=self.term_weights,
+                suggestion_weights=self.suggestion_weights,
+                document_terms=self.document_terms,
+                document_scores=self.document_scores,
+                sorted_order=self.sorted_order,
+                params=np.array(json.dumps(params)),
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save().
+
+        Args:
+            path (str): The .npz file to read.
+
+        Returns:
+            KeywordIndex: The loaded index.
+        """
+        with np.load(path) as data:
+            index = cls(**json.loads(str(data['params'])))
+            shape = tuple(data['shape'])
+            index.counts = sparse.csr_matrix((data['counts'], data['indices'], data['indptr']), shape=shape)
+            index.tfidf = sparse.csr_matrix((data['weights'], index.counts.indices, index.counts.indptr), shape=shape)
+            index.terms = json.loads(data['terms'].item())
+            index.doc_ids = json.loads(data['doc_ids'].item())
+            index.sources = data['sources']
+            index.documents = json.loads(data['documents'].item())
+            index.term_weights = data['term_weights']
+            index.suggestion_weights = data['suggestion_weights']
+            index.document_terms = data['document_terms']
+            index.document_scores = data['document_scores']
+            index.sorted_order = data['sorted_order']
+        index._prepare()
+        return index
+
+
+def update_keyword_index(vectorstore, path, rebuild=False, top_n=KEYWORDS_TOP_N):
+    """
+    Update the keyword index saved at path with the chunks of a vector store.
+
+    The saved index is updated in place (only new chunks are tokenized) unless
+    rebuild is set, it does not exist or it was built with other parameters.
+    The file is replaced atomically.
+
+    Args:
+        vectorstore (FAISS): The vector store whose chunks to index.
+        path (str): The .npz file of the keyword index.
+        rebuild (bool): Whether to ignore the saved index.
+        top_n (int): The number of keywords precomputed per document.
+
+    Returns:
+        tuple: The updated KeywordIndex and the numbers of chunks added and removed.
+    """
+    index = KeywordIndex.load(path) if not rebuild and os.path.isfile(path) else None
+    if index is None or index.top_n != top_n or index.min_phrase_df != MIN_PHRASE_DF:
+        index = KeywordIndex(top_n)
+    added, removed = index.update(vectorstore)
+    index.save(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return index, added, removed
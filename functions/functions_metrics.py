@@ -0,0 +1,293 @@
+import os
+import time
+import bisect
+import asyncio
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Record stage timings and prompt sizes for /metrics (off by default, then spans cost one check)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+
+# Add a Server-Timing header with the stage timings to every response
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+
+# Histogram buckets: seconds for stage latencies, counts for prompt and answer sizes and for batches
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Histogram:
+    """
+    Thread-safe Prometheus-style histogram with one series per label value.
+    """
+
+    def __init__(self, name, documentation, buckets, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        """
+        Record one observation.
+
+        Args:
+            value (float): The observed value.
+            label_value (str): The value of the histogram's label, e.g. the stage name.
+        """
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        """
+        Render the histogram in the Prometheus text exposition format.
+
+        Returns:
+            list: The lines of the histogram.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_value: (list(counts), total, count)
+                      for label_value, (counts, total, count) in self._series.items()}
+
+        for label_value, (counts, total, count) in sorted(series.items(), key=lambda item: str(item[0])):
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {cumulative}')
+            plain_labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{plain_labels} {total}")
+            lines.append(f"{self.name}_count{plain_labels} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Time spent in each stage of answering a question.",
+                          LATENCY_BUCKETS, label="stage")
+PROMPT_CHARACTERS = Histogram("rag_prompt_characters", "Characters of question and context sent to the LLM.",
+                              SIZE_BUCKETS)
+PROMPT_TOKENS = Histogram("rag_prompt_tokens", "Tokens of question and context sent to the LLM.", SIZE_BUCKETS)
+ANSWER_TOKENS = Histogram("rag_answer_tokens", "Tokens of the generated answers.", SIZE_BUCKETS)
+CONTEXT_TOKENS_SAVED = Histogram("rag_context_tokens_saved",
+                                 "Context tokens saved by merging overlapping chunks and the token budget.",
+                                 SIZE_BUCKETS)
+COALESCED_QUERIES = Histogram("rag_coalesced_queries", "Questions embedded and searched together in one batch.",
+                              BATCH_BUCKETS)
+
+HISTOGRAMS = [STAGE_SECONDS, PROMPT_CHARACTERS, PROMPT_TOKENS, ANSWER_TOKENS, CONTEXT_TOKENS_SAVED,
+              COALESCED_QUERIES]
+
+# Stage timings of the current request, collected for the Server-Timing header
+_request_spans = contextvars.ContextVar('request_spans', default=None)
+
+_encoding = None
+
+
+def observe_stage(stage, seconds):
+    """
+    Record the duration of a stage in the stage histogram and in the current request's spans.
+
+    Args:
+        stage (str): The stage name.
+        seconds (float): The duration.
+    """
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage)
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """
+    Time the enclosed block as a stage.
+
+    Args:
+        stage (str): The stage name.
+    """
+    if not METRICS_ENABLED and _request_spans.get() is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    """
+    Decorator that times every call of a function (or coroutine function) as a stage.
+
+    Args:
+        stage (str): The stage name.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_request_context(func, *args):
+    """
+    Bind a call to a copy of the current context, to run it in an executor thread.
+
+    Executor threads do not inherit context variables, so the stages recorded by
+    the call would otherwise be missing from the current request's spans.
+
+    Args:
+        func (callable): The function to call.
+        *args: Its arguments.
+
+    Returns:
+        callable: A function without arguments that calls func(*args) in the copied context.
+    """
+    return functools.partial(contextvars.copy_context().run, func, *args)
+
+
+def count_tokens(text):
+    """
+    Count the tokens of a text with the cl100k_base encoding of GPT-4 and ada-002.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The number of tokens, or an estimate of 4 characters per token without tiktoken.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def observe_prompt(question, context, answer=None):
+    """
+    Record the size of a prompt (question and context) and, if given, of its answer.
+
+    Args:
+        question (str): The question.
+        context (str): The retrieved context.
+        answer (str): The generated answer.
+    """
+    if not METRICS_ENABLED:
+        return
+    PROMPT_CHARACTERS.observe(len(question) + len(context))
+    PROMPT_TOKENS.observe(count_tokens(question) + count_tokens(context))
+    if answer is not None:
+        ANSWER_TOKENS.observe(count_tokens(answer))
+
+
+def observe_context(stats):
+    """
+    Record the tokens saved when assembling a context.
+
+    Args:
+        stats (dict): The statistics returned by assemble_context.
+    """
+    if METRICS_ENABLED:
+        CONTEXT_TOKENS_SAVED.observe(stats['tokens_saved'])
+
+
+def observe_batch(size):
+    """
+    Record the number of questions of a coalesced batch.
+
+    Args:
+        size (int): The number of questions in the batch.
+    """
+    if METRICS_ENABLED:
+        COALESCED_QUERIES.observe(size)
+
+
+def observe_timings(timings, prefix):
+    """
+    Record a dict of stage timings, e.g. the timings returned by the retriever.
+
+    Args:
+        timings (dict): Maps stage names to seconds.
+        prefix (str): Prefix of the recorded stage names.
+    """
+    for stage, seconds in timings.items():
+        observe_stage(f"{prefix}_{stage}", seconds)
+
+
+def start_request_spans():
+    """
+    Start collecting the stage timings of the current request, if the timing header is on.
+
+    Returns:
+        A token for stop_request_spans, or None if the timing header is off.
+    """
+    return _request_spans.set([]) if TIMING_HEADER else None
+
+
+def stop_request_spans(token):
+    """
+    Stop collecting stage timings and format them as a Server-Timing header value.
+
+    Args:
+        token: The token returned by start_request_spans.
+
+    Returns:
+        str or None: The header value, or None if no timings were collected.
+    """
+    if token is None:
+        return None
+    spans = _request_spans.get()
+    _request_spans.reset(token)
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans) or None
+
+
+def stage_totals():
+    """
+    Return the number of observations and the total seconds of every recorded stage.
+
+    Returns:
+        dict: Maps stage names to (count, seconds).
+    """
+    with STAGE_SECONDS._lock:
+        return {stage: (count, total) for stage, (_, total, count) in STAGE_SECONDS._series.items()}
+
+
+def render_metrics():
+    """
+    Render all histograms in the Prometheus text exposition format.
+
+    Returns:
+        str: The /metrics response body.
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
@@ -1,23 +1,33 @@
 from dotenv import load_dotenv
-from typing import List
-from deepeval.test_case import LLMTestCase
+from typing import List, TYPE_CHECKING
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 from pydantic import BaseModel, Field
 from langchain import PromptTemplate
+import openai
 from openai import RateLimitError
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
 
-from rank_bm25 import BM25Okapi
+from functions.functions_bm25 import BM25Index, top_k_indices
+from functions.functions_text_cache import iter_pdf_text, TEXT_CACHE_FOLDER
+from functions.functions_metrics import timed
 
-import fitz
 import asyncio
+import functools
 import random
+import time
 import textwrap
 import numpy as np
 
+# Parsing (PyMuPDF, the text splitter), vector store building and evaluation (deepeval) libraries
+# are imported by the functions that use them, so serving from a prebuilt index does not load them
+if TYPE_CHECKING:
+    from deepeval.test_case import LLMTestCase
+
+# Pages whose chunks load_and_split_pdf yields together, which bounds the chunks held while indexing
+SPLIT_BATCH_PAGES = 16
+
 
 def replace_t_with_space(list_of_documents):
     """
@@ -48,7 +58,7 @@ def text_wrap(text, width=120):
     """
     return textwrap.fill(text, width=width)
 
-def encode_from_string(content, chunk_size=1000, chunk_overlap=200):
+def encode_from_string(content, chunk_size=1000, chunk_overlap=200, embeddings=None):
     """
     Encodes a string into a vector store using OpenAI embeddings.
 
@@ -56,6 +66,7 @@ def encode_from_string(content, chunk_size=1000, chunk_overlap=200):
         content (str): The text content to be encoded.
         chunk_size (int): The size of each chunk of text.
         chunk_overlap (int): The overlap between chunks.
+        embeddings: The embeddings to encode the chunks with. Defaults to OpenAIEmbeddings.
 
     Returns:
         FAISS: A vector store containing the encoded content.
@@ -74,6 +85,9 @@ def encode_from_string(content, chunk_size=1000, chunk_overlap=200):
     if not isinstance(chunk_overlap, int) or chunk_overlap < 0:
         raise ValueError("chunk_overlap must be a non-negative integer.")
 
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_community.vectorstores import FAISS
+
     try:
         # Split the content into chunks
         text_splitter = RecursiveCharacterTextSplitter(
@@ -89,7 +103,9 @@ def encode_from_string(content, chunk_size=1000, chunk_overlap=200):
             chunk.metadata['relevance_score'] = 1.0
 
         # Generate embeddings and create the vector store
-        embeddings = OpenAIEmbeddings()
+        if embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+            embeddings = OpenAIEmbeddings()
         vectorstore = FAISS.from_documents(chunks, embeddings)
 
     except Exception as e:
@@ -116,6 +132,99 @@ def retrieve_context_per_question(question, chunks_query_retriever):
 
 
 
+# Model name that selects a local fake chat model instead of calling OpenAI
+FAKE_LLM_MODEL = "fake"
+
+
+@functools.lru_cache(maxsize=None)
+def _fake_chat_model_class():
+    # Built from langchain_core on first use: langchain_community.chat_models (which has a fake
+    # chat model) imports every chat model integration, which would cost every cold start
+    from langchain_core.language_models.chat_models import SimpleChatModel
+    from langchain_core.messages import AIMessageChunk
+    from langchain_core.outputs import ChatGenerationChunk
+
+    class FakeChatModel(SimpleChatModel):
+        """
+        Local fake chat model that cycles through canned responses.
+
+        It waits latency seconds per call to mimic an API round trip, and sleep seconds
+        between streamed tokens. The asynchronous path waits with asyncio.sleep, so
+        concurrent requests do not block each other.
+        """
+
+        responses: List[str]
+        sleep: float = 0.0
+        latency: float = 0.0
+        i: int = 0
+
+        @property
+        def _llm_type(self):
+            return "fake-chat-model"
+
+        def _next_response(self):
+            response = self.responses[self.i]
+            self.i = (self.i + 1) % len(self.responses)
+            return response
+
+        def _call(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            return self._next_response()
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._next_response()))])
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            for token in self._next_response():
+                time.sleep(self.sleep)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(self.latency)
+            for token in self._next_response():
+                await asyncio.sleep(self.sleep)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    return FakeChatModel
+
+
+def create_llm(model_name="gpt-4", max_tokens=2000, fake_token_delay=0.01, http_client=None,
+               http_async_client=None, fake_latency=0.0):
+    """
+    Creates the chat model used to answer questions.
+
+    Args:
+        model_name (str): The OpenAI chat model, or "fake" for a local stand-in that needs no API key.
+        max_tokens (int): The maximum number of tokens to generate.
+        fake_token_delay (float): Seconds the fake model waits between streamed tokens.
+        http_client: An optional shared httpx.Client so API connections are pooled across requests.
+        http_async_client: An optional shared httpx.AsyncClient for asynchronous calls.
+        fake_latency (float): Seconds the fake model waits before answering.
+
+    Returns:
+        The chat model.
+    """
+    if model_name == FAKE_LLM_MODEL:
+        return _fake_chat_model_class()(
+            responses=["This answer was generated by the local fake model from the retrieved context."],
+            sleep=fake_token_delay,
+            latency=fake_latency,
+        )
+
+    # Not langchain_community.chat_models, whose package imports every chat model integration
+    from langchain_openai import ChatOpenAI
+
+    # The OpenAI clients are built here because ChatOpenAI would pass one http_client to both of them
+    clients = {}
+    if http_client is not None:
+        clients['client'] = openai.OpenAI(http_client=http_client).chat.completions
+    if http_async_client is not None:
+        clients['async_client'] = openai.AsyncOpenAI(http_client=http_async_client).chat.completions
+    return ChatOpenAI(temperature=0, model_name=model_name, max_tokens=max_tokens, **clients)
+
+
 class QuestionAnswerFromContext(BaseModel):
     """
     Model to generate an answer to a query based on a given context.
@@ -149,6 +258,7 @@ def create_question_answer_from_context_chain(llm):
     return question_answer_from_context_cot_chain
 
 
+@timed('answer_question_from_context')
 def answer_question_from_context(question, context, question_answer_from_context_chain):
     """
     Answer a question using the given context by invoking a chain of reasoning.
@@ -173,6 +283,87 @@ def answer_question_from_context(question, context, question_answer_from_context
     return {"answer": answer, "context": context, "question": question}
 
 
+def stream_answer_question_from_context(question, context, question_answer_from_context_chain):
+    """
+    Answer a question using the given context, yielding the answer as it is generated.
+
+    Args:
+        question: The question to be answered.
+        context: The context to be used for answering the question.
+
+    Yields:
+        str: The next piece of the answer text.
+    """
+    input_data = {
+        "question": question,
+        "context": context
+    }
+    print("Streaming the answer from the retrieved context...")
+
+    for chunk in question_answer_from_context_chain.stream(input_data):
+        if chunk.content:
+            yield chunk.content
+
+
+@timed('answer_question_from_context')
+async def aanswer_question_from_context(question, context, question_answer_from_context_chain, max_retries=5):
+    """
+    Asynchronously answer a question using the given context, retrying on rate limits.
+
+    Args:
+        question: The question to be answered.
+        context: The context to be used for answering the question.
+        max_retries: The maximum number of attempts when the API rate limit is hit.
+
+    Returns:
+        A dictionary containing the answer, context, and question.
+    """
+    input_data = {
+        "question": question,
+        "context": context
+    }
+
+    output = await retry_with_exponential_backoff(
+        lambda: question_answer_from_context_chain.ainvoke(input_data), max_retries
+    )
+    return {"answer": output.content, "context": context, "question": question}
+
+
+async def astream_answer_question_from_context(question, context, question_answer_from_context_chain,
+                                               max_retries=5):
+    """
+    Asynchronously answer a question using the given context, yielding the answer as it is generated.
+
+    A rate limit hit before the first piece of the answer is retried with exponential
+    backoff; once text has been sent, the error is raised to the caller.
+
+    Args:
+        question: The question to be answered.
+        context: The context to be used for answering the question.
+        max_retries: The maximum number of attempts when the API rate limit is hit.
+
+    Yields:
+        str: The next piece of the answer text.
+    """
+    input_data = {
+        "question": question,
+        "context": context
+    }
+
+    for attempt in range(max_retries):
+        started = False
+        try:
+            async for chunk in question_answer_from_context_chain.astream(input_data):
+                if chunk.content:
+                    started = True
+                    yield chunk.content
+            return
+        except RateLimitError:
+            if started or attempt == max_retries - 1:
+                raise
+            await exponential_backoff(attempt)
+
+
 def show_context(context):
     """
     Display the contents of the provided context list.
@@ -188,6 +379,26 @@ def show_context(context):
         print("\n")
 
 
+def iter_pdf_pages_fitz(path):
+    """
+    Yield the text of a PDF document page by page.
+
+    Args:
+        path (str): The file path to the PDF document.
+
+    Yields:
+        tuple: The page number (starting at 0) and the text content of the page.
+
+    The document is opened with the 'fitz' library (PyMuPDF) and each page's text is
+    extracted only when it is requested, so large documents are never held in memory at once.
+    """
+    import fitz
+
+    with fitz.open(path) as doc:
+        for page_number, page in enumerate(doc):
+            yield page_number, page.get_text()
+
+
 def read_pdf_to_string(path):
     """
     Read a PDF document from the specified path and return its content as a string.
@@ -197,28 +408,18 @@ def read_pdf_to_string(path):
 
     Returns:
         str: The concatenated text content of all pages in the PDF document.
-
-    The function uses the 'fitz' library (PyMuPDF) to open the PDF document, iterate over each page,
-    extract the text content from each page, and append it to a single string.
     """
-    # Open the PDF document located at the specified path
-    doc = fitz.open(path)
-    content = ""
-    # Iterate over each page in the document
-    for page_num in range(len(doc)):
-        # Get the current page
-        page = doc[page_num]
-        # Extract the text content from the current page and append it to the content string
-        content += page.get_text()
-    return content
+    # Join once instead of appending to a growing string per page
+    return "".join(text for _, text in iter_pdf_pages_fitz(path))
 
 
-def bm25_retrieval(bm25: BM25Okapi, cleaned_texts: List[str], query: str, k: int = 5) -> List[str]:
+def bm25_retrieval(bm25, cleaned_texts: List[str], query: str, k: int = 5) -> List[str]:
     """
     Perform BM25 retrieval and return the top k cleaned text chunks.
 
     Args:
-    bm25 (BM25Okapi): Pre-computed BM25 index.
+    bm25 (BM25Index or BM25Okapi): Pre-computed BM25 index. A BM25Index is scored with
+        sparse matrix operations; a BM25Okapi falls back to its per-document scoring.
     cleaned_texts (List[str]): List of cleaned text chunks corresponding to the BM25 index.
     query (str): The query string.
     k (int): The number of text chunks to retrieve.
@@ -226,17 +427,21 @@ def bm25_retrieval(bm25: BM25Okapi, cleaned_texts: List[str], query: str, k: int
     Returns:
     List[str]: The top k cleaned text chunks based on BM25 scores.
     """
-    # Tokenize the query
-    query_tokens = query.split()
+    if isinstance(bm25, BM25Index):
+        # Vectorized scoring and partial sort over the sparse postings
+        top_k = [index for index, _ in bm25.search(query, k)]
+    else:
+        # Tokenize the query
+        query_tokens = query.split()
 
-    # Get BM25 scores for the query
-    bm25_scores = bm25.get_scores(query_tokens)
+        # Get BM25 scores for the query
+        bm25_scores = bm25.get_scores(query_tokens)
 
-    # Get the indices of the top k scores
-    top_k_indices = np.argsort(bm25_scores)[::-1][:k]
+        # Get the indices of the top k scores
+        top_k = top_k_indices(np.asarray(bm25_scores), k)
 
     # Retrieve the top k cleaned text chunks
-    top_k_texts = [cleaned_texts[i] for i in top_k_indices]
+    top_k_texts = [cleaned_texts[i] for i in top_k]
 
     return top_k_texts
 
@@ -264,7 +469,9 @@ async def retry_with_exponential_backoff(coroutine, max_retries=5):
     Retries a coroutine using exponential backoff upon encountering a RateLimitError.
 
     Args:
-        coroutine: The coroutine to be executed.
+        coroutine: A zero-argument function returning the coroutine to be executed, called once
+            per attempt. A coroutine object is also accepted, but it can only be awaited once,
+            so it is not retried.
         max_retries: The maximum number of retry attempts.
 
     Returns:
@@ -273,10 +480,13 @@ async def retry_with_exponential_backoff(coroutine, max_retries=5):
     Raises:
         The last encountered exception if all retry attempts fail.
     """
+    if not callable(coroutine):
+        max_retries = 1
+
     for attempt in range(max_retries):
         try:
-            # Attempt to execute the coroutine
-            return await coroutine
+            # Attempt to execute the coroutine (a fresh one per attempt)
+            return await (coroutine() if callable(coroutine) else coroutine)
         except RateLimitError as e:
             # If the last attempt also fails, raise the exception
             if attempt == max_retries - 1:
@@ -293,7 +503,7 @@ def create_deep_eval_test_cases(
     gt_answers: List[str],
     generated_answers: List[str],
     retrieved_documents: List[str]
-) -> List[LLMTestCase]:
+) -> List["LLMTestCase"]:
     """
     Create a list of LLMTestCase objects for evaluation.
 
@@ -306,6 +516,8 @@ def create_deep_eval_test_cases(
     Returns:
         List[LLMTestCase]: List of LLMTestCase objects.
     """
+    from deepeval.test_case import LLMTestCase
+
     return [
         LLMTestCase(
             input=question,
@@ -318,40 +530,78 @@ def create_deep_eval_test_cases(
         )
     ]
     
-def encode_pdf(path, chunk_size=1000, chunk_overlap=200):
+def load_and_split_pdf(path, chunk_size=1000, chunk_overlap=200, file_hash=None, text_cache_folder=TEXT_CACHE_FOLDER,
+                       batch_pages=SPLIT_BATCH_PAGES):
     """
-    Encodes a PDF into a vector store using OpenAI embeddings and returns both
-    the vector store and the documents with metadata.
+    Loads a PDF and splits it into text chunks tagged with the source file path.
+
+    The page text is read from the text cache filled by check_dataset.py, so a
+    validated PDF is not parsed a second time. Chunks are yielded in batches of
+    batch_pages pages, so a large PDF is never held in memory as a whole.
 
     Args:
         path: The full path to the PDF file.
         chunk_size: The desired size of each text chunk.
         chunk_overlap: The amount of overlap between consecutive chunks.
+        file_hash: The SHA-256 hash of the file, if already known.
+        text_cache_folder: The folder holding the page text cache.
+        batch_pages: The number of pages whose chunks are yielded together.
 
-    Returns:
-        A FAISS vector store containing the encoded content.
+    Yields:
+        A list of document chunks with tab characters replaced by spaces.
     """
 
-    # Load PDF documents
-    loader = PyPDFLoader(path)
-    documents = loader.load()
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-    # Split documents into chunks
+    # Split the PDF page by page, so only the current batch of pages is held
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len
     )
-    texts = text_splitter.split_documents(documents)
-    
-    # Add the full file path as metadata to each chunk
-    for text in texts:
-        if not hasattr(text, 'metadata'):
-            text.metadata = {}
-        text.metadata['source'] = path  # Store the full file path in metadata
+    texts = []
+    pages = 0
+    for page_number, text in iter_pdf_text(path, file_hash, text_cache_folder):
+        # One document per page, with the same metadata as PyPDFLoader
+        page = Document(page_content=text, metadata={'source': path, 'page': page_number})
+        search_from = 0
+        for chunk in text_splitter.split_documents([page]):
+            # Position of the chunk in the page text, used to merge overlapping chunks in the prompt
+            start = text.find(chunk.page_content, search_from)
+            if start != -1:
+                chunk.metadata['start_index'] = start
+                search_from = start + 1
+            texts.append(chunk)
+        pages += 1
+        if pages % batch_pages == 0 and texts:
+            yield replace_t_with_space(texts)
+            texts = []
+
+    if texts:
+        yield replace_t_with_space(texts)
+
+
+def encode_pdf(path, chunk_size=1000, chunk_overlap=200, embeddings=None):
+    """
+    Encodes a PDF into a vector store using OpenAI embeddings and returns both
+    the vector store and the documents with metadata.
 
-    cleaned_texts = replace_t_with_space(texts)
+    Args:
+        path: The full path to the PDF file.
+        chunk_size: The desired size of each text chunk.
+        chunk_overlap: The amount of overlap between consecutive chunks.
+        embeddings: The embeddings to encode the chunks with. Defaults to OpenAIEmbeddings.
+
+    Returns:
+        A FAISS vector store containing the encoded content.
+    """
+
+    from langchain_community.vectorstores import FAISS
+
+    cleaned_texts = [chunk for batch in load_and_split_pdf(path, chunk_size, chunk_overlap) for chunk in batch]
 
     # Generate embeddings and vector store
-    embeddings = OpenAIEmbeddings()
+    if embeddings is None:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
     vectorstore = FAISS.from_documents(cleaned_texts, embeddings)
 
     return vectorstore
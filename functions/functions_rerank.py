@@ -0,0 +1,169 @@
+import re
+
+import numpy as np
+
+# Characters at the start of a chunk compared to find chunks that overlap another one
+OVERLAP_PROBE_CHARS = 50
+
+# Token Jaccard similarity above which two chunks count as duplicates
+DUPLICATE_THRESHOLD = 0.9
+
+# Cross-encoder used when the reranker is "cross-encoder" without a model name
+CROSS_ENCODER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+
+
+class EmbeddingReranker:
+    """
+    Reranker that scores candidates by the cosine similarity of their embeddings to the question.
+
+    This is the similarity FAISS already ranks by, so it judges relevance no better
+    than the vector search: it only orders the fused candidates, including the
+    BM25-only ones, by their dense score, dropping the keyword signal. It is cheap
+    (the candidate vectors come from the embedding cache, with no API call) but
+    is not a relevance model; use CrossEncoderReranker for that.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def score(self, question, texts):
+        """
+        Score candidate texts against a question in one vectorized pass.
+
+        Args:
+            question (str): The question.
+            texts (list): The candidate texts.
+
+        Returns:
+            np.ndarray: One score per text, higher is better.
+        """
+        query = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        candidates = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(candidates, axis=1) * max(np.linalg.norm(query), 1e-12)
+        return candidates @ query / np.maximum(norms, 1e-12)
+
+
+class CrossEncoderReranker:
+    """
+    Reranker that scores (question, chunk) pairs with a local cross-encoder on the CPU.
+
+    The cross-encoder reads the question and the chunk together, so it judges
+    relevance beyond the similarity of their embeddings. Needs sentence-transformers,
+    which is not in requirements.txt (pip install sentence-transformers). The model
+    is loaded on first use.
+    """
+
+    def __init__(self, model_name=CROSS_ENCODER_MODEL, batch_size=32):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+
+    def score(self, question, texts):
+        """
+        Score candidate texts against a question in batches.
+
+        Args:
+            question (str): The question.
+            texts (list): The candidate texts.
+
+        Returns:
+            np.ndarray: One score per text, higher is better.
+        """
+        if self._model is None:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError as e:
+                raise ImportError("The cross-encoder reranker needs sentence-transformers. "
+                                  "Install it with: pip install sentence-transformers") from e
+            self._model = CrossEncoder(self.model_name, device='cpu')
+        return np.asarray(self._model.predict([(question, text) for text in texts], batch_size=self.batch_size))
+
+
+def create_reranker(spec, embeddings=None):
+    """
+    Create a reranker from its setting.
+
+    Args:
+        spec (str): '' or None (no reranking, the default), 'cross-encoder',
+            'cross-encoder:<model name>' or 'embedding' (dense cosine only, see EmbeddingReranker).
+        embeddings: The embeddings of the index, used by the embedding reranker.
+
+    Returns:
+        EmbeddingReranker, CrossEncoderReranker or None: The reranker.
+
+    Raises:
+        ValueError: If the setting names an unknown reranker.
+    """
+    if not spec:
+        return None
+    if spec == 'embedding':
+        return EmbeddingReranker(embeddings)
+    if spec == 'cross-encoder' or spec.startswith('cross-encoder:'):
+        return CrossEncoderReranker(spec.split(':', 1)[1] if ':' in spec else CROSS_ENCODER_MODEL)
+    raise ValueError(f"Unknown reranker: {spec}")
+
+
+def rerank(reranker, question, docs):
+    """
+    Order documents by their reranker scores.
+
+    Args:
+        reranker: The reranker.
+        question (str): The question.
+        docs (list): The candidate documents.
+
+    Returns:
+        list: The documents, best first.
+    """
+    if not docs:
+        return docs
+    scores = reranker.score(question, [doc.page_content for doc in docs])
+    return [docs[position] for position in np.argsort(-scores, kind='stable')]
+
+
+def _tokens(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def _overlaps(doc, other):
+    # Chunks split with overlap share text: the start of one appears in the other
+    text, other_text = doc.page_content.strip(), other.page_content.strip()
+    return text[:OVERLAP_PROBE_CHARS] in other_text or other_text[:OVERLAP_PROBE_CHARS] in text
+
+
+def dedupe_overlapping(docs, k):
+    """
+    Select the best k documents, skipping chunks that repeat an already selected one.
+
+    A chunk is skipped if it comes from the same source and page as a selected
+    chunk and overlaps it (the splitter's chunk overlap), or if its words nearly
+    equal those of a selected chunk from any source.
+
+    Args:
+        docs (list): The documents, best first.
+        k (int): The number of documents to select.
+
+    Returns:
+        list: Up to k documents, best first.
+    """
+    selected = []
+    selected_tokens = []
+    for doc in docs:
+        if len(selected) == k:
+            break
+        tokens = _tokens(doc.page_content)
+        duplicate = False
+        for other, other_tokens in zip(selected, selected_tokens):
+            same_section = (doc.metadata.get('source') == other.metadata.get('source')
+                            and doc.metadata.get('page') == other.metadata.get('page'))
+            if same_section and _overlaps(doc, other):
+                duplicate = True
+                break
+            union = tokens | other_tokens
+            if union and len(tokens & other_tokens) / len(union) >= DUPLICATE_THRESHOLD:
+                duplicate = True
+                break
+        if not duplicate:
+            selected.append(doc)
+            selected_tokens.append(tokens)
+    return selected
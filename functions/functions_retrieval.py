@@ -0,0 +1,468 @@
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from functions.functions_coalescer import COALESCE_MAX_BATCH, QueryCoalescer
+from functions.functions_filters import MetadataPartitions
+from functions.functions_metrics import in_request_context
+from functions.functions_rerank import dedupe_overlapping, rerank
+
+# Number of candidates each retriever contributes before fusion
+CANDIDATE_K = 20
+
+# Constant of reciprocal rank fusion, larger values flatten the rank weights
+RRF_K = 60
+
+# Fused candidates passed to the reranker, and the seconds it may take before the fused ranking is used
+RERANK_CANDIDATES = 50
+RERANK_BUDGET = 0.2
+
+
+def embed_questions(embeddings, questions):
+    """
+    Embed a batch of questions.
+
+    CachedEmbeddings keeps question vectors in memory only (embed_queries); other
+    embeddings embed them like documents.
+
+    Args:
+        embeddings: The embeddings of the vector store.
+        questions (list): The questions.
+
+    Returns:
+        list: One vector per question.
+    """
+    return getattr(embeddings, 'embed_queries', embeddings.embed_documents)(questions)
+
+
+async def aembed_questions(embeddings, questions):
+    """
+    Asynchronous version of embed_questions.
+    """
+    return await getattr(embeddings, 'aembed_queries', embeddings.aembed_documents)(questions)
+
+
+def vector_search_by_vectors(vectorstore, query_embeddings, k=4, params=None, index=None):
+    """
+    Search a FAISS vector store with a batch of query embeddings in a single call.
+
+    Args:
+        vectorstore (FAISS): The vector store to search.
+        query_embeddings (list): The query embeddings, one per query.
+        k (int): The number of hits to return per query.
+        params (faiss.SearchParameters): Optional search parameters, e.g. restricting the search to a partition.
+        index (faiss.Index): The index to search in place of the store's index, with the same positions.
+
+    Returns:
+        list: For each query, a list of (docstore id, score) tuples, best first.
+            Higher scores are better regardless of the index's distance strategy.
+    """
+    vectors = np.asarray(query_embeddings, dtype=np.float32)
+    if getattr(vectorstore, '_normalize_L2', False):
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    distances, positions = (index if index is not None else vectorstore.index).search(vectors, k, params=params)
+    higher_is_better = getattr(vectorstore, 'distance_strategy', None) == DistanceStrategy.MAX_INNER_PRODUCT
+
+    results = []
+    for query_distances, query_positions in zip(distances, positions):
+        hits = []
+        for distance, position in zip(query_distances, query_positions):
+            if position == -1:
+                # Fewer than k vectors in the index
+                continue
+            score = float(distance) if higher_is_better else -float(distance)
+            hits.append((vectorstore.index_to_docstore_id[position], score))
+        results.append(hits)
+    return results
+
+
+def vector_search(vectorstore, question, k=4, params=None, index=None):
+    """
+    Embed a question and search a FAISS vector store with it.
+
+    Args:
+        vectorstore (FAISS): The vector store to search.
+        question (str): The question to search for.
+        k (int): The number of hits to return.
+        params (faiss.SearchParameters): Optional search parameters, e.g. restricting the search to a partition.
+        index (faiss.Index): The index to search in place of the store's index, with the same positions.
+
+    Returns:
+        list: A list of (docstore id, score) tuples, best first.
+    """
+    return vector_search_by_vectors(vectorstore, [vectorstore._embed_query(question)], k, params, index)[0]
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K):
+    """
+    Fuse several rankings by summing 1 / (rrf_k + rank) for every list a document appears in.
+
+    Args:
+        rankings (list): Lists of (document id, score) tuples, each ordered best first.
+        rrf_k (int): The fusion constant.
+
+    Returns:
+        list: (document id, fused score) tuples, best first.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def weighted_score_fusion(rankings, weights):
+    """
+    Fuse several rankings by a weighted sum of their min-max normalized scores.
+
+    Args:
+        rankings (list): Lists of (document id, score) tuples.
+        weights (list): One weight per ranking.
+
+    Returns:
+        list: (document id, fused score) tuples, best first.
+    """
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        if not ranking:
+            continue
+        scores = np.array([score for _, score in ranking], dtype=np.float64)
+        low, high = scores.min(), scores.max()
+        normalized = (scores - low) / (high - low) if high > low else np.ones_like(scores)
+        for (doc_id, _), score in zip(ranking, normalized):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Retriever that combines FAISS vector search with BM25 keyword search.
+
+    Both searches run concurrently and each contributes candidate_k candidates,
+    which are fused with reciprocal rank fusion ('rrf') or a weighted sum of
+    normalized scores ('weighted'). Exact regulatory terms such as "10 CFR 50.55a"
+    are found by BM25 even when dense retrieval ranks them low.
+
+    With a reranker, the top rerank_candidates fused documents are rescored and
+    the best k are kept, skipping chunks that overlap an already chosen one.
+    Reranking that takes longer than rerank_budget seconds, or fails, is abandoned
+    in favour of the fused ranking, so the reranker never adds more than the
+    budget. Reranks run one at a time on their own thread, and while an abandoned
+    one is still running the fused ranking is used straight away.
+
+    Searches can be restricted by metadata filters (chapter, section). Both
+    searches then scan only the matching partition instead of filtering a
+    global top k, so narrower scopes are faster.
+
+    With a coalesce_window, the question embeddings and vector searches of
+    concurrent requests are batched by a QueryCoalescer.
+
+    With a query_expander, BM25 searches the expanded question it returns (e.g.
+    with related keyword terms appended), while the vector search and the
+    reranker still use the question as asked.
+
+    It exposes get_relevant_documents, so it can be passed to
+    retrieve_context_per_question in place of a LangChain retriever.
+    """
+
+    def __init__(self, vectorstore, bm25, k=4, candidate_k=CANDIDATE_K, fusion='rrf', rrf_k=RRF_K,
+                 vector_weight=0.5, reranker=None, rerank_candidates=RERANK_CANDIDATES, rerank_budget=RERANK_BUDGET,
+                 executor=None, coalesce_window=0.0, coalesce_max_batch=COALESCE_MAX_BATCH, query_expander=None):
+        if fusion not in ('rrf', 'weighted'):
+            raise ValueError("fusion must be 'rrf' or 'weighted'.")
+
+        self.vectorstore = vectorstore
+        self.bm25 = bm25
+        self.k = k
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.vector_weight = vector_weight
+        self.reranker = reranker
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget = rerank_budget
+        self.rerank_fallbacks = 0
+        # Reranks get their own thread, so one running over budget does not hold up the searches
+        self._rerank_executor = ThreadPoolExecutor(max_workers=1)
+        self._rerank_lock = threading.Lock()
+        self._overdue_rerank = None
+        self.query_expander = query_expander
+        # The reranker needs a wider pool from each retriever
+        self.candidate_k = max(candidate_k, rerank_candidates) if reranker is not None else candidate_k
+        self.partitions = MetadataPartitions(vectorstore, bm25)
+        # Shared by all requests, so it is sized for concurrency rather than for the two searches
+        self._executor = executor or ThreadPoolExecutor()
+        self.coalescer = None
+        if coalesce_window > 0:
+            embeddings = vectorstore.embedding_function
+            self.coalescer = QueryCoalescer(functools.partial(embed_questions, embeddings),
+                                            functools.partial(aembed_questions, embeddings),
+                                            functools.partial(vector_search_by_vectors, vectorstore), self._executor,
+                                            window=coalesce_window, max_batch=coalesce_max_batch)
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        return result, time.perf_counter() - start
+
+    def _bm25_query(self, question):
+        return self.query_expander(question) if self.query_expander is not None else question
+
+    def _bm25_search(self, question, bm25=None):
+        bm25 = bm25 or self.bm25
+        hits = bm25.search(self._bm25_query(question), self.candidate_k)
+        return [(bm25.doc_ids[index], score) for index, score in hits]
+
+    def count_matching(self, filters):
+        """
+        Return the number of chunks a search with the filters can return.
+
+        Args:
+            filters (dict): Filters returned by parse_filters, or None.
+
+        Returns:
+            int: The number of matching chunks (all chunks without filters).
+        """
+        if not filters:
+            return self.vectorstore.index.ntotal
+        return self.partitions.get(filters).size
+
+    def _scope(self, filters):
+        # The BM25 index, FAISS index and search parameters of the partition matching the filters
+        if not filters:
+            return self.bm25, (None, None), None
+        start = time.perf_counter()
+        partition = self.partitions.get(filters)
+        index, params = self.partitions.search_parameters(partition)
+        return partition.bm25, (params, index), time.perf_counter() - start
+
+    def _fuse(self, vector_hits, bm25_hits, k=None):
+        if self.fusion == 'rrf':
+            fused = reciprocal_rank_fusion([vector_hits, bm25_hits], self.rrf_k)
+        else:
+            fused = weighted_score_fusion([vector_hits, bm25_hits], [self.vector_weight, 1 - self.vector_weight])
+        # With a reranker, the wider pool is kept for rescoring
+        pool_size = max(k or self.k, self.rerank_candidates) if self.reranker is not None else k or self.k
+        return [self.vectorstore.docstore.search(doc_id) for doc_id, _ in fused[:pool_size]]
+
+    def _rerank(self, question, docs):
+        start = time.perf_counter()
+        ranked = rerank(self.reranker, question, docs)
+        return ranked, time.perf_counter() - start
+
+    def _submit_rerank(self, question, docs):
+        # None while a rerank that ran over budget is still busy, so slow reranks do not pile up
+        with self._rerank_lock:
+            if self._overdue_rerank is not None and not self._overdue_rerank.done():
+                return None
+            return self._rerank_executor.submit(in_request_context(self._rerank, question, docs))
+
+    def _rerank_fallback(self, future, error=None):
+        # Count a rerank that was skipped, ran over budget or failed; an overdue one finishes in the background
+        with self._rerank_lock:
+            self.rerank_fallbacks += 1
+            if future is not None and not future.cancel() and error is None:
+                self._overdue_rerank = future
+        if error is not None:
+            print(f"Reranking failed, using the fused ranking: {type(error).__name__}: {error}")
+
+    def _rerank_within_budget(self, question, docs, k=None):
+        # Returns the best k documents and the time spent reranking
+        if self.reranker is None:
+            return docs[:k or self.k], None
+        future = self._submit_rerank(question, docs)
+        if future is None:
+            self._rerank_fallback(None)
+            return dedupe_overlapping(docs, k or self.k), 0.0
+        try:
+            ranked, rerank_time = future.result(timeout=self.rerank_budget)
+        except TimeoutError:
+            # Over budget: keep the fused ranking
+            self._rerank_fallback(future)
+            ranked, rerank_time = docs, self.rerank_budget
+        except Exception as e:
+            self._rerank_fallback(future, e)
+            ranked, rerank_time = docs, None
+        return dedupe_overlapping(ranked, k or self.k), rerank_time
+
+    async def _arerank_within_budget(self, question, docs, k=None):
+        if self.reranker is None:
+            return docs[:k or self.k], None
+        future = self._submit_rerank(question, docs)
+        if future is None:
+            self._rerank_fallback(None)
+            return dedupe_overlapping(docs, k or self.k), 0.0
+        try:
+            ranked, rerank_time = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                                                         self.rerank_budget)
+        except asyncio.TimeoutError:
+            self._rerank_fallback(future)
+            ranked, rerank_time = docs, self.rerank_budget
+        except Exception as e:
+            self._rerank_fallback(future, e)
+            ranked, rerank_time = docs, None
+        return dedupe_overlapping(ranked, k or self.k), rerank_time
+
+    def retrieve_with_timings(self, question, k=None, filters=None):
+        """
+        Retrieve the fused top k documents for a question and report where the time went.
+
+        Args:
+            question (str): The question to retrieve documents for.
+            k (int): The number of documents to return. Defaults to the retriever's k.
+            filters (dict): Optional filters returned by parse_filters, restricting the search.
+
+        Returns:
+            tuple: The list of documents, best first, and a dict of per-stage timings in seconds
+                ('vector', 'bm25', 'fusion', 'total' and, with a reranker, 'rerank'; 'filter' with filters;
+                'coalesce' and 'embedding' of the batch when coalescing).
+        """
+        start = time.perf_counter()
+        bm25, search, filter_time = self._scope(filters)
+        bm25_future = self._executor.submit(in_request_context(self._timed, self._bm25_search, question, bm25))
+        if self.coalescer is not None:
+            # Embedded and searched in one batch with the questions of concurrent requests
+            vector_hits, timings = self.coalescer.search(question, self.candidate_k, *search)
+        else:
+            vector_future = self._executor.submit(in_request_context(self._timed, vector_search, self.vectorstore,
+                                                                     question, self.candidate_k, *search))
+            vector_hits, vector_time = vector_future.result()
+            timings = {'vector': vector_time}
+        bm25_hits, bm25_time = bm25_future.result()
+
+        fusion_start = time.perf_counter()
+        docs = self._fuse(vector_hits, bm25_hits, k)
+        fusion_time = time.perf_counter() - fusion_start
+        docs, rerank_time = self._rerank_within_budget(question, docs, k)
+
+        timings.update({
+            'bm25': bm25_time,
+            'fusion': fusion_time,
+            'total': time.perf_counter() - start,
+        })
+        if rerank_time is not None:
+            timings['rerank'] = rerank_time
+        if filter_time is not None:
+            timings['filter'] = filter_time
+        return docs, timings
+
+    async def aretrieve_with_timings(self, question, k=None, filters=None):
+        """
+        Asynchronous version of retrieve_with_timings.
+
+        The question embedding is awaited (an API call on a cache miss), and the CPU-bound
+        FAISS and BM25 searches run concurrently in the retriever's thread pool.
+
+        Args:
+            question (str): The question to retrieve documents for.
+            k (int): The number of documents to return. Defaults to the retriever's k.
+            filters (dict): Optional filters returned by parse_filters, restricting the search.
+
+        Returns:
+            tuple: The list of documents, best first, and a dict of per-stage timings in seconds
+                ('embedding', 'vector', 'bm25', 'fusion', 'total' and, with a reranker, 'rerank';
+                'filter' with filters; 'coalesce' when coalescing).
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+
+        bm25, search, filter_time = self._scope(filters)
+        bm25_future = loop.run_in_executor(self._executor,
+                                           in_request_context(self._timed, self._bm25_search, question, bm25))
+        if self.coalescer is not None:
+            # Embedded and searched in one batch with the questions of concurrent requests
+            (vector_hits, timings), (bm25_hits, bm25_time) = await asyncio.gather(
+                self.coalescer.asearch(question, self.candidate_k, *search), bm25_future)
+        else:
+            embedding = await self.vectorstore.embedding_function.aembed_query(question)
+            embedding_time = time.perf_counter() - start
+
+            vector_future = loop.run_in_executor(self._executor, in_request_context(
+                self._timed, vector_search_by_vectors, self.vectorstore, [embedding], self.candidate_k, *search))
+            (vector_hits, vector_time), (bm25_hits, bm25_time) = await asyncio.gather(vector_future, bm25_future)
+            vector_hits = vector_hits[0]
+            timings = {'embedding': embedding_time, 'vector': vector_time}
+
+        fusion_start = time.perf_counter()
+        docs = self._fuse(vector_hits, bm25_hits, k)
+        fusion_time = time.perf_counter() - fusion_start
+        docs, rerank_time = await self._arerank_within_budget(question, docs, k)
+
+        timings.update({
+            'bm25': bm25_time,
+            'fusion': fusion_time,
+            'total': time.perf_counter() - start,
+        })
+        if rerank_time is not None:
+            timings['rerank'] = rerank_time
+        if filter_time is not None:
+            timings['filter'] = filter_time
+        return docs, timings
+
+    def retrieve_batch(self, questions, k=None, filters=None):
+        """
+        Retrieve the fused top k documents for many questions with one pass per index.
+
+        All questions are embedded in one batched call, searched in one FAISS call
+        and scored in one sparse BM25 product, instead of one round trip each.
+
+        Args:
+            questions (list): The questions to retrieve documents for.
+            k (int): The number of documents to return per question. Defaults to the retriever's k.
+            filters (dict): Optional filters returned by parse_filters, restricting every search.
+
+        Returns:
+            tuple: For each question, its list of documents, best first, and a dict of
+                timings in seconds for the whole batch ('embedding', 'vector', 'bm25', 'fusion' and 'total').
+        """
+        start = time.perf_counter()
+        bm25, search, _ = self._scope(filters)
+        bm25_future = self._executor.submit(in_request_context(
+            self._timed,
+            lambda: [[(bm25.doc_ids[index], score) for index, score in hits]
+                     for hits in bm25.search_batch([self._bm25_query(question) for question in questions],
+                                                   self.candidate_k)]
+        ))
+        embeddings, embedding_time = self._timed(embed_questions, self.vectorstore.embedding_function, questions)
+        vector_hits, vector_time = self._timed(vector_search_by_vectors, self.vectorstore, embeddings,
+                                               self.candidate_k, *search)
+        bm25_hits, bm25_time = bm25_future.result()
+
+        fusion_start = time.perf_counter()
+        docs = [self._fuse(question_vector_hits, question_bm25_hits, k)
+                for question_vector_hits, question_bm25_hits in zip(vector_hits, bm25_hits)]
+        fusion_time = time.perf_counter() - fusion_start
+
+        rerank_start = time.perf_counter()
+        docs = [self._rerank_within_budget(question, question_docs, k)[0]
+                for question, question_docs in zip(questions, docs)]
+        end = time.perf_counter()
+
+        timings = {
+            'embedding': embedding_time,
+            'vector': vector_time,
+            'bm25': bm25_time,
+            'fusion': fusion_time,
+            'total': end - start,
+        }
+        if self.reranker is not None:
+            timings['rerank'] = end - rerank_start
+        return docs, timings
+
+    def get_relevant_documents(self, question):
+        """
+        Retrieve the fused top k documents for a question.
+
+        Args:
+            question (str): The question to retrieve documents for.
+
+        Returns:
+            list: The retrieved documents, best first.
+        """
+        docs, _ = self.retrieve_with_timings(question)
+        return docs
@@ -0,0 +1,679 @@
+import os
+import sys
+import json
+import pickle
+import shutil
+import secrets
+import argparse
+import itertools
+import threading
+import subprocess
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from functions.functions_filters import parse_document_path
+from functions.functions_metrics import in_request_context
+from functions.functions_vector_index import (
+    EF_SEARCH,
+    NPROBE,
+    bitmap_selector,
+    build_faiss_index,
+    filtered_search,
+    get_metric,
+    get_vectors,
+    set_search_parameters
+)
+
+# Serve from the shards in <index folder>/shards, searched in parallel by one process per shard
+SHARDED_INDEX = os.getenv("SHARDED_INDEX", "0") == "1"
+
+# Number of shards build_index.py splits the index into (0 keeps it unsharded)
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", 0))
+
+# The chunks of one chapter (or one document) always share a shard: 'chapter' or 'document'
+SHARD_KEY = os.getenv("SHARD_KEY", "chapter")
+SHARD_KEYS = ('chapter', 'document')
+
+# Addresses (host:port, one per shard in order) of the shard servers started by shard_server.py.
+# Without them, the application starts its own shard processes.
+SHARD_ADDRESSES = [address for address in os.getenv("SHARD_ADDRESSES", "").split(',') if address]
+
+# FAISS threads per shard process (one core per shard)
+SHARD_THREADS = int(os.getenv("SHARD_THREADS", 1))
+
+# Folder of the shards inside the index folder, their description, and the key authenticating clients
+SHARDS_FOLDER = 'shards'
+SHARDS_FILE = 'shards.json'
+AUTHKEY_FILE = 'shards.key'
+
+# Printed by a shard process once it listens, followed by its address
+READY_MESSAGE = 'Shard listening on'
+
+# Restricted searches (filter partitions) whose selector a shard process keeps
+SHARD_PARTITION_CACHE = 64
+
+# Groups are moved off a shard holding more than this fraction above the average number of chunks
+REBALANCE_TOLERANCE = 0.05
+
+
+def shard_group(metadata, key=SHARD_KEY):
+    """
+    Return the group of a chunk: the chunks of a group are always stored in the same shard.
+
+    Args:
+        metadata (dict): The chunk metadata.
+        key (str): 'chapter' groups the chunks by chapter, 'document' by source PDF.
+            Chunks without a chapter are grouped by document.
+
+    Returns:
+        str: The group name.
+    """
+    source = os.path.normpath(metadata.get('source', '')).replace("\\", "/")
+    if key == 'chapter':
+        chapter = metadata.get('chapter')
+        if chapter is None and 'section' not in metadata:
+            # Chunks indexed before the metadata was stored
+            chapter = parse_document_path(source)['chapter']
+        if chapter is not None:
+            return f"chapter {chapter}"
+    return source
+
+
+def assign_shards(group_sizes, n_shards, previous=None, tolerance=REBALANCE_TOLERANCE):
+    """
+    Assign groups of chunks to shards, keeping the previous assignment where possible.
+
+    Groups keep their previous shard if it still exists. New groups, and the groups
+    of removed shards, go to the least loaded shard, largest first. Then, while the
+    fullest shard holds more than (1 + tolerance) times the average, its largest
+    group no larger than half the gap to the emptiest shard is moved there, and
+    rebalancing stops once no group is small enough. Every move thus lowers a
+    fullest shard without making the emptiest one fuller than it, and adding
+    shards moves only enough groups onto the new shards to even the load.
+
+    Args:
+        group_sizes (dict): Maps each group to its number of chunks.
+        n_shards (int): The number of shards.
+        previous (dict): Maps groups to the shard they were assigned to before.
+        tolerance (float): The fraction above the average load a shard may hold.
+
+    Returns:
+        tuple: The assignment (dict mapping groups to shards) and the list of groups
+            that changed shard.
+    """
+    previous = previous or {}
+    assignment = {}
+    loads = [0] * n_shards
+    for group, size in group_sizes.items():
+        shard = previous.get(group)
+        if shard is not None and shard < n_shards:
+            assignment[group] = shard
+            loads[shard] += size
+
+    for group in sorted((group for group in group_sizes if group not in assignment),
+                        key=lambda group: (-group_sizes[group], group)):
+        shard = min(range(n_shards), key=loads.__getitem__)
+        assignment[group] = shard
+        loads[shard] += group_sizes[group]
+
+    limit = (1 + tolerance) * sum(loads) / n_shards
+    while max(loads) > limit:
+        # A group at most half the gap leaves the emptiest shard no fuller than the one it came from,
+        # so every move lowers one of the fullest shards; the largest such group lowers it the most
+        emptiest = min(range(n_shards), key=loads.__getitem__)
+        candidates = [group for group, shard in assignment.items()
+                      if loads[shard] == max(loads) and 0 < group_sizes[group] <= (loads[shard] - loads[emptiest]) / 2]
+        if not candidates:
+            break
+        group = max(candidates, key=lambda group: (group_sizes[group], group))
+        loads[assignment[group]] -= group_sizes[group]
+        loads[emptiest] += group_sizes[group]
+        assignment[group] = emptiest
+
+    moved = sorted(group for group, shard in assignment.items()
+                   if group in previous and previous[group] != shard)
+    return assignment, moved
+
+
+def load_shards_info(index_folder):
+    """
+    Return the description of the shards built in an index folder, or None if there are none.
+    """
+    try:
+        with open(os.path.join(index_folder, SHARDS_FOLDER, SHARDS_FILE), mode='r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _load_authkey(index_folder):
+    # The key is created once, readable by the owner only, and kept across rebuilds
+    path = os.path.join(index_folder, AUTHKEY_FILE)
+    if not os.path.isfile(path):
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+            f.write(secrets.token_hex(32))
+        os.replace(path + '.tmp', path)
+    with open(path, mode='r', encoding='utf-8') as f:
+        return f.read().strip().encode('utf-8')
+
+
+def build_shards(vectorstore, index_folder, n_shards, version, key=SHARD_KEY, index_type='flat'):
+    """
+    Split the index into shards of whole chapters (or documents) and save them.
+
+    Each shard holds a FAISS index of the given type over its chunks, and the global
+    positions of those chunks, so shard results map back to the docstore. Groups are
+    assigned with assign_shards from the previous shards, so building with more
+    shards moves only the groups needed to balance them. The shards are written to
+    a temporary folder and swapped in; running shard processes keep the shards they
+    loaded until they are restarted.
+
+    Args:
+        vectorstore (FAISS): The vector store with the exact index.
+        index_folder (str): The index folder.
+        n_shards (int): The number of shards.
+        version (str): The index version (from the manifest).
+        key (str): 'chapter' or 'document' (see shard_group).
+        index_type (str): The index type of each shard (see build_faiss_index).
+
+    Returns:
+        dict: The shards description, with the 'moved' groups and 'moved_chunks' count.
+    """
+    ntotal = vectorstore.index.ntotal
+    get_metadata = getattr(vectorstore.docstore, 'get_metadata', None)
+    groups = []
+    for position in range(ntotal):
+        docstore_id = vectorstore.index_to_docstore_id[position]
+        if get_metadata is not None:
+            metadata = get_metadata(docstore_id)
+        else:
+            metadata = vectorstore.docstore.search(docstore_id).metadata
+        groups.append(shard_group(metadata, key))
+
+    previous = load_shards_info(index_folder)
+    previous_assignment = previous['groups'] if previous is not None and previous['key'] == key else None
+    group_sizes = Counter(groups)
+    assignment, moved = assign_shards(group_sizes, n_shards, previous_assignment)
+    shard_of = np.array([assignment[group] for group in groups], dtype=np.int64)
+
+    shards_folder = os.path.join(index_folder, SHARDS_FOLDER)
+    tmp_folder = shards_folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    vectors = np.ascontiguousarray(get_vectors(vectorstore), dtype=np.float32)
+    metric = get_metric(vectorstore)
+    sizes = []
+    for shard in range(n_shards):
+        # Global positions stay sorted, so the chunks of a PDF stay next to each other
+        positions = np.flatnonzero(shard_of == shard)
+        index = (build_faiss_index(vectors[positions], index_type, metric) if len(positions)
+                 else faiss.index_factory(vectors.shape[1], 'Flat', metric))
+        faiss.write_index(index, os.path.join(tmp_folder, f'shard-{shard}.faiss'))
+        np.save(os.path.join(tmp_folder, f'shard-{shard}.positions.npy'), positions)
+        sizes.append(len(positions))
+
+    info = {
+        'version': version,
+        'key': key,
+        'index_type': index_type,
+        'metric': 'ip' if metric == faiss.METRIC_INNER_PRODUCT else 'l2',
+        'normalize_L2': bool(getattr(vectorstore, '_normalize_L2', False)),
+        'd': int(vectors.shape[1]),
+        'ntotal': ntotal,
+        'n_shards': n_shards,
+        'sizes': sizes,
+        'groups': assignment,
+    }
+    with open(os.path.join(tmp_folder, SHARDS_FILE), mode='w', encoding='utf-8') as f:
+        json.dump(info, f)
+
+    _load_authkey(index_folder)
+    if os.path.exists(shards_folder):
+        shutil.rmtree(shards_folder)
+    os.replace(tmp_folder, shards_folder)
+    return dict(info, moved=moved, moved_chunks=sum(group_sizes[group] for group in moved))
+
+
+class ShardServer:
+    """
+    One shard, searched on behalf of clients connected to a shard process.
+    """
+
+    def __init__(self, index_folder, shard, nprobe=NPROBE, ef_search=EF_SEARCH):
+        folder = os.path.join(index_folder, SHARDS_FOLDER)
+        self.shard = shard
+        # The version of the build this shard comes from, reported to every client
+        self.version = load_shards_info(index_folder)['version']
+        self.index = faiss.read_index(os.path.join(folder, f'shard-{shard}.faiss'))
+        set_search_parameters(self.index, nprobe, ef_search)
+        self.positions = np.load(os.path.join(folder, f'shard-{shard}.positions.npy'))
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _partition(self, token, local_positions):
+        # The index and parameters searching a partition, kept by token so clients send its positions once
+        with self._lock:
+            search = self._partitions.get(token)
+            if search is not None:
+                self._partitions.move_to_end(token)
+                return search
+        if local_positions is None:
+            return None
+
+        selector = bitmap_selector(local_positions, self.index.ntotal)
+        search = filtered_search(self.index, selector, len(local_positions) / max(self.index.ntotal, 1))
+        with self._lock:
+            self._partitions[token] = search
+            while len(self._partitions) > SHARD_PARTITION_CACHE:
+                self._partitions.popitem(last=False)
+        return search
+
+    def search(self, queries, k, token=None, local_positions=None):
+        """
+        Search the shard and return global positions.
+
+        Args:
+            queries (np.ndarray): The query vectors.
+            k (int): The number of neighbours per query.
+            token (int): Identifies a restricted search (None searches the whole shard).
+            local_positions (np.ndarray): The shard positions of the restriction, sent
+                the first time its token is used.
+
+        Returns:
+            tuple or None: The distances and global positions (-1 past the last hit),
+                or None if the token is unknown and no positions were sent.
+        """
+        index, params = self.index, None
+        if token is not None:
+            search = self._partition(token, local_positions)
+            if search is None:
+                return None
+            index, params = search
+        distances, labels = index.search(queries, k, params=params)
+        if len(self.positions) == 0:
+            return distances, labels
+        return distances, np.where(labels >= 0, self.positions[np.maximum(labels, 0)], -1)
+
+    def serve_connection(self, connection):
+        """
+        Answer the search requests of one client until it disconnects.
+
+        The shard number and index version are sent first, so the client can check
+        that it reached the shard of the index it loaded.
+        """
+        with connection:
+            try:
+                connection.send(('hello', {'shard': self.shard, 'version': self.version}))
+            except OSError:
+                return
+            while True:
+                try:
+                    queries, k, token, local_positions = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self.search(queries, k, token, local_positions))
+                except Exception as e:
+                    reply = ('error', f"{type(e).__name__}: {e}")
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+
+def serve_shard(index_folder, shard, host='127.0.0.1', port=0, threads=SHARD_THREADS):
+    """
+    Load a shard and answer search requests on a TCP port until the process is stopped.
+
+    Clients authenticate with the key saved in the index folder. The address is
+    printed once the shard is loaded, after READY_MESSAGE.
+
+    Args:
+        index_folder (str): The index folder.
+        shard (int): The shard number.
+        host (str): The interface to listen on.
+        port (int): The port to listen on (0 picks a free one).
+        threads (int): The number of FAISS threads.
+    """
+    faiss.omp_set_num_threads(threads)
+    server = ShardServer(index_folder, shard)
+    listener = Listener((host, port), authkey=_load_authkey(index_folder))
+    print(f"{READY_MESSAGE} {listener.address[0]}:{listener.address[1]}", flush=True)
+    while True:
+        try:
+            connection = listener.accept()
+        except (AuthenticationError, OSError, EOFError):
+            # A client that failed authentication or hung up during the handshake
+            continue
+        threading.Thread(target=server.serve_connection, args=(connection,), daemon=True).start()
+
+
+def start_shard_processes(index_folder, shards, host='127.0.0.1', ports=None, threads=SHARD_THREADS):
+    """
+    Start one process per shard and wait until they all listen.
+
+    The processes load their shards in parallel. Each one exits when its standard
+    input is closed, i.e. when the starting process exits or calls
+    terminate_shard_process.
+
+    Args:
+        index_folder (str): The index folder.
+        shards (list): The shard numbers.
+        host (str): The interface to listen on.
+        ports (list): The port of each shard. Defaults to free ports.
+        threads (int): The number of FAISS threads per process.
+
+    Returns:
+        list: The subprocess.Popen and the (host, port) address of each shard.
+
+    Raises:
+        RuntimeError: If a process exits before listening.
+    """
+    repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_folder, env.get('PYTHONPATH')]))
+    processes = [subprocess.Popen(
+        [sys.executable, '-m', 'functions.functions_shards', os.path.abspath(index_folder), str(shard),
+         '--host', host, '--port', str(port), '--threads', str(threads)],
+        cwd=repo_folder, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    ) for shard, port in zip(shards, ports or [0] * len(shards))]
+
+    started = []
+    for shard, process in zip(shards, processes):
+        for line in process.stdout:
+            if line.startswith(READY_MESSAGE):
+                address = line[len(READY_MESSAGE):].strip().rsplit(':', 1)
+                started.append((process, (address[0], int(address[1]))))
+                break
+        else:
+            for other in processes:
+                terminate_shard_process(other)
+            raise RuntimeError(f"Shard {shard} process exited with code {process.wait()} before listening.")
+    return started
+
+
+def terminate_shard_process(process):
+    """
+    Stop a process started by start_shard_processes.
+    """
+    process.stdin.close()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def merge_top_k(results, k, metric=faiss.METRIC_L2):
+    """
+    Merge the per-shard top k into the global top k.
+
+    Args:
+        results (list): The (distances, positions) arrays of each shard, with the same queries.
+        k (int): The number of neighbours per query.
+        metric (int): faiss.METRIC_L2 (smaller is better) or faiss.METRIC_INNER_PRODUCT.
+
+    Returns:
+        tuple: The distances and positions of the k best hits per query, like faiss.Index.search.
+    """
+    distances = np.concatenate([distances for distances, _ in results], axis=1)
+    positions = np.concatenate([positions for _, positions in results], axis=1)
+    keys = distances if metric == faiss.METRIC_L2 else -distances
+    keys = np.where(positions < 0, np.inf, keys)
+    order = np.argsort(keys, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(positions, order, axis=1)
+
+
+class ShardedIndex:
+    """
+    Vector index split into shards searched concurrently by separate processes.
+
+    A search is sent to every shard at once, each shard process searches its
+    chunks on its own core and returns its top k, and the results are merged into
+    the global top k. Each process holds only its shard's vectors, so the index no
+    longer has to fit in one process. It has the parts of the FAISS index interface
+    the retriever uses (d, ntotal, search, and restrict for filtered searches).
+
+    The shard processes are started here, unless the addresses of shard servers
+    started with shard_server.py are given, which several application workers can
+    share.
+    """
+
+    def __init__(self, index_folder, addresses=None, threads=SHARD_THREADS, version=None):
+        """
+        Args:
+            index_folder (str): The index folder.
+            addresses (list): 'host:port' of the shard servers, one per shard in order.
+            threads (int): The number of FAISS threads per started shard process.
+            version (str): The index version the shards must serve. Defaults to the
+                version of the shards built in the index folder.
+
+        Raises:
+            FileNotFoundError: If no shards were built.
+            ValueError: If the number of addresses does not match the number of shards,
+                or a shard server serves another shard or another version of the index.
+        """
+        self.info = load_shards_info(index_folder)
+        if self.info is None:
+            raise FileNotFoundError(f"No shards found in {index_folder}. Run build_index.py --shards N first.")
+        self.index_folder = index_folder
+        self.n_shards = self.info['n_shards']
+        self.d = self.info['d']
+        self.ntotal = self.info['ntotal']
+        self.metric_type = faiss.METRIC_INNER_PRODUCT if self.info['metric'] == 'ip' else faiss.METRIC_L2
+        self.shards = [shard for shard, size in enumerate(self.info['sizes']) if size]
+        self._shard_of = None
+        self._local_of = None
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+
+        self.processes = []
+        if addresses:
+            if len(addresses) != self.n_shards:
+                raise ValueError(f"{len(addresses)} shard addresses given for {self.n_shards} shards.")
+            addresses = [(host, int(port)) for host, port in (address.rsplit(':', 1) for address in addresses)]
+        else:
+            started = start_shard_processes(index_folder, list(range(self.n_shards)), threads=threads)
+            self.processes = [process for process, _ in started]
+            addresses = [address for _, address in started]
+
+        authkey = _load_authkey(index_folder)
+        self._connections = []
+        try:
+            for shard, address in enumerate(addresses):
+                self._connections.append(Client(address, authkey=authkey))
+                self._check_shard(shard, address, self._connections[-1].recv(),
+                                  self.info['version'] if version is None else version)
+        except BaseException:
+            for connection in self._connections:
+                connection.close()
+            for process in self.processes:
+                terminate_shard_process(process)
+            raise
+        # One thread per shard, so each connection carries one request at a time
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in range(self.n_shards)]
+
+    @staticmethod
+    def _check_shard(shard, address, hello, version):
+        # The first message of a shard server names the shard and index version it serves
+        kind, served = hello
+        if kind != 'hello':
+            raise ValueError(f"The server at {address[0]}:{address[1]} is not a shard server.")
+        if served['shard'] != shard:
+            raise ValueError(f"The server at {address[0]}:{address[1]} serves shard {served['shard']}, "
+                             f"not shard {shard}.")
+        if served['version'] != version:
+            raise ValueError(f"Shard {shard} at {address[0]}:{address[1]} serves index version "
+                             f"{served['version']}, not {version}. Restart the shard servers.")
+
+    def _call(self, shard, queries, k, restriction):
+        connection = self._connections[shard]
+        if restriction is None:
+            connection.send((queries, k, None, None))
+        else:
+            token, local_positions, sent = restriction.request(shard)
+            connection.send((queries, k, token, None if sent else local_positions))
+        status, result = connection.recv()
+        if status == 'ok' and result is None:
+            # The shard dropped the partition from its cache: send its positions again
+            connection.send((queries, k, restriction.token, restriction.local_positions[shard]))
+            status, result = connection.recv()
+        if status != 'ok':
+            raise RuntimeError(f"Shard {shard} failed: {result}")
+        if restriction is not None:
+            restriction.sent.add(shard)
+        return result
+
+    def _search(self, queries, k, restriction=None):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        # Empty shards (when there are more shards than groups) are skipped
+        shards = self.shards if restriction is None else restriction.shards
+        futures = [self._executors[shard].submit(in_request_context(self._call, shard, queries, k, restriction))
+                   for shard in shards]
+        results = [future.result() for future in futures]
+        if not results:
+            # No shard holds a chunk of the partition
+            return (np.full((len(queries), k), np.inf if self.metric_type == faiss.METRIC_L2 else -np.inf,
+                            dtype=np.float32),
+                    np.full((len(queries), k), -1, dtype=np.int64))
+        return merge_top_k(results, k, self.metric_type)
+
+    def search(self, queries, k, params=None):
+        """
+        Return the k nearest vectors of each query over all shards.
+
+        Args:
+            queries (np.ndarray): The query vectors, one row per query.
+            k (int): The number of neighbours per query.
+            params: Unused, for compatibility with faiss.Index.search.
+
+        Returns:
+            tuple: The distances (L2) or inner products, and the positions (-1 past the last hit).
+        """
+        return self._search(queries, k)
+
+    def restrict(self, positions):
+        """
+        Return an index that only searches the given positions.
+
+        Only the shards holding some of the positions are searched, so a search
+        filtered by chapter on shards grouped by chapter goes to one shard.
+
+        Args:
+            positions (np.ndarray): The sorted global positions to search.
+
+        Returns:
+            ShardRestriction: The restricted index.
+        """
+        with self._lock:
+            if self._shard_of is None:
+                # Shard and shard position of every global position, read once
+                folder = os.path.join(self.index_folder, SHARDS_FOLDER)
+                shard_of = np.empty(self.ntotal, dtype=np.int32)
+                local_of = np.empty(self.ntotal, dtype=np.int64)
+                for shard in range(self.n_shards):
+                    shard_positions = np.load(os.path.join(folder, f'shard-{shard}.positions.npy'))
+                    shard_of[shard_positions] = shard
+                    local_of[shard_positions] = np.arange(len(shard_positions))
+                self._shard_of, self._local_of = shard_of, local_of
+            token = next(self._tokens)
+        return ShardRestriction(self, token, np.asarray(positions, dtype=np.int64))
+
+    def close(self):
+        """
+        Disconnect from the shards and stop the shard processes started here.
+        """
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        for connection in self._connections:
+            connection.close()
+        for process in self.processes:
+            terminate_shard_process(process)
+        self.processes = []
+
+
+class ShardRestriction:
+    """
+    A ShardedIndex searched over a subset of its positions.
+    """
+
+    def __init__(self, index, token, positions):
+        self.index = index
+        self.d = index.d
+        self.ntotal = index.ntotal
+        self.token = token
+        shard_of = index._shard_of[positions]
+        self.local_positions = {shard: index._local_of[positions[shard_of == shard]]
+                                for shard in np.unique(shard_of).tolist()}
+        self.shards = sorted(self.local_positions)
+        # Shards that already hold the selector of this restriction
+        self.sent = set()
+
+    def request(self, shard):
+        return self.token, self.local_positions[shard], shard in self.sent
+
+    def search(self, queries, k, params=None):
+        return self.index._search(queries, k, self)
+
+
+def load_sharded_index(index_folder, embeddings, version=None, addresses=None, threads=SHARD_THREADS):
+    """
+    Load a vector store whose vectors are searched by the shards built in the index folder.
+
+    Only the docstore is loaded in this process; the vectors stay in the shard processes.
+
+    Args:
+        index_folder (str): The index folder.
+        embeddings: The embeddings used to encode queries.
+        version (str): The version of the saved index (from the manifest), which the shards must match.
+        addresses (list): 'host:port' of running shard servers. Defaults to starting the shard processes.
+        threads (int): The number of FAISS threads per started shard process.
+
+    Returns:
+        FAISS: The vector store. Its index is a ShardedIndex, to close when done.
+
+    Raises:
+        FileNotFoundError: If no shards were built.
+        ValueError: If the shards were built from another version of the index, or a
+            shard server serves another shard or another version.
+    """
+    info = load_shards_info(index_folder)
+    if info is not None and version is not None and info['version'] != version:
+        raise ValueError(f"The shards in {index_folder} are out of date. Run build_index.py --shards N again.")
+
+    index = ShardedIndex(index_folder, addresses, threads, version)
+    with open(os.path.join(index_folder, 'index.pkl'), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    distance_strategy = (DistanceStrategy.MAX_INNER_PRODUCT if index.metric_type == faiss.METRIC_INNER_PRODUCT
+                         else DistanceStrategy.EUCLIDEAN_DISTANCE)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id,
+                 normalize_L2=index.info['normalize_L2'], distance_strategy=distance_strategy)
+
+
+# Entry point of the shard processes started by ShardedIndex and shard_server.py
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve one shard of the vector index.")
+    parser.add_argument('index_folder', help="The index folder")
+    parser.add_argument('shard', type=int, help="The shard number")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on")
+    parser.add_argument('--port', type=int, default=0, help="Port to listen on (0 picks a free one)")
+    parser.add_argument('--threads', type=int, default=SHARD_THREADS, help="FAISS threads")
+    args = parser.parse_args()
+
+    # Exit with the process that started this one, which holds the other end of stdin
+    def exit_on_eof():
+        sys.stdin.read()
+        os._exit(0)
+
+    threading.Thread(target=exit_on_eof, daemon=True).start()
+    serve_shard(args.index_folder, args.shard, args.host, args.port, args.threads)
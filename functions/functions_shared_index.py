@@ -0,0 +1,387 @@
+import os
+import json
+import shutil
+
+import faiss
+import numpy as np
+from scipy import sparse
+from langchain.docstore.document import Document
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from functions.functions_bm25 import BM25Index
+from functions.functions_vector_index import (
+    EF_SEARCH,
+    NPROBE,
+    build_faiss_index,
+    get_metric,
+    get_vectors,
+    serving_index_path,
+    set_search_parameters
+)
+
+# Serve from the memory-mapped snapshot in <index folder>/shared, so worker processes share one copy
+SHARED_INDEX = os.getenv("SHARED_INDEX", "0") == "1"
+
+# Folder of the snapshots inside the index folder, and the file naming the current one
+SHARED_FOLDER = 'shared'
+CURRENT_FILE = 'CURRENT'
+
+# Snapshots kept besides the current one, for workers still serving them
+KEEP_SNAPSHOTS = 2
+
+# Vectors scored per block by the memory-mapped exact index (bounds the temporary score matrix)
+SEARCH_BLOCK_SIZE = 65536
+
+# Above this many runs of positions, a restricted search gathers the rows instead of scanning runs
+MAX_RUNS = 256
+
+
+def _positions_to_runs(positions):
+    # Contiguous [start, stop) runs of sorted positions
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = np.concatenate(([positions[0]], positions[breaks]))
+    stops = np.concatenate((positions[breaks - 1] + 1, [positions[-1] + 1]))
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+class MmapFlatIndex:
+    """
+    Exact vector index over a memory-mapped .npy file, searched with NumPy.
+
+    Every worker process that opens the same file shares its pages through the OS
+    page cache, instead of holding a private copy like a FAISS flat index. It has
+    the parts of the FAISS index interface the retriever uses (d, ntotal, search).
+    """
+
+    def __init__(self, vectors_file, metric=faiss.METRIC_L2):
+        self.vectors = np.load(vectors_file, mmap_mode='r')
+        self.ntotal, self.d = self.vectors.shape
+        self.metric_type = metric
+        # Squared norms complete the L2 distances computed from inner products
+        norms_file = vectors_file[:-len('.npy')] + '.norms.npy'
+        self.norms = np.load(norms_file, mmap_mode='r') if metric == faiss.METRIC_L2 else None
+
+    def _score(self, queries, start, stop, rows=None):
+        vectors = self.vectors[start:stop] if rows is None else self.vectors[rows]
+        scores = queries @ vectors.T
+        if self.norms is not None:
+            # Smaller distances are better, so the negated distance (up to the query norm) is the score
+            norms = self.norms[start:stop] if rows is None else self.norms[rows]
+            scores = 2 * scores - norms
+        return scores
+
+    def _search_ranges(self, queries, k, ranges, rows=None):
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_positions = np.zeros((len(queries), 0), dtype=np.int64)
+        for start, stop in ranges:
+            for block_start in range(start, stop, SEARCH_BLOCK_SIZE):
+                block_stop = min(block_start + SEARCH_BLOCK_SIZE, stop)
+                if rows is None:
+                    scores = self._score(queries, block_start, block_stop)
+                    positions = np.arange(block_start, block_stop)
+                else:
+                    positions = rows[block_start:block_stop]
+                    scores = self._score(queries, 0, 0, positions)
+                best_scores = np.concatenate((best_scores, scores), axis=1)
+                best_positions = np.concatenate((best_positions, np.broadcast_to(positions, scores.shape)), axis=1)
+                if best_scores.shape[1] > k:
+                    top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, top, axis=1)
+                    best_positions = np.take_along_axis(best_positions, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_positions = np.take_along_axis(best_positions, order, axis=1)
+
+        # Same output as FAISS: k columns padded with -1, L2 distances or inner products
+        distances = np.full((len(queries), k), np.inf if self.norms is not None else -np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        found = best_scores.shape[1]
+        if self.norms is not None:
+            best_scores = (queries * queries).sum(axis=1, keepdims=True) - best_scores
+        distances[:, :found] = best_scores
+        labels[:, :found] = best_positions
+        return distances, labels
+
+    def search(self, queries, k, params=None):
+        """
+        Return the k nearest vectors of each query.
+
+        Args:
+            queries (np.ndarray): The query vectors, one row per query.
+            k (int): The number of neighbours per query.
+            params: Unused, for compatibility with faiss.Index.search.
+
+        Returns:
+            tuple: The distances (L2) or inner products, and the positions (-1 past the last hit).
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        return self._search_ranges(queries, k, [(0, self.ntotal)])
+
+    def restrict(self, positions):
+        """
+        Return an index that only searches the given positions.
+
+        Chunks of one PDF are stored next to each other, so a partition by chapter
+        or section is a few contiguous runs, scanned in place without copying.
+
+        Args:
+            positions (np.ndarray): The sorted positions to search.
+
+        Returns:
+            RestrictedIndex: The restricted index.
+        """
+        return RestrictedIndex(self, positions)
+
+
+class RestrictedIndex:
+    """
+    A MmapFlatIndex searched over a subset of its positions.
+    """
+
+    def __init__(self, index, positions):
+        self.index = index
+        self.d = index.d
+        self.ntotal = index.ntotal
+        self.positions = np.asarray(positions, dtype=np.int64)
+        runs = _positions_to_runs(self.positions)
+        self.runs = runs if len(runs) <= MAX_RUNS else None
+
+    def search(self, queries, k, params=None):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.runs is not None:
+            return self.index._search_ranges(queries, k, self.runs)
+        return self.index._search_ranges(queries, k, [(0, len(self.positions))], rows=self.positions)
+
+
+class MmapDocstore:
+    """
+    Read-only docstore over memory-mapped chunk texts and metadata.
+
+    Documents are materialized only when searched for, i.e. for the retrieved hits.
+    Document ids are the positions in the vector index.
+    """
+
+    def __init__(self, folder):
+        self.texts = np.memmap(os.path.join(folder, 'texts.bin'), dtype=np.uint8, mode='r')
+        self.text_offsets = np.load(os.path.join(folder, 'texts.offsets.npy'), mmap_mode='r')
+        self.metadata = np.memmap(os.path.join(folder, 'metadata.bin'), dtype=np.uint8, mode='r')
+        self.metadata_offsets = np.load(os.path.join(folder, 'metadata.offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def get_metadata(self, doc_id):
+        """
+        Return the metadata of the document with the given id, without reading its text.
+        """
+        position = int(doc_id)
+        return json.loads(self.metadata[self.metadata_offsets[position]:self.metadata_offsets[position + 1]].tobytes())
+
+    def search(self, doc_id):
+        """
+        Return the document with the given id.
+
+        Args:
+            doc_id (int): The document id (its position in the vector index).
+
+        Returns:
+            Document: The document.
+        """
+        position = int(doc_id)
+        text = self.texts[self.text_offsets[position]:self.text_offsets[position + 1]].tobytes().decode('utf-8')
+        return Document(page_content=text, metadata=self.get_metadata(position))
+
+
+def _write_blob(strings, path):
+    # Concatenate UTF-8 strings into one file, with an .offsets.npy file of n + 1 byte offsets
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(path, 'wb') as f:
+        for position, string in enumerate(strings):
+            data = string.encode('utf-8')
+            f.write(data)
+            offsets[position + 1] = offsets[position] + len(data)
+    np.save(path[:-len('.bin')] + '.offsets.npy', offsets)
+
+
+def _to_ondisk_ivf(index, ivfdata_path):
+    # Move the inverted lists of an IVF index to a file that read_index memory-maps
+    ivf = faiss.extract_index_ivf(index)
+    lists = faiss.InvertedListsPtrVector()
+    lists.push_back(ivf.invlists)
+    ondisk = faiss.OnDiskInvertedLists(ivf.nlist, ivf.code_size, ivfdata_path)
+    # Named merge_from before FAISS 1.7.4
+    merge = getattr(ondisk, 'merge_from_multiple', None) or ondisk.merge_from
+    merge(lists.data(), lists.size())
+    ivf.replace_invlists(ondisk, True)
+    ondisk.this.disown()
+
+
+def snapshot_name(version, index_type):
+    """
+    Return the folder name of the snapshot of an index version and type.
+    """
+    return f"{version}-{''.join(c if c.isalnum() else '_' for c in index_type)}"
+
+
+def current_snapshot(index_folder):
+    """
+    Return the name of the current snapshot, or None if none was exported.
+
+    Args:
+        index_folder (str): The index folder.
+
+    Returns:
+        str or None: The snapshot folder name.
+    """
+    try:
+        with open(os.path.join(index_folder, SHARED_FOLDER, CURRENT_FILE), mode='r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def export_shared_index(vectorstore, bm25, index_folder, version, index_type='flat'):
+    """
+    Write a memory-mappable snapshot of the index and make it the current one.
+
+    The snapshot holds the vectors (flat) or an IVF index with on-disk inverted
+    lists, the chunk texts and metadata as byte blobs with offset tables, and the
+    BM25 matrix as separate .npy arrays. It is written to a temporary folder,
+    renamed into place, and published by atomically replacing the CURRENT file,
+    so serving workers switch to it on their next request without a restart.
+    Older snapshots beyond KEEP_SNAPSHOTS are removed; workers that still map
+    them keep their pages until they switch.
+
+    Args:
+        vectorstore (FAISS): The vector store with the exact index.
+        bm25 (BM25Index): The BM25 index of the same chunks.
+        index_folder (str): The index folder.
+        version (str): The index version (from the manifest).
+        index_type (str): 'flat' for memory-mapped exact search, or an IVF index type.
+            Other types are saved too, but every worker loads its own copy of them.
+
+    Returns:
+        str: The snapshot folder name.
+    """
+    shared_folder = os.path.join(index_folder, SHARED_FOLDER)
+    name = snapshot_name(version, index_type)
+    folder = os.path.join(shared_folder, name)
+    if not os.path.isdir(folder):
+        tmp_folder = os.path.join(shared_folder, '.tmp-' + name)
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        os.makedirs(tmp_folder)
+
+        # Document ids become index positions, so BM25 columns are reordered to match
+        docstore_ids = [vectorstore.index_to_docstore_id[position] for position in range(vectorstore.index.ntotal)]
+        positions = {docstore_id: position for position, docstore_id in enumerate(docstore_ids)}
+        documents = [vectorstore.docstore.search(docstore_id) for docstore_id in docstore_ids]
+        _write_blob([doc.page_content for doc in documents], os.path.join(tmp_folder, 'texts.bin'))
+        _write_blob([json.dumps(doc.metadata, ensure_ascii=False) for doc in documents],
+                    os.path.join(tmp_folder, 'metadata.bin'))
+
+        vectors = np.ascontiguousarray(get_vectors(vectorstore), dtype=np.float32)
+        metric = get_metric(vectorstore)
+        if index_type == 'flat':
+            np.save(os.path.join(tmp_folder, 'vectors.npy'), vectors)
+            np.save(os.path.join(tmp_folder, 'vectors.norms.npy'), (vectors * vectors).sum(axis=1))
+        else:
+            # The serving index built by update_index is reused rather than trained again
+            serving_path = serving_index_path(index_folder, index_type)
+            if os.path.isfile(serving_path):
+                index = faiss.read_index(serving_path)
+            else:
+                index = build_faiss_index(vectors, index_type, metric)
+            if faiss.try_extract_index_ivf(index) is not None:
+                _to_ondisk_ivf(index, os.path.join(tmp_folder, 'index.ivfdata'))
+            faiss.write_index(index, os.path.join(tmp_folder, 'index.faiss'))
+
+        np.save(os.path.join(tmp_folder, 'bm25.data.npy'), bm25.weights.data)
+        np.save(os.path.join(tmp_folder, 'bm25.indices.npy'), bm25.weights.indices)
+        np.save(os.path.join(tmp_folder, 'bm25.indptr.npy'), bm25.weights.indptr)
+        np.save(os.path.join(tmp_folder, 'bm25.doc_ids.npy'),
+                np.array([positions.get(doc_id, -1) for doc_id in bm25.doc_ids], dtype=np.int64))
+        terms = [None] * len(bm25.vocabulary)
+        for term, row in bm25.vocabulary.items():
+            terms[row] = term
+
+        info = {
+            'version': version,
+            'index_type': index_type,
+            'metric': 'ip' if metric == faiss.METRIC_INNER_PRODUCT else 'l2',
+            'normalize_L2': bool(getattr(vectorstore, '_normalize_L2', False)),
+            'ntotal': len(docstore_ids),
+            'bm25_shape': list(bm25.weights.shape),
+            'bm25_params': {'k1': bm25.k1, 'b': bm25.b, 'epsilon': bm25.epsilon},
+            'bm25_terms': terms,
+        }
+        with open(os.path.join(tmp_folder, 'info.json'), mode='w', encoding='utf-8') as f:
+            json.dump(info, f)
+        os.replace(tmp_folder, folder)
+
+    # Publish the snapshot: readers see either the old or the new name, never a partial file
+    current_path = os.path.join(shared_folder, CURRENT_FILE)
+    with open(current_path + '.tmp', mode='w', encoding='utf-8') as f:
+        f.write(name)
+    os.replace(current_path + '.tmp', current_path)
+
+    snapshots = sorted((entry for entry in os.scandir(shared_folder)
+                        if entry.is_dir() and entry.name != name and not entry.name.startswith('.')),
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in snapshots[KEEP_SNAPSHOTS:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+    return name
+
+
+def load_shared_index(index_folder, embeddings, name=None, nprobe=NPROBE, ef_search=EF_SEARCH):
+    """
+    Open a snapshot written by export_shared_index, memory-mapping its files.
+
+    Args:
+        index_folder (str): The index folder.
+        embeddings: The embeddings used to encode queries.
+        name (str): The snapshot to open. Defaults to the current one.
+        nprobe (int): The number of inverted lists probed per query (IVF indexes).
+        ef_search (int): The size of the candidate list per query (HNSW indexes).
+
+    Returns:
+        tuple: The vector store, the BM25 index and the snapshot info (with its 'name').
+
+    Raises:
+        FileNotFoundError: If no snapshot was exported.
+    """
+    name = name or current_snapshot(index_folder)
+    if name is None:
+        raise FileNotFoundError(f"No shared index found in {index_folder}. Run build_index.py --shared first.")
+    folder = os.path.join(index_folder, SHARED_FOLDER, name)
+    with open(os.path.join(folder, 'info.json'), mode='r', encoding='utf-8') as f:
+        info = json.load(f)
+
+    metric = faiss.METRIC_INNER_PRODUCT if info['metric'] == 'ip' else faiss.METRIC_L2
+    if info['index_type'] == 'flat':
+        index = MmapFlatIndex(os.path.join(folder, 'vectors.npy'), metric)
+    else:
+        # IVF inverted lists are memory-mapped from index.ivfdata next to the index file
+        index = faiss.read_index(os.path.join(folder, 'index.faiss'), faiss.IO_FLAG_ONDISK_SAME_DIR)
+        set_search_parameters(index, nprobe, ef_search)
+
+    distance_strategy = (DistanceStrategy.MAX_INNER_PRODUCT if metric == faiss.METRIC_INNER_PRODUCT
+                         else DistanceStrategy.EUCLIDEAN_DISTANCE)
+    vectorstore = FAISS(embeddings, index, MmapDocstore(folder), range(info['ntotal']),
+                        normalize_L2=info['normalize_L2'], distance_strategy=distance_strategy)
+
+    bm25 = BM25Index(**info['bm25_params'])
+    bm25.weights = sparse.csr_matrix(
+        (np.load(os.path.join(folder, 'bm25.data.npy'), mmap_mode='r'),
+         np.load(os.path.join(folder, 'bm25.indices.npy'), mmap_mode='r'),
+         np.load(os.path.join(folder, 'bm25.indptr.npy'), mmap_mode='r')),
+        shape=tuple(info['bm25_shape']), copy=False
+    )
+    bm25.vocabulary = {term: row for row, term in enumerate(info['bm25_terms'])}
+    bm25.doc_ids = np.load(os.path.join(folder, 'bm25.doc_ids.npy'), mmap_mode='r')
+    return vectorstore, bm25, dict(info, name=name)
@@ -0,0 +1,151 @@
+import os
+import gzip
+import json
+
+from functions.functions_utils import hash_file
+
+# Folder holding the extracted page text of every validated PDF, keyed by content hash
+TEXT_CACHE_FOLDER = './cache/text'
+
+# Manifest of the validation results of check_dataset.py
+VALIDATION_MANIFEST_FILE = './cache/validation.json'
+
+# Name of the text extractor, part of the cache key so a new extractor never reads stale text
+TEXT_EXTRACTOR = 'pypdf'
+
+
+def text_cache_path(file_hash, cache_folder=TEXT_CACHE_FOLDER):
+    """
+    Return the path of the page text cache of a PDF.
+
+    Args:
+        file_hash (str): The SHA-256 hash of the PDF contents.
+        cache_folder (str): The folder holding the text cache.
+
+    Returns:
+        str: The path of the gzipped JSON lines file, one line per page.
+    """
+    return os.path.join(cache_folder, file_hash[:2], f"{file_hash}.{TEXT_EXTRACTOR}.jsonl.gz")
+
+
+def iter_pdf_pages(path):
+    """
+    Parse a PDF and yield the text of its pages one at a time.
+
+    Args:
+        path (str): The path of the PDF file.
+
+    Yields:
+        tuple: The page number (starting at 0) and its text.
+
+    Raises:
+        Exception: Any error raised by pypdf if the file is not a valid PDF.
+    """
+    # pypdf is only needed when a PDF is parsed, not to read its cached text
+    import pypdf
+
+    with open(path, 'rb') as f:
+        reader = pypdf.PdfReader(f)
+        for page_number, page in enumerate(reader.pages):
+            yield page_number, page.extract_text() or ""
+
+
+def _write_pages(pages, cache_path):
+    # Write pages to the cache while passing them on. The file is written under a
+    # temporary name and renamed once every page is written, so concurrent writers
+    # and interrupted runs never leave a truncated cache file.
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    complete = False
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+            for page_number, text in pages:
+                f.write(json.dumps({'page': page_number, 'text': text}) + "\n")
+                yield page_number, text
+        os.replace(tmp_path, cache_path)
+        complete = True
+    finally:
+        if not complete and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_pdf_pages(pages, cache_path):
+    """
+    Write the page text of a PDF to the text cache.
+
+    Args:
+        pages (iterable): (page number, text) tuples, consumed one at a time.
+        cache_path (str): The cache file to write.
+
+    Returns:
+        int: The number of pages written.
+    """
+    return sum(1 for _ in _write_pages(pages, cache_path))
+
+
+def iter_cached_pages(cache_path):
+    """
+    Read the page text of a PDF from the text cache, one page at a time.
+
+    Args:
+        cache_path (str): The cache file to read.
+
+    Yields:
+        tuple: The page number and its text.
+    """
+    with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            page = json.loads(line)
+            yield page['page'], page['text']
+
+
+def iter_pdf_text(path, file_hash=None, cache_folder=TEXT_CACHE_FOLDER):
+    """
+    Yield the page text of a PDF, from the text cache if it was extracted before.
+
+    PDFs that are not cached yet are parsed page by page and added to the cache
+    as the pages are consumed, so only a few pages are held in memory at a time.
+
+    Args:
+        path (str): The path of the PDF file.
+        file_hash (str): The SHA-256 hash of the file, if already known.
+        cache_folder (str): The folder holding the text cache.
+
+    Yields:
+        tuple: The page number and its text.
+    """
+    cache_path = text_cache_path(file_hash or hash_file(path), cache_folder)
+    if os.path.isfile(cache_path):
+        yield from iter_cached_pages(cache_path)
+    else:
+        yield from _write_pages(iter_pdf_pages(path), cache_path)
+
+
+def validate_pdf(path, cache_folder=TEXT_CACHE_FOLDER):
+    """
+    Check that a PDF parses and cache its page text in the same pass.
+
+    A PDF whose contents were validated before (under any path) already has a text
+    cache entry and is not parsed again.
+
+    Args:
+        path (str): The path of the PDF file.
+        cache_folder (str): The folder holding the text cache.
+
+    Returns:
+        dict: The file's size, mtime, sha256, whether it is valid, its page count,
+            whether it was already cached and the parse error of an invalid file.
+    """
+    stat = os.stat(path)
+    file_hash = hash_file(path)
+    result = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash}
+
+    cache_path = text_cache_path(file_hash, cache_folder)
+    if os.path.isfile(cache_path):
+        return dict(result, valid=True, pages=sum(1 for _ in iter_cached_pages(cache_path)), cached=True)
+
+    try:
+        pages = save_pdf_pages(iter_pdf_pages(path), cache_path)
+    except Exception as e:
+        return dict(result, valid=False, error=f"{type(e).__name__}: {e}", cached=False)
+    return dict(result, valid=True, pages=pages, cached=False)
@@ -1,23 +1,35 @@
 # File validation
-import pdfplumber
 import csv
+import json
+import hashlib
 import os
 
+from functions.functions_metrics import timed
+
 ALLOWED_EXTENSIONS = {'pdf'}
 
 # Check if the file has an allowed extension
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Yield (page number, text) for each page of a PDF, parsing one page at a time
+def iter_pdf_page_text(pdf_path):
+    # Imported here, so modules that only need the other helpers do not load pdfplumber
+    import pdfplumber
+
+    with pdfplumber.open(pdf_path) as pdf:
+        for page_number, page in enumerate(pdf.pages):
+            # Pages without a text layer return None
+            yield page_number, page.extract_text() or ""
+            # Drop the parsed layout objects of the page before moving on
+            page.flush_cache()
+
 # Extract text from a PDF
 def extract_text_from_pdf(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        text = ""
-        for page in pdf.pages:
-            text += page.extract_text()
-    return text
+    return "".join(text for _, text in iter_pdf_page_text(pdf_path))
 
 # Find all PDFs in the folder
+@timed('find_all_pdfs')
 def find_all_pdfs(root_folder):
     pdf_files = []
     for dirpath, _, filenames in os.walk(root_folder):
@@ -27,6 +39,14 @@ def find_all_pdfs(root_folder):
                 pdf_files.append(full_path)
     return pdf_files
 
+# Compute the SHA-256 hash of a file's contents, reading it in blocks
+def hash_file(file_path, block_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
 # Load file titles from a CSV file
 def load_file_titles(csv_file):
     file_titles = {}
@@ -50,3 +70,26 @@ def load_file_titles(csv_file):
             file_titles[file_path] = file_title
 
     return file_titles
+
+# Build the unique references (file path and title) of the retrieved chunks
+def get_references(context_docs, file_titles):
+    references = []
+
+    # Append source of related files to references by accessing metadata
+    for doc in context_docs:
+        if hasattr(doc, 'metadata') and 'source' in doc.metadata:
+            file_path = doc.metadata['source']  # Use the full file path
+            normalized_path = os.path.normpath(file_path)  # Normalize the path for matching
+            normalized_path = normalized_path.replace("\\", "/")  # Convert backslashes to slashes (if necessary)
+
+            # Find file title using the normalized path
+            # Fall back to the title stored with the chunk when indexing
+            file_title = file_titles.get(normalized_path) or doc.metadata.get('title') or "Unknown Title"
+            references.append({"file_path": normalized_path, "file_title": file_title})
+
+    # Remove duplicate file paths and titles
+    return [dict(t) for t in {tuple(d.items()) for d in references}]
+
+# Format one server-sent event
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,288 @@
+import os
+import math
+import pickle
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+# Vector index used to serve queries: one of INDEX_TYPES or a raw FAISS factory string
+INDEX_TYPE = os.getenv('INDEX_TYPE', 'flat')
+
+# Search-time parameters: IVF lists probed per query and HNSW candidate list size
+NPROBE = int(os.getenv('INDEX_NPROBE', 16))
+EF_SEARCH = int(os.getenv('INDEX_EF_SEARCH', 64))
+
+# Maximum number of vectors sampled to train IVF centroids and PQ codebooks
+TRAIN_SAMPLE_SIZE = 50000
+
+# Neighbours per node of the HNSW graph
+HNSW_M = 32
+
+# Filtered HNSW searches matching a smaller fraction of the vectors scan the flat storage instead
+HNSW_MIN_SELECTIVITY = 0.1
+
+# Dimensions per PQ sub-quantizer (1536-dim ada-002 vectors become 96-byte codes)
+PQ_SUB_DIMS = 16
+
+# File holding the serving index next to the exact index.faiss
+SERVING_INDEX_FILE = 'index.{index_type}.faiss'
+
+INDEX_TYPES = ('flat', 'fp16', 'sq8', 'ivf', 'ivfpq', 'hnsw')
+
+
+def get_factory_string(index_type, dim, n_vectors):
+    """
+    Translate an index type into a FAISS index factory string sized for the corpus.
+
+    Args:
+        index_type (str): 'flat' (exact), 'fp16' or 'sq8' (scalar quantized, exact scan),
+            'ivf' (inverted lists), 'ivfpq' (inverted lists with product quantized codes),
+            'hnsw' (graph), or any FAISS factory string such as 'IVF1024,PQ32'.
+        dim (int): The vector dimension.
+        n_vectors (int): The number of vectors the index will hold.
+
+    Returns:
+        str: The factory string.
+    """
+    # Roughly 4 * sqrt(n) lists, but at least 39 training vectors per list as FAISS recommends
+    nlist = max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+    if index_type == 'flat':
+        return 'Flat'
+    if index_type == 'fp16':
+        return 'SQfp16'
+    if index_type == 'sq8':
+        return 'SQ8'
+    if index_type == 'ivf':
+        return f'IVF{nlist},Flat'
+    if index_type == 'ivfpq':
+        m = next(m for m in range(max(1, dim // PQ_SUB_DIMS), 0, -1) if dim % m == 0)
+        # 8-bit codebooks need about 39 * 256 training vectors, small corpora get smaller ones
+        nbits = max(4, min(8, int(math.log2(max(n_vectors, 1) / 39)))) if n_vectors else 8
+        return f'IVF{nlist},PQ{m}x{nbits}'
+    if index_type == 'hnsw':
+        return f'HNSW{HNSW_M},Flat'
+    return index_type
+
+
+def set_search_parameters(index, nprobe=NPROBE, ef_search=EF_SEARCH):
+    """
+    Set the search-time accuracy/speed parameters of an index, where it has them.
+
+    Args:
+        index (faiss.Index): The index.
+        nprobe (int): The number of inverted lists probed per query (IVF indexes).
+        ef_search (int): The size of the candidate list per query (HNSW indexes).
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = getattr(faiss.downcast_index(index), 'hnsw', None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+
+
+def bitmap_selector(positions, total):
+    """
+    Build a selector accepting the given positions of an index.
+
+    FAISS objects only hold pointers to the memory they read, so the selector
+    keeps a reference to its bitmap, and filtered_search attaches the selector to
+    the search parameters it returns: whoever holds the parameters keeps both alive.
+
+    Args:
+        positions (np.ndarray): The accepted positions.
+        total (int): The number of vectors of the index.
+
+    Returns:
+        faiss.IDSelectorBitmap: The selector.
+    """
+    bits = np.zeros(total, dtype=bool)
+    bits[positions] = True
+    bitmap = np.packbits(bits, bitorder='little')
+    selector = faiss.IDSelectorBitmap(total, faiss.swig_ptr(bitmap))
+    selector.referenced_objects = [bitmap]
+    return selector
+
+
+def _selector_parameters(params_class, selector, **kwargs):
+    # The parameters keep the selector alive for as long as they are used
+    params = params_class(sel=selector, **kwargs)
+    params.referenced_objects = [selector]
+    return params
+
+
+def filtered_search(index, selector, selectivity=1.0):
+    """
+    Choose how to search only the vectors accepted by a selector.
+
+    Approximate indexes look at fewer matching vectors when few vectors match, so
+    IVF probes more lists and HNSW keeps a longer candidate list, in proportion
+    to how small the selected fraction is. Below HNSW_MIN_SELECTIVITY the graph
+    walk would mostly visit rejected vectors, so the HNSW's flat storage is
+    scanned instead, computing distances to the selected vectors only.
+
+    Args:
+        index (faiss.Index): The index to search.
+        selector (faiss.IDSelector): The selector of the allowed positions.
+        selectivity (float): The fraction of the index's vectors the selector accepts.
+
+    Returns:
+        tuple: The index to search (positions are those of index) and the faiss.SearchParameters to pass.
+    """
+    scale = 1.0 / max(selectivity, 1e-6)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return index, _selector_parameters(faiss.SearchParametersIVF, selector,
+                                           nprobe=min(ivf.nlist, math.ceil(ivf.nprobe * scale)))
+    hnsw_index = faiss.downcast_index(index)
+    hnsw = getattr(hnsw_index, 'hnsw', None)
+    if hnsw is not None:
+        if selectivity < HNSW_MIN_SELECTIVITY:
+            return faiss.downcast_index(hnsw_index.storage), _selector_parameters(faiss.SearchParameters, selector)
+        return index, _selector_parameters(faiss.SearchParametersHNSW, selector,
+                                           efSearch=min(index.ntotal, math.ceil(hnsw.efSearch * scale)))
+    return index, _selector_parameters(faiss.SearchParameters, selector)
+
+
+def build_faiss_index(vectors, index_type=INDEX_TYPE, metric=faiss.METRIC_L2, train_sample_size=TRAIN_SAMPLE_SIZE,
+                      seed=0):
+    """
+    Build a FAISS index of the given type over a matrix of vectors.
+
+    Index types that need training are trained on a random sample of the vectors.
+    The vectors are added in order, so position i of the index is row i of vectors.
+
+    Args:
+        vectors (np.ndarray): The vectors, one row per vector.
+        index_type (str): The index type or FAISS factory string (see get_factory_string).
+        metric (int): faiss.METRIC_L2 or faiss.METRIC_INNER_PRODUCT.
+        train_sample_size (int): The maximum number of vectors to train on.
+        seed (int): The seed of the training sample.
+
+    Returns:
+        faiss.Index: The trained and filled index.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_vectors, dim = vectors.shape
+    index = faiss.index_factory(dim, get_factory_string(index_type, dim, n_vectors), metric)
+
+    if not index.is_trained:
+        sample = vectors
+        if n_vectors > train_sample_size:
+            rows = np.random.default_rng(seed).choice(n_vectors, train_sample_size, replace=False)
+            sample = vectors[np.sort(rows)]
+        index.train(sample)
+
+    index.add(vectors)
+    set_search_parameters(index)
+    return index
+
+
+def index_memory_bytes(index):
+    """
+    Return the size of an index in bytes, as serialized (close to its size in RAM).
+
+    Args:
+        index (faiss.Index): The index.
+
+    Returns:
+        int: The number of bytes.
+    """
+    return int(faiss.serialize_index(index).size)
+
+
+def get_vectors(vectorstore):
+    """
+    Return every vector of a vector store with an exact (flat) index.
+
+    Args:
+        vectorstore (FAISS): The vector store.
+
+    Returns:
+        np.ndarray: The vectors, row i being the vector at index position i.
+    """
+    return vectorstore.index.reconstruct_n(0, vectorstore.index.ntotal)
+
+
+def get_metric(vectorstore):
+    """
+    Return the FAISS metric matching a vector store's distance strategy.
+    """
+    if vectorstore.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return faiss.METRIC_INNER_PRODUCT
+    return faiss.METRIC_L2
+
+
+def serving_index_path(index_folder, index_type):
+    """
+    Return the file the serving index of the given type is saved to.
+    """
+    safe_type = ''.join(c if c.isalnum() else '_' for c in index_type)
+    return os.path.join(index_folder, SERVING_INDEX_FILE.format(index_type=safe_type))
+
+
+def save_serving_index(vectorstore, index_folder, index_type=INDEX_TYPE):
+    """
+    Build the serving index of the given type from the exact index and save it,
+    removing the serving indexes of other types.
+
+    The exact index stays the source of truth for incremental updates (which delete
+    and merge vectors); the serving index is rebuilt from it after every update.
+    Positions are kept, so the saved docstore ids map to both indexes.
+
+    Args:
+        vectorstore (FAISS): The vector store with the exact index.
+        index_folder (str): The folder the index is saved to.
+        index_type (str): The index type or FAISS factory string.
+
+    Returns:
+        str or None: The path of the saved serving index, or None for 'flat'.
+    """
+    path = None
+    if index_type != 'flat':
+        index = build_faiss_index(get_vectors(vectorstore), index_type, get_metric(vectorstore))
+        path = serving_index_path(index_folder, index_type)
+        faiss.write_index(index, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    # Serving indexes of other types are out of date from now on
+    for file_name in os.listdir(index_folder):
+        file_path = os.path.join(index_folder, file_name)
+        if file_name.startswith('index.') and file_name.endswith('.faiss') and file_name != 'index.faiss' \
+                and file_path != path:
+            os.remove(file_path)
+    return path
+
+
+def load_serving_vectorstore(index_folder, embeddings, index_type=INDEX_TYPE, nprobe=NPROBE, ef_search=EF_SEARCH):
+    """
+    Load a vector store that searches with the serving index of the given type.
+
+    Only the serving index is read, so a compressed index never has the exact
+    vectors loaded next to it.
+
+    Args:
+        index_folder (str): The folder the index was saved to.
+        embeddings: The embeddings used to encode queries.
+        index_type (str): The index type or FAISS factory string.
+        nprobe (int): The number of inverted lists probed per query (IVF indexes).
+        ef_search (int): The size of the candidate list per query (HNSW indexes).
+
+    Returns:
+        FAISS: The vector store.
+
+    Raises:
+        FileNotFoundError: If no serving index of that type was built.
+    """
+    path = serving_index_path(index_folder, index_type)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No {index_type} index found in {index_folder}. Run build_index.py first.")
+
+    index = faiss.read_index(path)
+    set_search_parameters(index, nprobe, ef_search)
+    with open(os.path.join(index_folder, 'index.pkl'), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
@@ -1,109 +1,123 @@
 import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin
+
 import requests
 from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm  # Progress bar
-import time  # For request delay
 import csv  # Module for saving CSV files
 
-# Define base URL and chapters
-base_url = "https://www.nrc.gov/reading-rm/doc-collections/nuregs/staff/sr0800/ch"
-chapters = {f"Chapter{num}": f"{base_url}{num}/index.html" for num in range(5, 6)}
-
-# Base URL for downloads
-base_download_url = "https://www.nrc.gov"
-failed_downloads = []  # To track failed downloads
-
-# Dictionary to map file paths and titles
-file_titles = {}
-
-# Function to download the PDF
-def download_pdf(pdf_name, link, root_dir):
-    pdf_path = os.path.join(root_dir, pdf_name)
-
-    # Check if file already exists
-    if os.path.exists(pdf_path):
-        print(f"Skipping {pdf_name}, already exists.")
-        return
-
-    try:
-        response = requests.get(link)
-        response.raise_for_status()  # Check for HTTP errors
-        with open(pdf_path, 'wb') as pdf_file:
-            pdf_file.write(response.content)
-        print(f"Downloaded {pdf_name} to {root_dir}")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download {pdf_name}: {e}")
-        failed_downloads.append(pdf_name)  # Track the failed download (file name)
-
-# Function to process each chapter
-def process_chapter(chapter_name, chapter_url, progress_bar):
-    try:
-        # Create a folder for the chapter if it doesn't exist
-        root_dir = f"./database/manual/NUREG0800_{chapter_name}"
-        if not os.path.exists(root_dir):
-            os.makedirs(root_dir)
-        
-        # Parse the webpage
-        response = requests.get(chapter_url)
-        response.raise_for_status()  # Check for HTTP errors
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # Find the section table
-        table_rows = soup.find_all('tr')
-
-        # Iterate through the rows to process each section
-        for row in table_rows:
-            cells = row.find_all('td')
-            if len(cells) > 2:  # Ensure there are at least 3 cells (for index 2 to be valid)
-                section = cells[0].text.strip().replace('.', '_').replace(' ', '_').replace('-', '_')
-                title = cells[1].text.strip()  # Extract the file title
-                rev_link = cells[2].find('a')
-                if rev_link:
-                    pdf_url = base_download_url + rev_link['href']
-                    pdf_name = section + ".pdf"
-                    download_pdf(pdf_name, pdf_url, root_dir)
-                    progress_bar.update(1)  # Update the progress bar
-
-                    # Save the path and title in the dictionary
-                    file_path = os.path.join(root_dir, pdf_name)
-
-                    # Normalize the path and replace backslashes with slashes
-                    normalized_path = os.path.normpath(file_path).replace("\\", "/")
-                    file_titles[normalized_path] = title
-
-                    # Add a delay between requests to avoid overloading the server
-                    time.sleep(1)
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to process {chapter_name}: {e}")
+from functions.functions_crawler import Crawler, DOWNLOAD_MANIFEST_FILE, REQUESTS_PER_SECOND, BURST
+
+# Site hosting the NUREG-0800 Standard Review Plan and its chapters (1 to 19)
+BASE_URL = "https://www.nrc.gov"
+CHAPTER_PATH = "/reading-rm/doc-collections/nuregs/staff/sr0800/ch{num}/index.html"
+CHAPTER_NUMBERS = range(1, 20)
+
+DATABASE_FOLDER = "./database/manual"
+
+# Build the chapter index URLs
+def get_chapters(base_url, chapter_numbers):
+    return {f"Chapter{num}": base_url.rstrip('/') + CHAPTER_PATH.format(num=num) for num in chapter_numbers}
+
+# Parse a chapter index page into (pdf name, title, pdf url) tuples
+def parse_chapter(page, chapter_url):
+    soup = BeautifulSoup(page, 'html.parser')
+    pdfs = []
+
+    # Iterate through the rows of the section table
+    for row in soup.find_all('tr'):
+        cells = row.find_all('td')
+        if len(cells) > 2:  # Ensure there are at least 3 cells (for index 2 to be valid)
+            section = cells[0].text.strip().replace('.', '_').replace(' ', '_').replace('-', '_')
+            title = cells[1].text.strip()  # Extract the file title
+            rev_link = cells[2].find('a')
+            if rev_link and rev_link.get('href'):
+                pdfs.append((section + ".pdf", title, urljoin(chapter_url, rev_link['href'])))
+    return pdfs
+
+# Download a PDF unless an earlier crawl already finished it
+def download_pdf(crawler, pdf_url, pdf_path, revalidate):
+    if not revalidate and crawler.is_complete(pdf_url, pdf_path):
+        return 'skipped'
+    if not revalidate and pdf_url not in crawler.manifest and os.path.exists(pdf_path):
+        # Downloaded before the manifest existed
+        return 'skipped'
+    return crawler.download(pdf_url, pdf_path)
 
 # Function to save file titles to CSV
-def save_titles_to_csv():
-    csv_file_path = "file_titles.csv"
+def save_titles_to_csv(file_titles, csv_file_path="file_titles.csv"):
     with open(csv_file_path, mode="w", newline="") as csv_file:
         writer = csv.writer(csv_file)
         writer.writerow(["File Path", "File Title"])  # Write the CSV header
-        for file_path, title in file_titles.items():
+        for file_path, title in sorted(file_titles.items()):
             writer.writerow([file_path, title])  # Save each file path and title to the CSV
     print(f"File titles saved to {csv_file_path}")
 
-# Process chapters in parallel with a progress bar
-def process_all_chapters():
-    total_chapters = len(chapters)  # Total number of chapters to process
-    with ThreadPoolExecutor() as executor:
-        with tqdm(total=total_chapters, desc="Processing Chapters", unit="chapter") as progress_bar:
-            for chapter_name, chapter_url in chapters.items():
-                print(f"Processing {chapter_name}...")
-                executor.submit(process_chapter, chapter_name, chapter_url, progress_bar)
-
-    # Write failed downloads (file names) to a text file
-    if failed_downloads:
+# Crawl all chapters, then download their PDFs concurrently
+def process_all_chapters(chapters, crawler, database_folder=DATABASE_FOLDER, workers=8, revalidate=False):
+    file_titles = {}  # Dictionary to map file paths and titles
+    failed = []  # To track failed chapters and downloads
+    downloads = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Parse the chapter index pages
+        futures = {executor.submit(crawler.fetch_page, url): (name, url) for name, url in chapters.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing Chapters", unit="chapter"):
+            chapter_name, chapter_url = futures[future]
+            try:
+                pdfs = parse_chapter(future.result(), chapter_url)
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to process {chapter_name}: {e}")
+                failed.append(chapter_url)
+                continue
+
+            root_dir = os.path.join(database_folder, f"NUREG0800_{chapter_name}")
+            for pdf_name, title, pdf_url in pdfs:
+                pdf_path = os.path.join(root_dir, pdf_name)
+
+                # Normalize the path and replace backslashes with slashes
+                file_titles[os.path.normpath(pdf_path).replace("\\", "/")] = title
+                downloads.append((pdf_url, pdf_path))
+
+        # Download the PDFs; the per-host rate limit paces the requests of all threads
+        futures = {executor.submit(download_pdf, crawler, url, path, revalidate): (url, path) for url, path in downloads}
+        counts = {}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading PDFs", unit="file"):
+            pdf_url, pdf_path = futures[future]
+            try:
+                status = future.result()
+                counts[status] = counts.get(status, 0) + 1
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Failed to download {pdf_path}: {e}")
+                failed.append(pdf_url)
+
+    print(", ".join(f"{status}: {count}" for status, count in sorted(counts.items())) or "No PDFs found")
+
+    # Write failed downloads to a text file
+    if failed:
         with open("failed_downloads.txt", "w") as f:
-            for item in failed_downloads:
+            for item in failed:
                 f.write(f"{item}\n")
         print("Failed downloads recorded in failed_downloads.txt")
 
     # Save the file path to title dictionary to a CSV file
-    save_titles_to_csv()
-
-process_all_chapters()
+    save_titles_to_csv(file_titles)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download the NUREG-0800 PDFs to ./database.")
+    parser.add_argument('--chapters', type=int, nargs='+', default=list(CHAPTER_NUMBERS), help="Chapter numbers to download")
+    parser.add_argument('--base-url', default=BASE_URL, help="Site to crawl (e.g. a local mirror)")
+    parser.add_argument('--workers', type=int, default=8, help="Number of concurrent requests")
+    parser.add_argument('--rate', type=float, default=REQUESTS_PER_SECOND, help="Requests per second per host")
+    parser.add_argument('--burst', type=int, default=BURST, help="Requests that may be sent back to back")
+    parser.add_argument('--revalidate', action='store_true',
+                        help="Re-check downloaded files with conditional requests and fetch changed ones")
+    parser.add_argument('--manifest', default=DOWNLOAD_MANIFEST_FILE, help="Download manifest file")
+    args = parser.parse_args()
+
+    crawler = Crawler(args.manifest, rate=args.rate, burst=args.burst, pool_size=args.workers)
+    process_all_chapters(get_chapters(args.base_url, args.chapters), crawler, workers=args.workers,
+                         revalidate=args.revalidate)
@@ -0,0 +1,60 @@
+import time
+import asyncio
+import argparse
+
+import httpx
+import numpy as np
+
+# Load test for /ask. Start the server with a local stub LLM and embedder, e.g.
+#   LLM_MODEL=fake FAKE_LLM_LATENCY=1.0 EMBEDDING_MODEL=hash-1536 python app.py
+#   LLM_MODEL=fake FAKE_LLM_LATENCY=1.0 EMBEDDING_MODEL=hash-1536 hypercorn app_async:app --bind 0.0.0.0:5001
+# and compare the throughput of both serving modes at the same concurrency.
+parser = argparse.ArgumentParser(description="Send concurrent questions to the search engine and report latency.")
+parser.add_argument('--url', default='http://127.0.0.1:5001/ask', help="Endpoint to send questions to")
+parser.add_argument('--requests', type=int, default=500, help="Total number of questions to send")
+parser.add_argument('--concurrency', type=int, default=100, help="Number of questions in flight at once")
+parser.add_argument('--question', default='What is reactor core isolation?', help="Question to ask")
+parser.add_argument('--repeat', action='store_true', help="Ask the same question every time (answer cache hits)")
+args = parser.parse_args()
+
+
+async def worker(client, queue, latencies, errors):
+    while True:
+        try:
+            request_id = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        # A numbered question defeats the answer cache unless --repeat is given
+        question = args.question if args.repeat else f"{args.question} ({request_id})"
+        start = time.perf_counter()
+        try:
+            response = await client.post(args.url, json={'question': question})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+
+
+async def main():
+    queue = asyncio.Queue()
+    for request_id in range(args.requests):
+        queue.put_nowait(request_id)
+
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client, queue, latencies, errors) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - start
+
+    print(f"Requests: {len(latencies)} ok, {len(errors)} failed in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.1f} requests/s at concurrency {args.concurrency})")
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"Latency: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, p99 {p99 * 1000:.0f} ms")
+    if errors:
+        print(f"First error: {errors[0]}")
+
+
+asyncio.run(main())
@@ -0,0 +1,43 @@
+import time
+import argparse
+from dotenv import load_dotenv
+
+# Load environment variables (SHARD_THREADS, INDEX_NPROBE, ...) before the functions modules read them
+load_dotenv()
+
+from functions.functions_index import INDEX_FOLDER
+from functions.functions_shards import (
+    SHARD_THREADS,
+    load_shards_info,
+    start_shard_processes,
+    terminate_shard_process
+)
+
+# Serve the shards built by build_index.py --shards N, one process per shard, for the application
+# workers started with SHARDED_INDEX=1 and SHARD_ADDRESSES set to the printed addresses
+parser = argparse.ArgumentParser(description="Start one search process per index shard.")
+parser.add_argument('--index', default=INDEX_FOLDER, help="Index folder holding the shards")
+parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on")
+parser.add_argument('--port', type=int, default=6100, help="Port of the first shard (the others follow it)")
+parser.add_argument('--threads', type=int, default=SHARD_THREADS, help="FAISS threads per shard process")
+args = parser.parse_args()
+
+info = load_shards_info(args.index)
+if info is None:
+    raise SystemExit(f"No shards found in {args.index}. Run build_index.py --shards N first.")
+
+shards = list(range(info['n_shards']))
+started = start_shard_processes(args.index, shards, args.host, [args.port + shard for shard in shards], args.threads)
+for shard, (_, (host, port)) in zip(shards, started):
+    print(f"Shard {shard}: {info['sizes'][shard]} chunks on {host}:{port}")
+print(f"SHARD_ADDRESSES={','.join(f'{host}:{port}' for _, (host, port) in started)}")
+
+# The shard processes exit with this one
+try:
+    while all(process.poll() is None for process, _ in started):
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
+finally:
+    for process, _ in started:
+        terminate_shard_process(process)
@@ -0,0 +1,45 @@
+import gc
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+import functions.functions_retrieval as functions_retrieval
+from functions.functions_embeddings import HashEmbeddings
+from functions.functions_index import build_bm25_index
+from functions.functions_retrieval import HybridRetriever
+
+CHAPTERS = 10
+CHUNKS_PER_CHAPTER = 200
+
+
+def make_retriever():
+    embeddings = HashEmbeddings(size=64)
+    texts = [f"chapter {chunk % CHAPTERS} reactor coolant valve {chunk}"
+             for chunk in range(CHAPTERS * CHUNKS_PER_CHAPTER)]
+    metadatas = [{'source': f'database/manual/NUREG0800_Chapter{chunk % CHAPTERS}/{chunk % CHAPTERS}_1.pdf',
+                  'chapter': chunk % CHAPTERS, 'section': f'{chunk % CHAPTERS}_1'}
+                 for chunk in range(len(texts))]
+    vectorstore = FAISS.from_embeddings(list(zip(texts, embeddings.embed_documents(texts))), embeddings,
+                                        metadatas=metadatas)
+    return HybridRetriever(vectorstore, build_bm25_index(vectorstore), k=4, candidate_k=50)
+
+
+def test_partition_evicted_during_search_still_filters(monkeypatch):
+    retriever = make_retriever()
+    retriever.partitions.cache_size = 1
+    vector_search = functions_retrieval.vector_search
+
+    def evict_then_search(*args, **kwargs):
+        # Another request's filters push this search's partition out of the cache before FAISS reads it
+        retriever.partitions.get({'chapter': [9]})
+        gc.collect()
+        # Reuse the freed memory, so a dangling bitmap would accept other chunks
+        junk = [np.full(CHAPTERS * CHUNKS_PER_CHAPTER // 8, 255, dtype=np.uint8) for _ in range(100)]
+        hits = vector_search(*args, **kwargs)
+        del junk
+        return hits
+
+    monkeypatch.setattr(functions_retrieval, 'vector_search', evict_then_search)
+    for _ in range(5):
+        docs, _ = retriever.retrieve_with_timings("reactor coolant valve", k=50, filters={'chapter': [3]})
+        assert docs and all(doc.metadata['chapter'] == 3 for doc in docs)
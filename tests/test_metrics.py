@@ -0,0 +1,49 @@
+import asyncio
+
+from langchain_community.vectorstores import FAISS
+
+import functions.functions_metrics as functions_metrics
+import functions.functions_retrieval as functions_retrieval
+from functions.functions_embeddings import HashEmbeddings
+from functions.functions_index import build_bm25_index
+from functions.functions_metrics import span, start_request_spans, stop_request_spans
+from functions.functions_retrieval import HybridRetriever
+
+
+def make_retriever():
+    embeddings = HashEmbeddings(size=64)
+    texts = [f"reactor coolant valve {chunk}" for chunk in range(50)]
+    vectorstore = FAISS.from_embeddings(list(zip(texts, embeddings.embed_documents(texts))), embeddings)
+    return HybridRetriever(vectorstore, build_bm25_index(vectorstore), k=4)
+
+
+def test_spans_recorded_in_executor_threads_reach_the_request(monkeypatch):
+    monkeypatch.setattr(functions_metrics, 'TIMING_HEADER', True)
+    retriever = make_retriever()
+    search_bm25 = retriever._bm25_search
+    vector_search = functions_retrieval.vector_search
+    vector_search_by_vectors = functions_retrieval.vector_search_by_vectors
+
+    def timed_call(stage, func):
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(retriever, '_bm25_search', timed_call('probe_bm25', search_bm25))
+    monkeypatch.setattr(functions_retrieval, 'vector_search', timed_call('probe_vector', vector_search))
+    monkeypatch.setattr(functions_retrieval, 'vector_search_by_vectors',
+                        timed_call('probe_vector', vector_search_by_vectors))
+
+    token = start_request_spans()
+    retriever.retrieve_with_timings("reactor coolant valve")
+    header = stop_request_spans(token)
+    assert 'probe_bm25' in header and 'probe_vector' in header
+
+    async def request():
+        token = start_request_spans()
+        await retriever.aretrieve_with_timings("reactor coolant valve")
+        return stop_request_spans(token)
+
+    header = asyncio.run(request())
+    assert 'probe_bm25' in header and 'probe_vector' in header
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+from langchain_community.vectorstores import FAISS
+
+from functions.functions_embeddings import HashEmbeddings
+from functions.functions_index import build_bm25_index
+from functions.functions_retrieval import HybridRetriever
+
+
+class FailingReranker:
+    def score(self, question, texts):
+        raise RuntimeError("model not loaded")
+
+
+class BlockingReranker:
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def score(self, question, texts):
+        self.calls += 1
+        self.release.wait()
+        return [0.0] * len(texts)
+
+
+def make_retriever(reranker):
+    embeddings = HashEmbeddings(size=64)
+    texts = [f"reactor coolant valve {chunk} " + "inspection " * (chunk % 7) for chunk in range(100)]
+    vectorstore = FAISS.from_embeddings(list(zip(texts, embeddings.embed_documents(texts))), embeddings)
+    return HybridRetriever(vectorstore, build_bm25_index(vectorstore), k=4, reranker=reranker,
+                           rerank_candidates=20, rerank_budget=0.05)
+
+
+def test_failing_reranker_falls_back_to_fused_ranking():
+    retriever = make_retriever(FailingReranker())
+    docs, timings = retriever.retrieve_with_timings("reactor coolant valve")
+    assert len(docs) == 4 and 'rerank' not in timings
+    docs, _ = asyncio.run(retriever.aretrieve_with_timings("reactor coolant valve"))
+    assert len(docs) == 4
+    assert retriever.rerank_fallbacks == 2
+
+
+def test_no_rerank_starts_while_one_is_over_budget():
+    reranker = BlockingReranker()
+    retriever = make_retriever(reranker)
+    try:
+        for _ in range(3):
+            docs, _ = retriever.retrieve_with_timings("reactor coolant valve")
+            assert len(docs) == 4
+        docs, _ = asyncio.run(retriever.aretrieve_with_timings("reactor coolant valve"))
+        assert len(docs) == 4
+        assert reranker.calls == 1
+        assert retriever.rerank_fallbacks == 4
+    finally:
+        reranker.release.set()